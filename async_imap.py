@@ -0,0 +1,157 @@
+"""
+Minimal asyncio IMAP4rev1 client used by the pipelined delete path of the
+Gmail cleanup engine. Unlike imaplib it can keep several tagged commands in
+flight on one connection, and any number of connections can share one event
+loop. Errors use imaplib's exception types so callers handle both paths the
+same way.
+"""
+import asyncio
+import imaplib
+import re
+import ssl
+import time
+from collections import OrderedDict
+
+LITERAL_RE = re.compile(rb'\{(\d+)\}\r\n$')
+
+
+def quote(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class AsyncImapConnection:
+    """
+    One IMAP connection with pipelining. ``send()`` writes a command at once
+    and returns a future of ``(status, untagged, text)``. ``command()`` and
+    ``uid()`` await that future and return ``(status, data)`` like imaplib:
+    the untagged responses on OK, the tagged response text otherwise.
+
+    The server answers pipelined commands in order, so an untagged response
+    belongs to the oldest command still waiting for its tagged completion.
+    Literals are inlined into the response bytes. With ``metrics`` (an
+    ImapMetrics), every command records its latency from being written to
+    its tagged completion, and the bytes of its command line and responses.
+    """
+
+    def __init__(self, reader, writer, metrics=None):
+        self._reader = reader
+        self._writer = writer
+        self.metrics = metrics
+        self._counter = 0
+        self._pending = OrderedDict()
+        self._error = None
+        self.capabilities = set()
+        self._read_task = None
+        self._received = 0
+
+    @classmethod
+    async def open(cls, host, port, ssl_context=None, metrics=None):
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=ssl_context if ssl_context is not None else ssl.create_default_context(),
+            server_hostname=host)
+        conn = cls(reader, writer, metrics)
+        greeting = await conn._read_response()
+        if not greeting.startswith(b'* OK'):
+            writer.close()
+            raise imaplib.IMAP4.error(f"Unexpected greeting: {greeting!r}")
+        conn._read_task = asyncio.ensure_future(conn._read_loop())
+        return conn
+
+    async def _read_response(self):
+        line = await self._reader.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("socket closed by server")
+        response = line
+        while True:
+            match = LITERAL_RE.search(line)
+            if not match:
+                break
+            literal = await self._reader.readexactly(int(match.group(1)))
+            line = await self._reader.readline()
+            response += literal + line
+        self._received = len(response)
+        return response.rstrip(b'\r\n')
+
+    async def _read_loop(self):
+        try:
+            while True:
+                response = await self._read_response()
+                if response.startswith(b'* '):
+                    waiting = next(iter(self._pending.values()), None)
+                    if waiting is not None:
+                        waiting[1].append(response[2:])
+                        waiting[4] += self._received
+                elif not response.startswith(b'+'):
+                    tag, _, rest = response.partition(b' ')
+                    status, _, text = rest.partition(b' ')
+                    waiting = self._pending.pop(tag.decode(errors='ignore'), None)
+                    if waiting is not None:
+                        status = status.decode(errors='ignore')
+                        self._record(waiting, self._received, status == 'OK')
+                        if not waiting[0].done():
+                            waiting[0].set_result((status, waiting[1], text))
+        except asyncio.CancelledError:
+            self._fail(imaplib.IMAP4.abort("connection closed"))
+            raise
+        except Exception as e:
+            self._fail(e if isinstance(e, imaplib.IMAP4.abort) else imaplib.IMAP4.abort(str(e) or type(e).__name__))
+
+    def _record(self, waiting, received, ok):
+        if self.metrics is not None:
+            _, _, name, started, untagged_bytes, sent = waiting
+            self.metrics.record(name, time.monotonic() - started, sent, untagged_bytes + received, ok)
+
+    def _fail(self, error):
+        self._error = error
+        for waiting in self._pending.values():
+            self._record(waiting, 0, False)
+            if not waiting[0].done():
+                waiting[0].set_exception(error)
+        self._pending.clear()
+
+    def send(self, *args):
+        if self._error is not None:
+            raise self._error
+        self._counter += 1
+        tag = f"P{self._counter}"
+        future = asyncio.get_running_loop().create_future()
+        line = f"{tag} {' '.join(args)}\r\n".encode()
+        name = f"UID {args[1].upper()}" if args[0].upper() == 'UID' and len(args) > 1 else args[0].upper()
+        # future, untagged responses, command name, start time, untagged bytes, bytes sent
+        self._pending[tag] = [future, [], name, time.monotonic(), 0, len(line)]
+        self._writer.write(line)
+        return future
+
+    async def command(self, *args):
+        future = self.send(*args)
+        try:
+            await self._writer.drain()
+        except OSError as e:
+            self._fail(imaplib.IMAP4.abort(str(e) or type(e).__name__))
+        status, untagged, text = await future
+        if status == 'BAD':
+            raise imaplib.IMAP4.error(f"{args[0]} command error: BAD [{text!r}]")
+        return status, untagged if status == 'OK' else [text]
+
+    async def uid(self, command, *args):
+        return await self.command('UID', command, *args)
+
+    async def login(self, user, password):
+        status, _ = await self.command('LOGIN', quote(user), quote(password))
+        if status != 'OK':
+            raise imaplib.IMAP4.error("LOGIN failed")
+        status, untagged = await self.command('CAPABILITY')
+        for response in untagged:
+            if response.startswith(b'CAPABILITY'):
+                self.capabilities = set(response.decode(errors='ignore').upper().split()[1:])
+
+    async def logout(self):
+        try:
+            if self._error is None:
+                await asyncio.wait_for(self.command('LOGOUT'), 5)
+        except Exception:
+            pass
+        finally:
+            if self._read_task is not None:
+                self._read_task.cancel()
+            self._writer.close()
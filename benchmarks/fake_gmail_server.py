@@ -0,0 +1,1076 @@
+"""
+Offline stand-in for Gmail's IMAP server.
+
+Emulates the subset of IMAP4rev1 and the Gmail extensions used by the
+cleanup engine: X-GM-MSGID / X-GM-THRID / X-GM-LABELS / X-GM-RAW, Trash
+semantics, MOVE, UIDPLUS ``UID EXPUNGE``, CONDSTORE / QRESYNC, LIST-STATUS
+and ``[THROTTLED]`` responses. Latency and throttling can be injected so the
+delete and scan paths can be measured without touching a real account.
+
+    python -m benchmarks.fake_gmail_server --messages 10000 --port 1143
+    python -m benchmarks.fake_gmail_server --messages 10000 --self-signed /tmp/fake-gmail
+"""
+import argparse
+import bisect
+import os
+import queue
+import random
+import re
+import socketserver
+import ssl
+import subprocess
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+SYSTEM_FOLDERS = {
+    "INBOX": None,
+    "[Gmail]/All Mail": "\\All",
+    "[Gmail]/Sent Mail": "\\Sent",
+    "[Gmail]/Spam": "\\Junk",
+    "[Gmail]/Trash": "\\Trash",
+    "[Gmail]/Starred": "\\Flagged",
+}
+TRASH = "[Gmail]/Trash"
+SPAM = "[Gmail]/Spam"
+ALL_MAIL = "[Gmail]/All Mail"
+LABEL_FOLDERS = {"\\Inbox": "INBOX", "\\Trash": TRASH, "\\Spam": SPAM, "\\Sent": "[Gmail]/Sent Mail",
+                 "\\Starred": "[Gmail]/Starred"}
+FOLDER_LABELS = {folder: label for label, folder in LABEL_FOLDERS.items()}
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+SENDERS = ["news@shop.example", "noreply@x.example", "alice@example.org", "bob@example.net",
+           "deals@promo.example", "team@lists.example", "billing@service.example"]
+
+
+class Message:
+    __slots__ = ("msgid", "thrid", "size", "date", "sender", "list_id", "category", "seen", "flagged")
+
+    def __init__(self, msgid, thrid, size, date, sender, list_id, category, seen=False, flagged=False):
+        self.msgid = msgid
+        self.thrid = thrid
+        self.size = size
+        self.date = date
+        self.sender = sender
+        self.list_id = list_id
+        self.category = category
+        self.seen = seen
+        self.flagged = flagged
+
+    def header_block(self):
+        lines = [f"From: {self.sender}"]
+        if self.list_id:
+            lines.append(f"List-ID: <{self.list_id}>")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+    def raw(self):
+        header = (
+            f"From: {self.sender}\r\nTo: you@gmail.com\r\nSubject: Message {self.msgid}\r\n"
+            f'Date: {self.date.strftime("%a, %d %b %Y %H:%M:%S +0000")}\r\n'
+            + (f"List-ID: <{self.list_id}>\r\n" if self.list_id else "")
+            + f"Message-ID: <{self.msgid}@fake.gmail>\r\n\r\n"
+        ).encode()
+        body_len = max(self.size - len(header), 2)
+        line = b"x" * 76 + b"\r\n"
+        body = (line * (body_len // len(line) + 1))[:body_len - 2] + b"\r\n"
+        return header + body
+
+
+class Folder:
+    """
+    One IMAP mailbox view. UIDs are handed out in increasing order, so the
+    insertion order of ``entries`` is already the sorted UID list.
+    """
+
+    def __init__(self, name, uidvalidity):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.entries = {}
+        self.modseqs = {}
+        self.deleted = set()
+        self.vanished = []
+        self.highestmodseq = 1
+        self._uids = []
+
+    @property
+    def uids(self):
+        if self._uids is None:
+            self._uids = list(self.entries)
+        return self._uids
+
+    def add(self, message, modseq):
+        uid = self.uidnext
+        self.uidnext += 1
+        self.entries[uid] = message
+        self.modseqs[uid] = modseq
+        self.highestmodseq = max(self.highestmodseq, modseq)
+        if self._uids is not None:
+            self._uids.append(uid)
+        return uid
+
+    def remove(self, uid, modseq):
+        if self.entries.pop(uid, None) is None:
+            return
+        self._uids = None
+        self.modseqs.pop(uid, None)
+        self.deleted.discard(uid)
+        self.vanished.append((uid, modseq))
+        self.highestmodseq = max(self.highestmodseq, modseq)
+
+    def touch(self, uid, modseq):
+        if uid in self.entries:
+            self.modseqs[uid] = modseq
+            self.highestmodseq = max(self.highestmodseq, modseq)
+
+
+class FakeGmail:
+    """
+    Shared mailbox state. Every folder is a label view over the same
+    ``Message`` objects, so moving a message to Trash removes it from all
+    other labels exactly like Gmail does.
+    """
+
+    def __init__(self, username="user@gmail.com", password="app-password", latency=0.0,
+                 throttle_every=0, throttle_rate=0.0, capabilities=None, seed=1, rtt=0.0,
+                 drop_every=0):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.rtt = rtt
+        self.throttle_every = throttle_every
+        self.throttle_rate = throttle_rate
+        self.drop_every = drop_every
+        self.drops = 0
+        self.capabilities = list(capabilities if capabilities is not None else [
+            "IMAP4rev1", "UNSELECT", "IDLE", "NAMESPACE", "QUOTA", "ID", "XLIST", "CHILDREN",
+            "X-GM-EXT-1", "UIDPLUS", "COMPRESS=DEFLATE", "ENABLE", "MOVE", "CONDSTORE", "ESEARCH",
+            "UTF8=ACCEPT", "LIST-EXTENDED", "LIST-STATUS", "LITERAL-", "SPECIAL-USE", "QRESYNC",
+        ])
+        self.lock = threading.RLock()
+        self.random = random.Random(seed)
+        self.modseq = 1
+        self.next_msgid = 1_600_000_000_000_000_000
+        self.folders = {}
+        self.locations = {}
+        self.commands = 0
+        for name in list(SYSTEM_FOLDERS) + ["[Gmail]"]:
+            self.create_folder(name)
+
+    def create_folder(self, name):
+        with self.lock:
+            if name not in self.folders:
+                self.folders[name] = Folder(name, 1000 + len(self.folders))
+            return self.folders[name]
+
+    def bump(self):
+        self.modseq += 1
+        return self.modseq
+
+    def populate(self, count, labels=("INBOX",), start_date=None, size_range=(2_000, 60_000)):
+        """
+        Add ``count`` synthetic messages to every folder in ``labels`` plus All Mail.
+        """
+        start_date = start_date or datetime(2019, 1, 1, tzinfo=timezone.utc)
+        rng = self.random
+        with self.lock:
+            targets = [self.create_folder(label) for label in labels]
+            all_mail = self.folders[ALL_MAIL]
+            for index in range(count):
+                self.next_msgid += rng.randint(1, 50)
+                sender = SENDERS[index % len(SENDERS)]
+                message = Message(
+                    msgid=self.next_msgid,
+                    thrid=self.next_msgid - (index % 3),
+                    size=rng.randint(*size_range),
+                    date=start_date + timedelta(minutes=37 * index),
+                    sender=sender,
+                    list_id="team.lists.example" if sender.startswith("team@") else None,
+                    category="promotions" if sender.split("@")[0] in ("news", "deals") else "primary",
+                    flagged=index % 50 == 0,
+                )
+                modseq = self.bump()
+                locations = {}
+                for folder in targets + [all_mail]:
+                    locations[folder.name] = folder.add(message, modseq)
+                self.locations[message.msgid] = locations
+
+    def folder_labels(self, message):
+        labels = []
+        for name in self.locations.get(message.msgid, {}):
+            if name == ALL_MAIL:
+                continue
+            labels.append(FOLDER_LABELS.get(name, name))
+        return labels
+
+    def add_label(self, message, folder_name):
+        locations = self.locations.setdefault(message.msgid, {})
+        if folder_name in locations:
+            return
+        if folder_name == TRASH:
+            modseq = self.bump()
+            for name, uid in list(locations.items()):
+                self.folders[name].remove(uid, modseq)
+            locations.clear()
+        elif TRASH in locations or SPAM in locations:
+            self.remove_label(message, TRASH)
+            self.remove_label(message, SPAM)
+            locations.setdefault(ALL_MAIL, self.folders[ALL_MAIL].add(message, self.bump()))
+        locations[folder_name] = self.create_folder(folder_name).add(message, self.bump())
+        if folder_name != TRASH and folder_name != SPAM and ALL_MAIL not in locations:
+            locations[ALL_MAIL] = self.folders[ALL_MAIL].add(message, self.bump())
+
+    def remove_label(self, message, folder_name):
+        locations = self.locations.get(message.msgid, {})
+        uid = locations.pop(folder_name, None)
+        if uid is not None:
+            self.folders[folder_name].remove(uid, self.bump())
+        if folder_name == ALL_MAIL:
+            self.add_label(message, TRASH)
+        elif not locations:
+            self.locations.pop(message.msgid, None)
+
+    def total_messages(self):
+        return len(self.locations)
+
+
+def tokenize(text):
+    """
+    Split an IMAP argument string into atoms, quoted strings and nested lists.
+    """
+    tokens = []
+    stack = [tokens]
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char == " ":
+            index += 1
+        elif char == "(":
+            new = []
+            stack[-1].append(new)
+            stack.append(new)
+            index += 1
+        elif char == ")":
+            stack.pop()
+            index += 1
+        elif char == '"':
+            index += 1
+            value = []
+            while text[index] != '"':
+                if text[index] == "\\":
+                    index += 1
+                value.append(text[index])
+                index += 1
+            stack[-1].append(("Q", "".join(value)))
+            index += 1
+        else:
+            start = index
+            depth = 0
+            while index < len(text) and (depth or text[index] not in ' ()"'):
+                if text[index] == "[":
+                    depth += 1
+                elif text[index] == "]":
+                    depth -= 1
+                index += 1
+            stack[-1].append(text[start:index])
+    return tokens
+
+
+def atom(token):
+    return token[1] if isinstance(token, tuple) else token
+
+
+def parse_set(text, largest):
+    """
+    Yield ``(low, high)`` pairs of an IMAP sequence set, resolving ``*``.
+    """
+    for part in text.split(","):
+        if ":" in part:
+            low, high = part.split(":", 1)
+        else:
+            low = high = part
+        low = largest if low == "*" else int(low)
+        high = largest if high == "*" else int(high)
+        if low > high:
+            low, high = high, low
+        yield low, high
+
+
+def uids_in_set(folder, text):
+    largest = folder.uids[-1] if folder.uids else 0
+    found = []
+    for low, high in parse_set(text, largest):
+        start = bisect.bisect_left(folder.uids, low)
+        end = bisect.bisect_right(folder.uids, high)
+        found.extend(folder.uids[start:end])
+    return sorted(set(found))
+
+
+def imap_date(value):
+    return datetime.strptime(value, "%d-%b-%Y").replace(tzinfo=timezone.utc)
+
+
+def gmail_raw_predicate(query, now):
+    """
+    Compile a handful of Gmail search operators used in tests and benchmarks.
+    """
+    checks = []
+    for term in query.split():
+        negate = term.startswith("-")
+        term = term.lstrip("-")
+        key, _, value = term.partition(":")
+        key = key.lower()
+        if key == "older_than" or key == "newer_than":
+            unit = {"d": 1, "m": 30, "y": 365}[value[-1]]
+            cutoff = now - timedelta(days=int(value[:-1]) * unit)
+            check = (lambda m, c=cutoff: m.date < c) if key == "older_than" else (lambda m, c=cutoff: m.date >= c)
+        elif key == "larger" or key == "smaller":
+            factor = {"k": 1024, "m": 1024 * 1024}.get(value[-1].lower(), 1)
+            limit = int(value.rstrip("kKmM")) * factor
+            check = (lambda m, l=limit: m.size > l) if key == "larger" else (lambda m, l=limit: m.size < l)
+        elif key == "from":
+            check = lambda m, v=value.lower(): v in m.sender
+        elif key == "category":
+            check = lambda m, v=value.lower(): m.category == v
+        elif key == "is" and value == "starred":
+            check = lambda m: m.flagged
+        elif key == "is" and value == "unread":
+            check = lambda m: not m.seen
+        else:
+            check = lambda m: True
+        checks.append((lambda m, c=check: not c(m)) if negate else check)
+    return lambda message: all(check(message) for check in checks)
+
+
+class Session(socketserver.StreamRequestHandler):
+    """
+    One IMAP connection. Commands are processed strictly in arrival order, so
+    pipelined clients get their tagged responses back in order.
+    """
+
+    disable_nagle_algorithm = True  # replies are written in pieces; Nagle + delayed ACK would add ~40 ms each
+
+    def setup(self):
+        if self.server.ssl_context:
+            self.request = self.server.ssl_context.wrap_socket(self.request, server_side=True)
+        super().setup()
+        self.gmail = self.server.gmail
+        self.selected = None
+        self.readonly = False
+        self.condstore = False
+        self.qresync = False
+        self.authenticated = False
+        self.received_at = time.monotonic()
+        self.outbox = None
+        self.pending = []
+        if self.gmail.rtt:
+            # Responses leave ``rtt`` seconds after their command arrived, but
+            # later commands keep being processed meanwhile, like a long link.
+            self.outbox = queue.Queue()
+            threading.Thread(target=self.deliver, daemon=True).start()
+
+    def deliver(self):
+        while True:
+            due, data = self.outbox.get()
+            if data is None:
+                return
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (ConnectionError, OSError, ValueError, ssl.SSLError):
+                return
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        if self.outbox is not None:
+            self.pending.append(data)
+        else:
+            self.wfile.write(data)
+
+    def flush(self):
+        if self.outbox is not None:
+            self.outbox.put((self.received_at + self.gmail.rtt, b"".join(self.pending)))
+            self.pending = []
+        else:
+            self.wfile.flush()
+
+    def finish(self):
+        if self.outbox is not None:
+            self.outbox.put((0, None))
+            while not self.outbox.empty():
+                time.sleep(0.01)
+        super().finish()
+
+    def untagged(self, text):
+        self.send(f"* {text}\r\n")
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        while True:
+            match = re.search(rb"\{(\d+)\+?\}\r\n$", line)
+            if not match:
+                break
+            length = int(match.group(1))
+            if not line.rstrip().endswith(b"+}"):
+                self.send("+ go ahead\r\n")
+                self.flush()
+            literal = self.rfile.read(length)
+            quoted = b'"' + literal.replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+            line = line[:match.start()] + quoted + self.rfile.readline()
+        return line.decode("utf-8", errors="replace").rstrip("\r\n")
+
+    def handle(self):
+        self.send("* OK [CAPABILITY IMAP4rev1 AUTH=PLAIN] Fake Gmail ready\r\n")
+        self.flush()
+        while True:
+            try:
+                line = self.read_command()
+            except (ConnectionError, OSError, ssl.SSLError):
+                return
+            if line is None:
+                return
+            if not line:
+                continue
+            self.received_at = time.monotonic()
+            tag, _, rest = line.partition(" ")
+            self.tag = tag
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            uid_mode = False
+            if command == "UID":
+                uid_mode = True
+                command, _, args = args.partition(" ")
+                command = command.upper()
+            if self.gmail.latency:
+                time.sleep(self.gmail.latency)
+            with self.gmail.lock:
+                self.gmail.commands += 1
+                throttled = self.throttled(command)
+            if throttled:
+                self.send(f"{tag} NO [THROTTLED] Too many simultaneous commands\r\n")
+                self.flush()
+                continue
+            handler = getattr(self, "cmd_" + command.replace("-", "_"), None)
+            try:
+                if handler is None:
+                    self.send(f"{tag} BAD Unknown command {command}\r\n")
+                else:
+                    with self.gmail.lock:
+                        result = handler(tokenize(args), uid_mode, args)
+                        drop = (uid_mode and self.gmail.drop_every
+                                and self.gmail.commands % self.gmail.drop_every == 0)
+                        if drop:
+                            self.gmail.drops += 1
+                    if drop:
+                        # The command took effect but the session dies before
+                        # its reply, like a NAT timeout or a TLS reset.
+                        self.pending = []
+                        return
+                    self.send(f"{tag} {result}\r\n")
+            except Exception as exc:
+                self.send(f"{tag} BAD {type(exc).__name__}: {exc}\r\n")
+            self.flush()
+            if command == "LOGOUT":
+                return
+
+    def throttled(self, command):
+        if command in ("LOGIN", "LOGOUT", "CAPABILITY", "NOOP"):
+            return False
+        gmail = self.gmail
+        if gmail.throttle_every and gmail.commands % gmail.throttle_every == 0:
+            return True
+        return gmail.throttle_rate and gmail.random.random() < gmail.throttle_rate
+
+    def cmd_CAPABILITY(self, tokens, uid_mode, raw):
+        caps = self.gmail.capabilities if self.authenticated else ["IMAP4rev1", "AUTH=PLAIN"]
+        self.untagged("CAPABILITY " + " ".join(caps))
+        return "OK Success"
+
+    def cmd_NOOP(self, tokens, uid_mode, raw):
+        return "OK Success"
+
+    def cmd_LOGIN(self, tokens, uid_mode, raw):
+        user, password = atom(tokens[0]), atom(tokens[1])
+        if user != self.gmail.username or password != self.gmail.password:
+            return "NO [AUTHENTICATIONFAILED] Invalid credentials (Failure)"
+        self.authenticated = True
+        return "OK [CAPABILITY " + " ".join(self.gmail.capabilities) + "] user authenticated (Success)"
+
+    def cmd_LOGOUT(self, tokens, uid_mode, raw):
+        self.untagged("BYE LOGOUT Requested")
+        return "OK 73 good day (Success)"
+
+    def cmd_ENABLE(self, tokens, uid_mode, raw):
+        enabled = []
+        for token in tokens:
+            name = atom(token).upper()
+            if name in ("CONDSTORE", "QRESYNC") and name in self.gmail.capabilities:
+                self.condstore = True
+                self.qresync = self.qresync or name == "QRESYNC"
+                enabled.append(name)
+        self.untagged("ENABLED " + " ".join(enabled))
+        return "OK Success"
+
+    def folder_flags(self, name):
+        special = SYSTEM_FOLDERS.get(name)
+        flags = ["\\HasNoChildren"]
+        if name == "[Gmail]":
+            flags = ["\\HasChildren", "\\Noselect"]
+        elif special:
+            flags.append(special)
+        return "(" + " ".join(flags) + ")"
+
+    def status_items(self, folder, items):
+        values = []
+        for item in items:
+            item = item.upper()
+            if item == "MESSAGES":
+                values.append(f"MESSAGES {len(folder.uids)}")
+            elif item == "UNSEEN":
+                values.append(f"UNSEEN {sum(1 for m in folder.entries.values() if not m.seen)}")
+            elif item == "RECENT":
+                values.append("RECENT 0")
+            elif item == "UIDNEXT":
+                values.append(f"UIDNEXT {folder.uidnext}")
+            elif item == "UIDVALIDITY":
+                values.append(f"UIDVALIDITY {folder.uidvalidity}")
+            elif item == "HIGHESTMODSEQ" and "CONDSTORE" in self.gmail.capabilities:
+                values.append(f"HIGHESTMODSEQ {folder.highestmodseq}")
+            elif item == "SIZE" and "STATUS=SIZE" in self.gmail.capabilities:
+                values.append(f"SIZE {sum(m.size for m in folder.entries.values())}")
+            else:
+                raise ValueError(f"unsupported STATUS item {item}")
+        return "(" + " ".join(values) + ")"
+
+    def cmd_LIST(self, tokens, uid_mode, raw):
+        return_status = None
+        if len(tokens) > 2 and atom(tokens[2]).upper() == "RETURN":
+            if "LIST-STATUS" not in self.gmail.capabilities:
+                return "BAD LIST-STATUS not supported"
+            options = tokens[3]
+            if len(options) >= 2 and atom(options[0]).upper() == "STATUS":
+                return_status = [atom(item) for item in options[1]]
+        for name in sorted(self.gmail.folders):
+            self.untagged(f'LIST {self.folder_flags(name)} "/" "{name}"')
+            if return_status is not None and name != "[Gmail]":
+                folder = self.gmail.folders[name]
+                self.untagged(f'STATUS "{name}" {self.status_items(folder, return_status)}')
+        return "OK Success"
+
+    cmd_XLIST = cmd_LIST
+
+    def folder_arg(self, token):
+        name = atom(token)
+        if name.upper() == "INBOX":
+            name = "INBOX"
+        return self.gmail.folders.get(name)
+
+    def cmd_STATUS(self, tokens, uid_mode, raw):
+        folder = self.folder_arg(tokens[0])
+        if folder is None or folder.name == "[Gmail]":
+            return "NO [NONEXISTENT] Unknown Mailbox"
+        items = [atom(item) for item in tokens[1]]
+        self.untagged(f'STATUS "{folder.name}" {self.status_items(folder, items)}')
+        return "OK Success"
+
+    def cmd_SELECT(self, tokens, uid_mode, raw, readonly=False):
+        folder = self.folder_arg(tokens[0])
+        if folder is None or folder.name == "[Gmail]":
+            self.selected = None
+            return "NO [NONEXISTENT] Unknown Mailbox"
+        self.selected = folder
+        self.readonly = readonly
+        params = tokens[1] if len(tokens) > 1 and isinstance(tokens[1], list) else []
+        qresync_args = None
+        for index, param in enumerate(params):
+            name = atom(param).upper() if not isinstance(param, list) else ""
+            if name == "CONDSTORE":
+                self.condstore = True
+            elif name == "QRESYNC":
+                if not self.qresync:
+                    return "BAD QRESYNC not enabled"
+                qresync_args = params[index + 1]
+        self.untagged("FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen $NotPhishing $Phishing)")
+        self.untagged(f"OK [UIDVALIDITY {folder.uidvalidity}] UIDs valid.")
+        self.untagged(f"{len(folder.uids)} EXISTS")
+        self.untagged("0 RECENT")
+        self.untagged(f"OK [UIDNEXT {folder.uidnext}] Predicted next UID.")
+        if "CONDSTORE" in self.gmail.capabilities:
+            self.untagged(f"OK [HIGHESTMODSEQ {folder.highestmodseq}]")
+        if qresync_args is not None:
+            uidvalidity, modseq = int(atom(qresync_args[0])), int(atom(qresync_args[1]))
+            if uidvalidity == folder.uidvalidity:
+                vanished = sorted(uid for uid, seq in folder.vanished if seq > modseq)
+                if vanished:
+                    self.untagged("VANISHED (EARLIER) " + join_set(vanished))
+                for uid in folder.uids:
+                    if folder.modseqs[uid] > modseq:
+                        self.send_fetch(folder, uid, ["UID", "FLAGS", "MODSEQ"])
+        mode = "READ-ONLY" if readonly else "READ-WRITE"
+        return f"OK [{mode}] {folder.name} selected. (Success)"
+
+    def cmd_EXAMINE(self, tokens, uid_mode, raw):
+        return self.cmd_SELECT(tokens, uid_mode, raw, readonly=True)
+
+    def cmd_CLOSE(self, tokens, uid_mode, raw):
+        if self.selected is None:
+            return "BAD No mailbox selected"
+        if not self.readonly:
+            self.expunge(self.selected, None, notify=False)
+        self.selected = None
+        return "OK Returned to authenticated state. (Success)"
+
+    def cmd_UNSELECT(self, tokens, uid_mode, raw):
+        self.selected = None
+        return "OK Returned to authenticated state. (Success)"
+
+    def require_selected(self):
+        if self.selected is None:
+            raise ValueError("No mailbox selected")
+        return self.selected
+
+    def resolve(self, folder, text, uid_mode):
+        if uid_mode:
+            return uids_in_set(folder, text)
+        largest = len(folder.uids)
+        found = []
+        for low, high in parse_set(text, largest):
+            found.extend(folder.uids[max(low, 1) - 1:min(high, largest)])
+        return sorted(set(found))
+
+    def cmd_SEARCH(self, tokens, uid_mode, raw):
+        folder = self.require_selected()
+        return_options = None
+        if tokens and atom(tokens[0]).upper() == "RETURN":
+            if "ESEARCH" not in self.gmail.capabilities:
+                return "BAD ESEARCH not supported"
+            return_options = [atom(option).upper() for option in tokens[1]] or ["ALL"]
+            tokens = tokens[2:]
+        if tokens and atom(tokens[0]).upper() == "CHARSET":
+            tokens = tokens[2:]
+        predicate = self.compile_search(folder, tokens)
+        matches = [uid for uid in folder.uids if predicate(uid, folder.entries[uid])]
+        if not uid_mode:
+            positions = {uid: index + 1 for index, uid in enumerate(folder.uids)}
+            matches = [positions[uid] for uid in matches]
+        if return_options is not None:
+            parts = [f'(TAG "{self.tag}")'] + (["UID"] if uid_mode else [])
+            if matches and "MIN" in return_options:
+                parts.append(f"MIN {matches[0]}")
+            if matches and "MAX" in return_options:
+                parts.append(f"MAX {matches[-1]}")
+            if "COUNT" in return_options:
+                parts.append(f"COUNT {len(matches)}")
+            if matches and "ALL" in return_options:
+                parts.append(f"ALL {join_set(matches)}")
+            self.untagged("ESEARCH " + " ".join(parts))
+            return "OK SEARCH completed (Success)"
+        self.untagged("SEARCH" + "".join(f" {number}" for number in matches))
+        return "OK SEARCH completed (Success)"
+
+    def compile_search(self, folder, tokens):
+        now = datetime.now(timezone.utc)
+        checks = []
+        index = 0
+        while index < len(tokens):
+            token = tokens[index]
+            index += 1
+            if isinstance(token, list):
+                inner = self.compile_search(folder, token)
+                checks.append(inner)
+                continue
+            key = atom(token).upper()
+            if key == "ALL":
+                continue
+            if key == "NOT":
+                inner = self.compile_search(folder, [tokens[index]])
+                index += 1
+                checks.append(lambda uid, m, f=inner: not f(uid, m))
+            elif key == "OR":
+                left = self.compile_search(folder, [tokens[index]])
+                right = self.compile_search(folder, [tokens[index + 1]])
+                index += 2
+                checks.append(lambda uid, m, a=left, b=right: a(uid, m) or b(uid, m))
+            elif key == "UID":
+                allowed = set(uids_in_set(folder, atom(tokens[index])))
+                index += 1
+                checks.append(lambda uid, m, a=allowed: uid in a)
+            elif re.match(r"^[\d*][\d:,*]*$", key):
+                allowed = set(self.resolve(folder, key, False))
+                checks.append(lambda uid, m, a=allowed: uid in a)
+            elif key == "X-GM-MSGID":
+                wanted = int(atom(tokens[index]))
+                index += 1
+                checks.append(lambda uid, m, w=wanted: m.msgid == w)
+            elif key == "X-GM-THRID":
+                wanted = int(atom(tokens[index]))
+                index += 1
+                checks.append(lambda uid, m, w=wanted: m.thrid == w)
+            elif key == "X-GM-RAW":
+                raw_predicate = gmail_raw_predicate(atom(tokens[index]), now)
+                index += 1
+                checks.append(lambda uid, m, p=raw_predicate: p(m))
+            elif key in ("BEFORE", "SINCE", "ON", "SENTBEFORE", "SENTSINCE", "SENTON"):
+                when = imap_date(atom(tokens[index]))
+                index += 1
+                if key.endswith("BEFORE"):
+                    checks.append(lambda uid, m, w=when: m.date < w)
+                elif key.endswith("SINCE"):
+                    checks.append(lambda uid, m, w=when: m.date >= w)
+                else:
+                    checks.append(lambda uid, m, w=when: m.date.date() == w.date())
+            elif key in ("FROM", "TO", "SUBJECT", "TEXT", "BODY"):
+                needle = atom(tokens[index]).lower()
+                index += 1
+                if key == "FROM":
+                    checks.append(lambda uid, m, n=needle: n in m.sender)
+                else:
+                    checks.append(lambda uid, m, n=needle: n in f"message {m.msgid}")
+            elif key in ("LARGER", "SMALLER"):
+                limit = int(atom(tokens[index]))
+                index += 1
+                if key == "LARGER":
+                    checks.append(lambda uid, m, l=limit: m.size > l)
+                else:
+                    checks.append(lambda uid, m, l=limit: m.size < l)
+            elif key in ("SEEN", "UNSEEN"):
+                checks.append(lambda uid, m, want=key == "SEEN": m.seen == want)
+            elif key in ("FLAGGED", "UNFLAGGED"):
+                checks.append(lambda uid, m, want=key == "FLAGGED": m.flagged == want)
+            elif key in ("DELETED", "UNDELETED"):
+                checks.append(lambda uid, m, want=key == "DELETED", f=folder: (uid in f.deleted) == want)
+            elif key == "MODSEQ":
+                modseq = int(atom(tokens[index]))
+                index += 1
+                checks.append(lambda uid, m, s=modseq, f=folder: f.modseqs.get(uid, 0) >= s)
+            else:
+                raise ValueError(f"unsupported search key {key}")
+        return lambda uid, message: all(check(uid, message) for check in checks)
+
+    def fetch_items(self, tokens):
+        items = []
+        for token in tokens:
+            if isinstance(token, list):
+                items.extend(self.fetch_items(token))
+            else:
+                items.append(atom(token))
+        expanded = []
+        for item in items:
+            upper = item.upper()
+            if upper == "ALL":
+                expanded.extend(["FLAGS", "INTERNALDATE", "RFC822.SIZE"])
+            elif upper == "FAST":
+                expanded.extend(["FLAGS", "INTERNALDATE", "RFC822.SIZE"])
+            else:
+                expanded.append(item)
+        return expanded
+
+    def cmd_FETCH(self, tokens, uid_mode, raw):
+        folder = self.require_selected()
+        uid_set = atom(tokens[0])
+        items = self.fetch_items(tokens[1] if isinstance(tokens[1], list) else [tokens[1]])
+        changedsince = None
+        vanished = False
+        mod_tokens = tokens[2] if len(tokens) > 2 else []
+        for index, token in enumerate(mod_tokens):
+            name = atom(token).upper()
+            if name == "CHANGEDSINCE":
+                changedsince = int(atom(mod_tokens[index + 1]))
+            elif name == "VANISHED":
+                if not self.qresync:
+                    return "BAD QRESYNC not enabled"
+                vanished = True
+        uids = self.resolve(folder, uid_set, uid_mode)
+        if vanished and changedsince is not None:
+            requested = set()
+            largest = folder.uidnext
+            for low, high in parse_set(uid_set, largest):
+                requested.update(range(low, min(high, largest) + 1)) if high - low < 10_000_000 else None
+            gone = sorted(uid for uid, seq in folder.vanished if seq > changedsince and uid in requested)
+            if gone:
+                self.untagged("VANISHED (EARLIER) " + join_set(gone))
+        if uid_mode and "UID" not in [item.upper() for item in items]:
+            items = ["UID"] + items
+        if changedsince is not None and "MODSEQ" not in [item.upper() for item in items]:
+            items = items + ["MODSEQ"]
+        for uid in uids:
+            if changedsince is not None and folder.modseqs[uid] <= changedsince:
+                continue
+            self.send_fetch(folder, uid, items)
+        return "OK Success"
+
+    def send_fetch(self, folder, uid, items):
+        message = folder.entries[uid]
+        position = bisect.bisect_left(folder.uids, uid) + 1
+        parts = []
+        literals = []
+        for item in items:
+            upper = item.upper()
+            if upper == "UID":
+                parts.append(f"UID {uid}")
+            elif upper == "FLAGS":
+                flags = []
+                if message.seen:
+                    flags.append("\\Seen")
+                if message.flagged:
+                    flags.append("\\Flagged")
+                if uid in folder.deleted:
+                    flags.append("\\Deleted")
+                parts.append("FLAGS (" + " ".join(flags) + ")")
+            elif upper == "X-GM-MSGID":
+                parts.append(f"X-GM-MSGID {message.msgid}")
+            elif upper == "X-GM-THRID":
+                parts.append(f"X-GM-THRID {message.thrid}")
+            elif upper == "X-GM-LABELS":
+                labels = " ".join(label if label.startswith("\\") else f'"{label}"'
+                                  for label in self.gmail.folder_labels(message)
+                                  if label != FOLDER_LABELS.get(folder.name, folder.name))
+                parts.append(f"X-GM-LABELS ({labels})")
+            elif upper == "RFC822.SIZE":
+                parts.append(f"RFC822.SIZE {message.size}")
+            elif upper == "INTERNALDATE":
+                date = message.date
+                parts.append(f'INTERNALDATE "{date.day:02d}-{MONTHS[date.month - 1]}-{date.year} '
+                             f'{date.strftime("%H:%M:%S")} +0000"')
+            elif upper == "MODSEQ":
+                parts.append(f"MODSEQ ({folder.modseqs[uid]})")
+            elif upper.startswith("BODY.PEEK[HEADER.FIELDS") or upper.startswith("BODY[HEADER.FIELDS"):
+                literals.append((re.sub(r"^BODY\.PEEK", "BODY", item), message.header_block()))
+            elif upper in ("BODY.PEEK[]", "BODY[]", "RFC822"):
+                name = "RFC822" if upper == "RFC822" else "BODY[]"
+                literals.append((name, message.raw()))
+            elif upper in ("BODY.PEEK[HEADER]", "BODY[HEADER]", "RFC822.HEADER"):
+                literals.append(("BODY[HEADER]", message.raw().split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"))
+            else:
+                raise ValueError(f"unsupported fetch item {item}")
+        head = f"* {position} FETCH (" + " ".join(parts)
+        if not literals:
+            self.send(head + ")\r\n")
+            return
+        self.send(head)
+        for index, (name, payload) in enumerate(literals):
+            separator = " " if parts or index else ""
+            self.send(f"{separator}{name} {{{len(payload)}}}\r\n".encode() + payload)
+        self.send(")\r\n")
+
+    def cmd_STORE(self, tokens, uid_mode, raw):
+        folder = self.require_selected()
+        if self.readonly:
+            return "NO Mailbox is read-only"
+        match = re.match(r"(\S+) (?:\(UNCHANGEDSINCE \d+\) )?([+-]?)(\S+?)(\.SILENT)? (.*)$", raw)
+        uid_set, sign, item, silent, values_text = match.groups()
+        values = [atom(value) for value in flatten(tokenize(values_text))]
+        item = item.upper()
+        for uid in self.resolve(folder, uid_set, uid_mode):
+            message = folder.entries.get(uid)
+            if message is None:
+                continue
+            if item == "FLAGS":
+                self.store_flags(folder, uid, message, sign, values)
+            elif item == "X-GM-LABELS":
+                self.store_labels(folder, message, sign, values)
+            else:
+                raise ValueError(f"unsupported store item {item}")
+            if not silent and uid in folder.entries:
+                self.send_fetch(folder, uid, ["UID", "FLAGS"] if uid_mode else ["FLAGS"])
+        return "OK Success"
+
+    def store_flags(self, folder, uid, message, sign, values):
+        enabled = sign != "-"
+        for value in values:
+            flag = value.upper()
+            if flag == "\\DELETED":
+                if enabled:
+                    folder.deleted.add(uid)
+                else:
+                    folder.deleted.discard(uid)
+            elif flag == "\\SEEN":
+                message.seen = enabled
+            elif flag == "\\FLAGGED":
+                message.flagged = enabled
+        folder.touch(uid, self.gmail.bump())
+
+    def store_labels(self, folder, message, sign, values):
+        for value in values:
+            if value.startswith("\\"):
+                target = LABEL_FOLDERS.get("\\" + value[1:].capitalize(), value)
+            else:
+                target = value
+            if sign == "-":
+                self.gmail.remove_label(message, target)
+            else:
+                self.gmail.add_label(message, target)
+
+    def copy_or_move(self, tokens, uid_mode, move):
+        folder = self.require_selected()
+        destination = self.folder_arg(tokens[1])
+        if destination is None:
+            return "NO [TRYCREATE] No folder (Failure)"
+        uids = self.resolve(folder, atom(tokens[0]), uid_mode)
+        source_uids = []
+        target_uids = []
+        for uid in uids:
+            message = folder.entries.get(uid)
+            if message is None:
+                continue
+            source_uids.append(uid)
+            self.gmail.add_label(message, destination.name)
+            if move and destination.name != TRASH:
+                self.gmail.remove_label(message, folder.name)
+            target_uids.append(self.gmail.locations.get(message.msgid, {}).get(destination.name, 0))
+        if not source_uids:
+            return "OK No messages"
+        code = f"[COPYUID {destination.uidvalidity} {join_set(source_uids)} {join_set(target_uids)}]"
+        if move:
+            self.untagged(f"OK {code}")
+            return "OK Success"
+        return f"OK {code} Success"
+
+    def cmd_COPY(self, tokens, uid_mode, raw):
+        return self.copy_or_move(tokens, uid_mode, move=False)
+
+    def cmd_MOVE(self, tokens, uid_mode, raw):
+        if "MOVE" not in self.gmail.capabilities:
+            return "BAD Unknown command MOVE"
+        return self.copy_or_move(tokens, uid_mode, move=True)
+
+    def expunge(self, folder, only, notify=True):
+        doomed = sorted(folder.deleted if only is None else folder.deleted & only)
+        uids = folder.uids
+        positions = [bisect.bisect_left(uids, uid) + 1 for uid in doomed if uid in folder.entries]
+        for uid in doomed:
+            message = folder.entries.get(uid)
+            if message is not None:
+                self.gmail.remove_label(message, folder.name)
+        if notify:
+            for position in reversed(positions):
+                self.untagged(f"{position} EXPUNGE")
+
+    def cmd_EXPUNGE(self, tokens, uid_mode, raw):
+        folder = self.require_selected()
+        if self.readonly:
+            return "NO Mailbox is read-only"
+        only = None
+        if uid_mode:
+            if "UIDPLUS" not in self.gmail.capabilities:
+                return "BAD UID EXPUNGE requires UIDPLUS"
+            only = set(uids_in_set(folder, atom(tokens[0])))
+        self.expunge(folder, only)
+        return "OK Success"
+
+
+def flatten(tokens):
+    for token in tokens:
+        if isinstance(token, list):
+            yield from flatten(token)
+        else:
+            yield token
+
+
+def join_set(uids):
+    parts = []
+    start = prev = None
+    for uid in sorted(uids):
+        if prev is not None and uid == prev + 1:
+            prev = uid
+            continue
+        if start is not None:
+            parts.append(str(start) if start == prev else f"{start}:{prev}")
+        start = prev = uid
+    if start is not None:
+        parts.append(str(start) if start == prev else f"{start}:{prev}")
+    return ",".join(parts)
+
+
+class FakeGmailServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Threaded TCP server; every connection shares one ``FakeGmail`` state.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, gmail, host="127.0.0.1", port=0, certfile=None, keyfile=None):
+        self.gmail = gmail
+        self.ssl_context = None
+        if certfile:
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+        super().__init__((host, port), Session)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def self_signed_certificate(directory):
+    """
+    Write a throwaway certificate for localhost / 127.0.0.1 with the
+    ``openssl`` command line tool and return ``(certfile, keyfile)``. Clients
+    trust it with ``ssl.create_default_context(cafile=certfile)``.
+    """
+    os.makedirs(directory, exist_ok=True)
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    if not (os.path.exists(certfile) and os.path.exists(keyfile)):
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "30", "-subj", "/CN=localhost",
+             "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1", "-keyout", keyfile, "-out", certfile],
+            check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run an offline Gmail IMAP stand-in.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1143)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--labels", nargs="*", default=["INBOX", "Newsletters"])
+    parser.add_argument("--username", default="user@gmail.com")
+    parser.add_argument("--password", default="app-password")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every command")
+    parser.add_argument("--rtt", type=float, default=0.0, help="Simulated network round trip in seconds")
+    parser.add_argument("--throttle-every", type=int, default=0, help="Reply [THROTTLED] to every Nth command")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Probability of a [THROTTLED] reply")
+    parser.add_argument("--drop-every", type=int, default=0, help="Drop the connection after every Nth command")
+    parser.add_argument("--no-move", action="store_true", help="Do not advertise the MOVE extension")
+    parser.add_argument("--certfile")
+    parser.add_argument("--keyfile")
+    parser.add_argument("--self-signed", metavar="DIR",
+                        help="Serve TLS with a localhost certificate created in DIR (needs openssl)")
+    args = parser.parse_args(argv)
+    if args.self_signed and not args.certfile:
+        args.certfile, args.keyfile = self_signed_certificate(args.self_signed)
+
+    gmail = FakeGmail(args.username, args.password, latency=args.latency, rtt=args.rtt,
+                      throttle_every=args.throttle_every, throttle_rate=args.throttle_rate,
+                      drop_every=args.drop_every)
+    if args.no_move:
+        gmail.capabilities.remove("MOVE")
+    gmail.populate(args.messages, labels=args.labels)
+    server = FakeGmailServer(gmail, args.host, args.port, args.certfile, args.keyfile)
+    print(f"Fake Gmail IMAP listening on {args.host}:{server.port} "
+          f'({gmail.total_messages():,} messages, TLS {"on" if args.certfile else "off"})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
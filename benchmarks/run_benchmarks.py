@@ -0,0 +1,198 @@
+"""
+Reproducible benchmarks for the scan and delete paths of the cleanup engine,
+run against the offline IMAP stand-in in ``fake_gmail_server.py`` instead of
+a real account.
+
+For every mailbox size a fresh fake server is populated with the same seeded
+synthetic mail, and every operation runs in its own process so its peak RSS
+is not mixed up with the server's or another run's. Reported per run:
+
+    msgs/s     messages scanned or deleted per second of wall time
+    rt/msg     IMAP commands the server received per message (each pipelined
+               command counts as one)
+    p95        95th percentile latency of the client's IMAP commands
+    peak RSS   high-water mark of the client process
+
+    python -m benchmarks.run_benchmarks --sizes 1000 100000
+    python -m benchmarks.run_benchmarks --sizes 1000000 --operations trash --pipeline 8 --rtt 0.05
+    python -m benchmarks.run_benchmarks --json results.json
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import argparse
+import tempfile
+import platform
+import multiprocessing
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_gmail_server import FakeGmail, FakeGmailServer, self_signed_certificate  # noqa: E402
+from gmail_engine import CHUNK_SIZE, POOL_SIZE, GmailCleanupEngine, build_search_criteria, format_bytes  # noqa: E402
+from gmail_metrics import format_seconds  # noqa: E402
+
+SIZES = (1_000, 100_000, 1_000_000)
+OPERATIONS = ("scan", "search", "trash", "permanent")
+SEARCH_FILTER = "-is:starred"  # matches 98% of the synthetic mail and forces a SEARCH instead of STATUS
+FOLDER = "INBOX"
+USERNAME = "user@gmail.com"
+PASSWORD = "app-password"
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes, or None where it cannot
+    be read. Linux keeps ``ru_maxrss`` across exec, so a worker spawned from
+    a runner holding a large fake mailbox would inherit its peak; VmHWM
+    belongs to the current address space only.
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_operation(settings, results):
+    """
+    Worker process: connect to the fake server, run one operation and put
+    ``(messages, seconds, details, peak_rss)`` on ``results``.
+    """
+    os.environ["XDG_CACHE_HOME"] = settings["cache_dir"]  # keep deletion journals out of the real cache
+    engine = GmailCleanupEngine(USERNAME, PASSWORD, host=settings["host"], port=settings["port"],
+                                pool_size=settings["pool_size"], chunk_size=settings["chunk_size"],
+                                pipeline_depth=settings["pipeline"])
+    engine.ssl_context = ssl.create_default_context(cafile=settings["certfile"])
+    engine.connect()
+    operation = settings["operation"]
+    criteria = settings["criteria"]
+    try:
+        started = time.perf_counter()
+        if operation in ("scan", "search"):
+            result = engine.scan([FOLDER], criteria, use_index=settings["index"])
+            messages, details = result["total"], {"stopped": result["stopped"]}
+        else:
+            result = engine.delete([FOLDER], operation == "permanent", criteria, use_index=settings["index"])
+            messages = result["deleted"]
+            details = {"failed": result["failed"], "throttled": result["throttled"]}
+        seconds = time.perf_counter() - started
+        metrics = engine.metrics.to_dict()
+        details.update({key: metrics[key] for key in ("p50", "p95", "p99", "bytes_sent", "bytes_received")})
+    finally:
+        engine.close()
+    results.put((messages, seconds, details, peak_rss()))
+
+
+def start_server(args, size, certfile, keyfile):
+    gmail = FakeGmail(USERNAME, PASSWORD, latency=args.latency, rtt=args.rtt,
+                      throttle_every=args.throttle_every, throttle_rate=args.throttle_rate, seed=args.seed)
+    gmail.populate(size, labels=[FOLDER])
+    return FakeGmailServer(gmail, "127.0.0.1", 0, certfile, keyfile).start()
+
+
+def benchmark(args, size, operation, certfile, keyfile, cache_dir):
+    """
+    Run one operation against a freshly populated server and return its
+    result row.
+    """
+    gmail_filter = args.gmail_filter
+    if operation == "search" and not gmail_filter:
+        gmail_filter = SEARCH_FILTER
+    criteria = build_search_criteria(gmail_filter, "")
+    server = start_server(args, size, certfile, keyfile)
+    try:
+        settings = {
+            "host": "127.0.0.1", "port": server.port, "certfile": certfile, "cache_dir": cache_dir,
+            "operation": operation, "criteria": criteria,
+            "pool_size": args.pool_size, "chunk_size": args.chunk_size, "pipeline": args.pipeline,
+            "index": args.index,
+        }
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        commands = server.gmail.commands
+        worker = context.Process(target=run_operation, args=(settings, results))
+        worker.start()
+        messages, seconds, details, rss = results.get(timeout=args.timeout)
+        worker.join()
+        commands = server.gmail.commands - commands
+    finally:
+        server.stop()
+    return {
+        "size": size,
+        "operation": operation,
+        "messages": messages,
+        "seconds": round(seconds, 3),
+        "messages_per_second": round(messages / seconds, 1) if seconds else None,
+        "commands": commands,
+        "round_trips_per_message": round(commands / messages, 4) if messages else None,
+        "peak_rss": rss,
+        **details,
+    }
+
+
+def print_row(row):
+    rate = f"{row['messages_per_second']:,.0f}" if row["messages_per_second"] is not None else "-"
+    per_message = f"{row['round_trips_per_message']:.4f}" if row["round_trips_per_message"] is not None else "-"
+    rss = format_bytes(row["peak_rss"]) if row["peak_rss"] is not None else "-"
+    print(f"{row['size']:>10,} {row['operation']:<10} {row['messages']:>10,} {row['seconds']:>9.2f}s "
+          f"{rate:>10} {per_message:>8} {format_seconds(row['p95']):>9} {rss:>10}", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark scan and delete against the offline Gmail stand-in.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="messages per mailbox")
+    parser.add_argument("--operations", nargs="+", choices=OPERATIONS, default=list(OPERATIONS),
+                        help=f"scan (STATUS), search (SEARCH count, default filter {SEARCH_FILTER}), trash or "
+                             "permanent delete")
+    parser.add_argument("--gmail-filter", default="", help="X-GM-RAW query for scan and delete")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--pipeline", type=int, default=0, metavar="DEPTH", help="asyncio pipeline depth (0: off)")
+    parser.add_argument("--index", action="store_true", help="use the local metadata index")
+    parser.add_argument("--latency", type=float, default=0.0, help="server processing time per command (s)")
+    parser.add_argument("--rtt", type=float, default=0.0, help="simulated network round trip (s)")
+    parser.add_argument("--throttle-every", type=int, default=0, help="reply [THROTTLED] to every Nth command")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="probability of a [THROTTLED] reply")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic mailbox")
+    parser.add_argument("--timeout", type=float, default=3600, help="seconds allowed per run")
+    parser.add_argument("--certfile", help="TLS certificate (default: a throwaway self-signed one)")
+    parser.add_argument("--keyfile")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="gmail-cleanup-bench-") as work_dir:
+        certfile, keyfile = args.certfile, args.keyfile
+        if not certfile:
+            certfile, keyfile = self_signed_certificate(os.path.join(work_dir, "tls"))
+        print(f"Python {platform.python_version()} on {platform.platform()}, pool {args.pool_size}, "
+              f"chunk {args.chunk_size}, pipeline {args.pipeline}, rtt {args.rtt}s, latency {args.latency}s")
+        print(f"{'mailbox':>10} {'operation':<10} {'messages':>10} {'time':>10} {'msgs/s':>10} {'rt/msg':>8} "
+              f"{'p95':>9} {'peak RSS':>10}")
+        rows = []
+        for size in args.sizes:
+            for operation in args.operations:
+                cache_dir = tempfile.mkdtemp(dir=work_dir)
+                row = benchmark(args, size, operation, certfile, keyfile, cache_dir)
+                rows.append(row)
+                print_row(row)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "settings": vars(args), "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
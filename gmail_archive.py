@@ -0,0 +1,191 @@
+"""
+Archive writers for the archive-then-delete stage of the Gmail cleanup
+engine. Messages are appended to one mbox file or one Maildir per folder,
+optionally compressed with gzip or, when the zstandard package is installed,
+zstd. Writes go through large buffers and ``sync()`` makes everything
+written so far durable; the engine only deletes a chunk after that returns.
+"""
+import os
+import re
+import gzip
+import time
+import socket
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMATS = ("mbox", "maildir")
+COMPRESSIONS = ("gzip", "zstd")
+WRITE_BUFFER = 1024 * 1024
+FROM_LINE_RE = re.compile(rb'^(>*From )', re.MULTILINE)
+MAILDIR_FLAGS = {"\\Draft": "D", "\\Flagged": "F", "\\Answered": "R", "\\Seen": "S"}
+EXTENSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+INFO_SEPARATOR = ":" if os.name == "posix" else "!"  # ':' is not allowed in Windows file names
+
+
+def folder_file_name(folder):
+    return re.sub(r'[^\w.@-]+', '_', folder).strip('_') or "folder"
+
+
+class MailArchive:
+    """
+    Base class of the archive writers. ``add()`` writes one raw RFC 822
+    message of a folder; ``sync()`` flushes and fsyncs everything added so
+    far. Both may be called from several worker threads.
+    """
+
+    def __init__(self, path, compression=None):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"unknown compression {compression!r} (choose {', '.join(COMPRESSIONS)})")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package: pip install zstandard")
+        self.path = path
+        self.compression = compression
+        self.messages = 0
+        self.size = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, folder, uidvalidity, uid, message, flags=(), date=None):
+        with self._lock:
+            self._add(folder, uidvalidity, uid, message, flags, date)
+            self.messages += 1
+            self.size += len(message)
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        self.sync()
+
+    def _compress(self, data):
+        if self.compression == "gzip":
+            return gzip.compress(data, compresslevel=6)
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor(level=3).compress(data)
+        return data
+
+
+class MboxArchive(MailArchive):
+    """
+    One mboxrd file per folder (``INBOX.mbox``, ``INBOX.mbox.gz``...). Lines
+    starting with ``From `` are quoted with ``>`` and CRLF becomes LF. Each
+    ``sync()`` ends a compressed member (gzip) or frame (zstd), so a crash
+    can only lose the part written after the last sync, and files that are
+    appended to by several runs stay readable by zcat / zstdcat.
+    """
+
+    def __init__(self, path, compression=None):
+        super().__init__(path, compression)
+        self.extension = ".mbox" + EXTENSIONS[compression]
+        self._files = {}
+        self._streams = {}
+
+    def _stream(self, folder):
+        stream = self._streams.get(folder)
+        if stream is None:
+            raw = self._files.get(folder)
+            if raw is None:
+                raw = open(os.path.join(self.path, folder_file_name(folder) + self.extension), "ab",
+                           buffering=WRITE_BUFFER)
+                self._files[folder] = raw
+            if self.compression == "gzip":
+                stream = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6)
+            elif self.compression == "zstd":
+                stream = zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+            else:
+                stream = raw
+            self._streams[folder] = stream
+        return stream
+
+    def _add(self, folder, uidvalidity, uid, message, flags, date):
+        stamp = time.asctime(time.gmtime(date if date is not None else time.time()))
+        body = FROM_LINE_RE.sub(rb'>\1', message.replace(b'\r\n', b'\n'))
+        if not body.endswith(b'\n'):
+            body += b'\n'
+        status = b''
+        if "\\Seen" in flags:
+            status = b'Status: RO\n'
+        stream = self._stream(folder)
+        stream.write(f"From MAILER-DAEMON {stamp}\n".encode() + status + body + b'\n')
+
+    def _sync(self):
+        for folder, stream in list(self._streams.items()):
+            if stream is not self._files[folder]:
+                stream.close()  # ends the gzip member / zstd frame, keeps the file open
+                del self._streams[folder]
+        for raw in self._files.values():
+            raw.flush()
+            os.fsync(raw.fileno())
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            for raw in self._files.values():
+                raw.close()
+            self._files.clear()
+            self._streams.clear()
+
+
+class MaildirArchive(MailArchive):
+    """
+    One Maildir per folder. File names are derived from UIDVALIDITY and UID,
+    so a resumed job overwrites what it already archived instead of adding
+    duplicates. Compressed messages (as read by Dovecot's zlib plugin) get a
+    ``.gz`` / ``.zst`` suffix before the info part.
+    """
+
+    def __init__(self, path, compression=None):
+        super().__init__(path, compression)
+        self._host = re.sub(r'[/:]', '_', socket.gethostname()) or "localhost"
+        self._created = set()
+        self._dirty = set()
+
+    def _folder_dir(self, folder):
+        directory = os.path.join(self.path, folder_file_name(folder))
+        if directory not in self._created:
+            for sub in ("tmp", "new", "cur"):
+                os.makedirs(os.path.join(directory, sub), exist_ok=True)
+            self._created.add(directory)
+        return directory
+
+    def _add(self, folder, uidvalidity, uid, message, flags, date):
+        directory = self._folder_dir(folder)
+        info = "".join(sorted(MAILDIR_FLAGS[flag] for flag in flags if flag in MAILDIR_FLAGS))
+        name = f"{int(date or time.time())}.V{uidvalidity}U{uid}.{self._host}{EXTENSIONS[self.compression]}"
+        temp_path = os.path.join(directory, "tmp", name)
+        with open(temp_path, "wb") as message_file:
+            message_file.write(self._compress(message))
+            message_file.flush()
+            os.fsync(message_file.fileno())
+        os.replace(temp_path, os.path.join(directory, "cur", f"{name}{INFO_SEPARATOR}2,{info}"))
+        self._dirty.add(os.path.join(directory, "cur"))
+
+    def _sync(self):
+        if os.name != "posix":
+            self._dirty.clear()  # directories cannot be opened for fsync on Windows
+            return
+        for directory in self._dirty:
+            descriptor = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+        self._dirty.clear()
+
+
+def open_archive(path, archive_format="mbox", compression=None):
+    """
+    Create the archive writer for ``archive_format`` (``mbox`` or
+    ``maildir``) in the directory ``path``. Raises ValueError for an
+    unknown format or an unavailable compression.
+    """
+    if archive_format == "mbox":
+        return MboxArchive(path, compression)
+    if archive_format == "maildir":
+        return MaildirArchive(path, compression)
+    raise ValueError(f"unknown archive format {archive_format!r} (choose {', '.join(FORMATS)})")
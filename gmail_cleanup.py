@@ -1,15 +1,256 @@
 import sys
+import os
+import time
 import threading
-import re
+import imaplib
+import logging
+import logging.handlers
+from collections import deque
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QLabel, QLineEdit, QPushButton, QCheckBox, QScrollArea, QTextEdit,
-    QFrame, QRadioButton, QButtonGroup, QDialog, QDialogButtonBox,
-    QGridLayout, QSizePolicy, QStyle, QStackedWidget, QGraphicsOpacityEffect
+    QLabel, QLineEdit, QPushButton, QCheckBox, QScrollArea, QTextEdit, QPlainTextEdit,
+    QFrame, QRadioButton, QButtonGroup, QDialog, QDialogButtonBox, QFileDialog, QProgressBar,
+    QGridLayout, QSizePolicy, QStyle, QStackedWidget, QGraphicsOpacityEffect, QTreeView, QHeaderView
+)
+from PyQt5.QtCore import (
+    Qt, QUrl, pyqtSignal, QSize, QPropertyAnimation, QTimer, QAbstractItemModel, QModelIndex, QSortFilterProxyModel
 )
-from PyQt5.QtCore import Qt, QUrl, pyqtSignal, QSize, QPropertyAnimation
 from PyQt5.QtGui import QFont, QPalette, QColor, QDesktopServices
-import imaplib
+from gmail_archive import open_archive
+from gmail_engine import (
+    CHUNK_SIZE, PIPELINE_DEPTH, POOL_SIZE, SPLIT_SIZE, DeletionPlan, GmailCleanupEngine, build_search_criteria,
+    default_cache_dir, format_bytes, format_duration
+)
+
+LOG_FLUSH_INTERVAL = 50  # ms between terminal updates
+LOG_MAX_LINES = 5000  # lines kept in the terminal; older ones are dropped
+LOG_FILE_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+PROGRESS_REFRESH_INTERVAL = 250  # ms between progress bar updates
+STALL_WARNING = 30  # seconds without progress before the label says so
+FOLDER_DELIMITER = "/"  # Gmail's hierarchy delimiter for nested labels
+FOLDER_COLUMNS = ("Folder", "Emails", "Size")
+FOLDER_ROLE = Qt.UserRole  # full folder path, also used by the filter box
+SORT_ROLE = Qt.UserRole + 1  # numbers for the count and size columns, so they sort numerically
+
+
+class FolderNode:
+    __slots__ = ("name", "path", "is_folder", "parent", "children", "row", "folders", "checked",
+                 "selected", "count", "size", "total_count", "total_size", "counted")
+
+    def __init__(self, name, path="", parent=None):
+        self.name = name
+        self.path = path
+        self.is_folder = False  # False for a group that only exists because of nested labels
+        self.parent = parent
+        self.children = []
+        self.row = 0
+        self.folders = 0  # selectable folders in this subtree, including this node
+        self.checked = 0  # checked folders in this subtree
+        self.selected = False
+        self.count = None
+        self.size = None
+        self.total_count = 0
+        self.total_size = 0
+        self.counted = 0  # folders in this subtree with known stats
+
+    def check_state(self):
+        if not self.checked:
+            return Qt.Unchecked
+        return Qt.Checked if self.checked == self.folders else Qt.PartiallyChecked
+
+
+class FolderTreeModel(QAbstractItemModel):
+    """
+    Checkable folder tree for the dashboard, grouped on FOLDER_DELIMITER.
+    Folders are plain nodes rather than widgets, so the view only creates
+    and paints the rows that are on screen. Every node keeps how many
+    folders below it are checked and their summed counts, so a click or a
+    scan result only walks up to the root, and the view is told about a
+    batch of changes with one signal per parent.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.root = FolderNode("")
+        self.nodes = {}
+
+    def set_folders(self, folders):
+        self.beginResetModel()
+        self.root = FolderNode("")
+        self.nodes = {}
+        groups = {}
+        for folder in folders:
+            node = self.root
+            path = ""
+            for name in folder.split(FOLDER_DELIMITER):
+                path = f"{path}{FOLDER_DELIMITER}{name}" if path else name
+                child = groups.get(path)
+                if child is None:
+                    child = groups[path] = FolderNode(name, path, node)
+                    node.children.append(child)
+                node = child
+            node.is_folder = True
+            self.nodes[folder] = node
+        self._finish(self.root)
+        self.endResetModel()
+
+    def _finish(self, node):
+        node.children.sort(key=lambda child: child.name.lower())
+        node.folders = 1 if node.is_folder else 0
+        for row, child in enumerate(node.children):
+            child.row = row
+            self._finish(child)
+            node.folders += child.folders
+
+    def folders(self):
+        return list(self.nodes)
+
+    def selected_folders(self):
+        return [folder for folder, node in self.nodes.items() if node.selected]
+
+    def matching_folders(self, text):
+        """
+        Folders the filter box shows for ``text`` (case-insensitive substring
+        of the full path, like the proxy's fixed-string filter).
+        """
+        text = text.lower()
+        return [folder for folder in self.nodes if text in folder.lower()]
+
+    def set_checked(self, folders, checked):
+        changed = set()
+        for folder in folders:
+            node = self.nodes.get(folder)
+            if node is None or node.selected == checked:
+                continue
+            node.selected = checked
+            while node is not None:
+                node.checked += 1 if checked else -1
+                changed.add(node)
+                node = node.parent
+        self._changed(changed, 0, 0, [Qt.CheckStateRole])
+
+    def set_stats(self, stats):
+        """
+        Show scan results: ``stats`` maps folders to their STATUS items
+        (``MESSAGES``, ``SIZE``), or to None to forget them.
+        """
+        changed = set()
+        for folder, folder_stats in stats.items():
+            node = self.nodes.get(folder)
+            if node is None:
+                continue
+            count = folder_stats.get("MESSAGES") if folder_stats else None
+            size = folder_stats.get("SIZE") if folder_stats else None
+            count_delta = (count or 0) - (node.count or 0)
+            size_delta = (size or 0) - (node.size or 0)
+            counted_delta = (count is not None) - (node.count is not None)
+            node.count, node.size = count, size
+            while node is not None:
+                node.total_count += count_delta
+                node.total_size += size_delta
+                node.counted += counted_delta
+                changed.add(node)
+                node = node.parent
+        self._changed(changed, 1, len(FOLDER_COLUMNS) - 1, [Qt.DisplayRole, SORT_ROLE])
+
+    def clear_stats(self):
+        self.set_stats(dict.fromkeys(self.nodes))
+
+    def _changed(self, nodes, first_column, last_column, roles):
+        rows = {}
+        for node in nodes:
+            if node is self.root:
+                continue
+            low, high = rows.get(node.parent, (node.row, node.row))
+            rows[node.parent] = (min(low, node.row), max(high, node.row))
+        for parent, (low, high) in rows.items():
+            parent_index = self._index(parent)
+            self.dataChanged.emit(self.index(low, first_column, parent_index),
+                                  self.index(high, last_column, parent_index), roles)
+
+    def _node(self, index):
+        return index.internalPointer() if index.isValid() else self.root
+
+    def _index(self, node):
+        return QModelIndex() if node is self.root else self.createIndex(node.row, 0, node)
+
+    def _stat(self, node, column):
+        if node.is_folder:
+            return node.count if column == 1 else node.size
+        if not node.counted:
+            return None
+        return node.total_count if column == 1 else node.total_size or None
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        return self.createIndex(row, column, self._node(parent).children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        return self._index(index.internalPointer().parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        return len(self._node(parent).children)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(FOLDER_COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return FOLDER_COLUMNS[section]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if index.column() == 0:
+            return Qt.ItemIsEnabled | Qt.ItemIsUserCheckable
+        return Qt.ItemIsEnabled
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        column = index.column()
+        if column == 0:
+            if role == Qt.DisplayRole:
+                return node.name
+            if role == Qt.CheckStateRole:
+                return node.check_state()
+            if role in (FOLDER_ROLE, Qt.ToolTipRole):
+                return node.path
+            if role == SORT_ROLE:
+                return node.name.lower()
+            return None
+        value = self._stat(node, column)
+        if role == Qt.DisplayRole:
+            if value is None:
+                return ""
+            return f"{value:,}" if column == 1 else format_bytes(value)
+        if role == SORT_ROLE:
+            return -1 if value is None else value
+        if role == Qt.TextAlignmentRole:
+            return Qt.AlignRight | Qt.AlignVCenter
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or not index.isValid() or index.column() != 0:
+            return False
+        folders = []
+        stack = [index.internalPointer()]
+        while stack:
+            node = stack.pop()
+            if node.is_folder:
+                folders.append(node.path)
+            stack.extend(node.children)
+        self.set_checked(folders, value == Qt.Checked)
+        return True
+
 
 class HelpDialog(QDialog):
     def __init__(self, parent=None):
@@ -85,7 +326,9 @@ class HelpDialog(QDialog):
             <p><b>2. Select Folders</b></p>
             <ul>
                 <li>Check the folders you want to scan/delete</li>
-                <li>Use "SELECT ALL" or "DESELECT ALL" for convenience</li>
+                <li>Nested labels are grouped as a tree; checking a group checks everything in it</li>
+                <li>Type in the filter box to narrow the list; "SELECT ALL" and "DESELECT ALL" then only affect the matching folders</li>
+                <li>After a SCAN, click the Emails or Size header to sort by it</li>
                 <li>Common folders: INBOX, Sent, Spam, Drafts</li>
             </ul>
 
@@ -95,9 +338,17 @@ class HelpDialog(QDialog):
                 <li><b>Permanent Delete:</b> Emails are permanently deleted (cannot be recovered)</li>
             </ul>
 
+            <p><b>Optional: Filter</b></p>
+            <ul>
+                <li><b>Gmail search filter:</b> Gmail syntax such as <i>older_than:2y category:promotions</i></li>
+                <li><b>IMAP SEARCH criteria:</b> e.g. <i>BEFORE 01-Jan-2023 FROM noreply@x.com</i></li>
+                <li>Leave both empty to scan/delete everything in the selected folders</li>
+            </ul>
+
             <p><b>4. Scan or Delete</b></p>
             <ul>
                 <li><b>SCAN:</b> Count emails in selected folders (safe, no deletion)</li>
+                <li><b>PLAN:</b> Save the exact emails a deletion would remove (safe, no deletion)</li>
                 <li><b>DELETE:</b> Delete emails from selected folders</li>
                 <li><b>STOP:</b> Abort the current operation</li>
             </ul>
@@ -105,6 +356,7 @@ class HelpDialog(QDialog):
             <h2 style="color: #39ff14;">⚠️ Important Notes</h2>
             <ul>
                 <li><b>Always scan first</b> to verify what will be deleted</li>
+                <li>For large deletions, <b>plan first</b> and delete exactly the saved plan: mail that arrives in between is not touched</li>
                 <li><b>Permanent deletion cannot be undone</b></li>
                 <li>Large deletions may take several minutes</li>
                 <li>Keep the application open during deletion</li>
@@ -139,6 +391,7 @@ class HelpDialog(QDialog):
                 <li>Gmail IMAP has rate limits for bulk operations</li>
                 <li>Large folders (10,000+ emails) will take time</li>
                 <li>Be patient and don't close the application</li>
+                <li>The status bar shows live IMAP metrics: latency percentiles, round trips per email and throttling</li>
             </ul>
 
             <h2 style="color: #39ff14;">🌐 Resources</h2>
@@ -158,7 +411,7 @@ class CyberpunkGmailDeleter(QMainWindow):
     connection_success = pyqtSignal(object)
     auth_error = pyqtSignal(str)
     connection_error = pyqtSignal(str)
-    log_signal = pyqtSignal(str)
+    folder_stats_ready = pyqtSignal(object)
 
     def __init__(self):
         super().__init__()
@@ -223,7 +476,7 @@ class CyberpunkGmailDeleter(QMainWindow):
                 border: 2px solid #00ffcc;
                 border-radius: 5px;
             }
-            QTextEdit {
+            QTextEdit, QPlainTextEdit {
                 background-color: #000000;
                 border: 2px solid #00ffcc;
                 font-family: 'Consolas', monospace;
@@ -231,9 +484,11 @@ class CyberpunkGmailDeleter(QMainWindow):
                 border-radius: 5px;
             }
         """)
-        self.imap = None
-        self.is_running = False
-        self.folder_checks = {}
+        self.engine = None
+        self.chunk_size = CHUNK_SIZE
+        self.pool_size = POOL_SIZE
+        self.split_size = SPLIT_SIZE
+        self.plan = None
         self.connect_icon = self.style().standardIcon(QStyle.SP_BrowserReload)
         self.connecting_icon = self.style().standardIcon(QStyle.SP_BrowserStop)
         self.connected_icon = self.style().standardIcon(QStyle.SP_DialogApplyButton)
@@ -241,7 +496,18 @@ class CyberpunkGmailDeleter(QMainWindow):
         self.connection_success.connect(self.handle_connection_success)
         self.auth_error.connect(self.handle_auth_error)
         self.connection_error.connect(self.handle_connection_error)
-        self.log_signal.connect(self._append_log)
+        self.folder_stats_ready.connect(self.update_folder_stats)
+        # Workers append to the deque (atomic in CPython, no lock needed) and a
+        # timer on the UI thread moves the lines to the terminal in batches.
+        self.log_queue = deque()
+        self.log_file = None
+        self.log_timer = QTimer(self)
+        self.log_timer.timeout.connect(self._flush_log)
+        self.log_timer.start(LOG_FLUSH_INTERVAL)
+        self.progress_active = False
+        self.progress_timer = QTimer(self)
+        self.progress_timer.timeout.connect(self.update_progress)
+        self.progress_timer.start(PROGRESS_REFRESH_INTERVAL)
 
         self.init_ui()
 
@@ -260,6 +526,14 @@ class CyberpunkGmailDeleter(QMainWindow):
         self.status_bar = self.statusBar()
         self.status_bar.setStyleSheet("color: #00ffcc; font-size: 14px; padding: 5px;")
         self.status_bar.showMessage("🔌 Disconnected - Click HELP for setup instructions")
+        self.metrics_label = QLabel("")
+        self.metrics_label.setStyleSheet("color: #ffd700; font-size: 12px; padding: 0 5px;")
+        self.metrics_label.setToolTip("Live IMAP metrics: commands, latency percentiles, round trips per email, "
+                                      "throttling and traffic")
+        self.status_bar.addPermanentWidget(self.metrics_label)
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.timeout.connect(self.update_metrics)
+        self.metrics_timer.start(1000)
 
         # Initial log messages
         self.log("⚡ GMAIL BULK DELETER - PROVIDED BY ANGRY ADMIN")
@@ -529,18 +803,61 @@ class CyberpunkGmailDeleter(QMainWindow):
         folder_buttons_widget.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
         folder_layout_main.addWidget(folder_buttons_widget)
 
-        self.folder_scroll = QScrollArea()
-        self.folder_scroll.setWidgetResizable(True)
-        self.folder_scroll.setMinimumHeight(180)
-        self.folder_scroll.setMaximumHeight(220)
-
-        self.folder_container = QWidget()
-        self.folder_container.setStyleSheet("background-color: #1a1a2e;")
-        self.folder_scroll.setWidget(self.folder_container)
-
-        self.folder_layout = QVBoxLayout(self.folder_container)
-        self.folder_layout.setSpacing(8)
-        self.folder_layout.setContentsMargins(10, 10, 10, 10)
+        self.folder_filter = QLineEdit()
+        self.folder_filter.setPlaceholderText("🔎 Filter folders (e.g. Newsletters/ or Promotions)")
+        self.folder_filter.setClearButtonEnabled(True)
+        self.folder_filter.setFixedHeight(40)
+        self.folder_filter.setStyleSheet("""
+            QLineEdit {
+                background-color: #1a1a2e;
+                color: #00ffcc;
+                border: 1px solid #00ffcc;
+                border-radius: 5px;
+                padding: 6px 10px;
+                font-size: 14px;
+            }
+        """)
+        self.folder_filter.setEnabled(False)
+        folder_layout_main.addWidget(self.folder_filter)
+
+        self.folder_model = FolderTreeModel(self)
+        self.folder_proxy = QSortFilterProxyModel(self)
+        self.folder_proxy.setSourceModel(self.folder_model)
+        self.folder_proxy.setRecursiveFilteringEnabled(True)
+        self.folder_proxy.setFilterRole(FOLDER_ROLE)
+        self.folder_proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self.folder_proxy.setSortRole(SORT_ROLE)
+        self.folder_filter.textChanged.connect(self.filter_folders)
+
+        self.folder_view = QTreeView()
+        self.folder_view.setModel(self.folder_proxy)
+        self.folder_view.setUniformRowHeights(True)  # lets the view lay out only the visible rows
+        self.folder_view.setSortingEnabled(True)
+        self.folder_view.sortByColumn(0, Qt.AscendingOrder)
+        self.folder_view.setSelectionMode(QTreeView.NoSelection)
+        self.folder_view.setMinimumHeight(180)
+        self.folder_view.setMaximumHeight(320)
+        header = self.folder_view.header()
+        header.setStretchLastSection(False)
+        header.setSectionResizeMode(0, QHeaderView.Stretch)
+        header.setSectionResizeMode(1, QHeaderView.ResizeToContents)
+        header.setSectionResizeMode(2, QHeaderView.ResizeToContents)
+        self.folder_view.setStyleSheet("""
+            QTreeView {
+                background-color: #1a1a2e;
+                color: #00ffcc;
+                border: 1px solid #00ffcc;
+                border-radius: 5px;
+                font-size: 14px;
+            }
+            QHeaderView::section {
+                background-color: #142248;
+                color: #f7fbff;
+                border: none;
+                padding: 4px 8px;
+            }
+        """)
+        self.folder_view.hide()
 
         self.folder_placeholder = QLabel("🔌 Connect to Gmail to load your folders...")
         self.folder_placeholder.setStyleSheet("""
@@ -551,9 +868,9 @@ class CyberpunkGmailDeleter(QMainWindow):
             background-color: transparent;
         """)
         self.folder_placeholder.setAlignment(Qt.AlignCenter)
-        self.folder_layout.addWidget(self.folder_placeholder)
+        folder_layout_main.addWidget(self.folder_placeholder)
 
-        folder_layout_main.addWidget(self.folder_scroll, 1)
+        folder_layout_main.addWidget(self.folder_view, 1)
         layout.addWidget(folder_frame)
 
         delete_mode_frame = QFrame()
@@ -582,6 +899,59 @@ class CyberpunkGmailDeleter(QMainWindow):
 
         layout.addWidget(delete_mode_frame)
 
+        options_frame = QFrame()
+        options_frame.setObjectName("cyberFrame")
+        options_layout = QVBoxLayout(options_frame)
+        options_layout.setSpacing(10)
+
+        options_title = QLabel("⚙️ OPTIONS")
+        options_title.setFont(QFont("Orbitron", 18, QFont.Bold))
+        options_layout.addWidget(options_title)
+
+        self.index_check = QCheckBox("💾 Keep a local metadata index (SQLite cache, no message bodies)")
+        self.index_check.setFont(QFont("Rajdhani", 14))
+        self.index_check.setMinimumHeight(30)
+        self.index_check.setToolTip(f"Stored in {default_cache_dir()}")
+        options_layout.addWidget(self.index_check)
+
+        self.pipeline_check = QCheckBox("⚡ Pipeline IMAP commands during deletion (faster on slow links)")
+        self.pipeline_check.setFont(QFont("Rajdhani", 14))
+        self.pipeline_check.setMinimumHeight(30)
+        self.pipeline_check.setToolTip(f"Keeps up to {PIPELINE_DEPTH} commands in flight per connection")
+        options_layout.addWidget(self.pipeline_check)
+
+        self.plan_check = QCheckBox("📝 Delete exactly the saved plan (no new search, refuses if a folder changed)")
+        self.plan_check.setFont(QFont("Rajdhani", 14))
+        self.plan_check.setMinimumHeight(30)
+        self.plan_check.setToolTip("Uses the plan from PLAN DELETION, or asks for a plan file")
+        options_layout.addWidget(self.plan_check)
+
+        self.archive_check = QCheckBox("📦 Archive emails to a compressed mbox before deleting them")
+        self.archive_check.setFont(QFont("Rajdhani", 14))
+        self.archive_check.setMinimumHeight(30)
+        self.archive_check.setToolTip("Asks for a folder; each chunk is saved there before it is deleted")
+        options_layout.addWidget(self.archive_check)
+
+        self.log_file_check = QCheckBox("📜 Save the full log to a rotating file")
+        self.log_file_check.setFont(QFont("Rajdhani", 14))
+        self.log_file_check.setMinimumHeight(30)
+        self.log_file_check.setToolTip(f"Stored in {os.path.join(default_cache_dir(), 'logs')}; "
+                                       f"the terminal keeps the last {LOG_MAX_LINES:,} lines")
+        self.log_file_check.toggled.connect(self.toggle_log_file)
+        options_layout.addWidget(self.log_file_check)
+
+        self.gmail_filter_input = QLineEdit()
+        self.gmail_filter_input.setPlaceholderText("Gmail search filter, e.g. older_than:2y category:promotions larger:10M")
+        self.gmail_filter_input.setMinimumHeight(40)
+        options_layout.addWidget(self.gmail_filter_input)
+
+        self.imap_filter_input = QLineEdit()
+        self.imap_filter_input.setPlaceholderText("IMAP SEARCH criteria, e.g. BEFORE 01-Jan-2023 FROM noreply@x.com LARGER 10000000")
+        self.imap_filter_input.setMinimumHeight(40)
+        options_layout.addWidget(self.imap_filter_input)
+
+        layout.addWidget(options_frame)
+
         action_layout = QHBoxLayout()
         action_layout.setSpacing(15)
 
@@ -608,6 +978,52 @@ class CyberpunkGmailDeleter(QMainWindow):
             }
         """)
 
+        self.analyze_btn = QPushButton("📊 ANALYZE STORAGE")
+        self.analyze_btn.setFont(QFont("Orbitron", 14, QFont.Bold))
+        self.analyze_btn.clicked.connect(self.analyze_emails)
+        self.analyze_btn.setEnabled(False)
+        self.analyze_btn.setFixedHeight(50)
+        self.analyze_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #3b1f6e;
+                color: #f0e6ff;
+                border: 2px solid #c77dff;
+                border-radius: 8px;
+                padding: 12px 24px;
+            }
+            QPushButton:hover {
+                background-color: #5a2fa8;
+            }
+            QPushButton:disabled {
+                background-color: #221140;
+                color: #b79ae0;
+                border: 2px dashed #9d6bd8;
+            }
+        """)
+
+        self.plan_btn = QPushButton("📝 PLAN DELETION")
+        self.plan_btn.setFont(QFont("Orbitron", 14, QFont.Bold))
+        self.plan_btn.clicked.connect(self.plan_emails)
+        self.plan_btn.setEnabled(False)
+        self.plan_btn.setFixedHeight(50)
+        self.plan_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #5c4a00;
+                color: #fff8e0;
+                border: 2px solid #ffcc00;
+                border-radius: 8px;
+                padding: 12px 24px;
+            }
+            QPushButton:hover {
+                background-color: #806600;
+            }
+            QPushButton:disabled {
+                background-color: #2e2500;
+                color: #d9c36a;
+                border: 2px dashed #b39b2d;
+            }
+        """)
+
         self.delete_btn = QPushButton("⚠️ DELETE EMAILS")
         self.delete_btn.setFont(QFont("Orbitron", 14, QFont.Bold))
         self.delete_btn.clicked.connect(self.delete_emails)
@@ -647,6 +1063,8 @@ class CyberpunkGmailDeleter(QMainWindow):
         """)
 
         action_layout.addWidget(self.scan_btn)
+        action_layout.addWidget(self.analyze_btn)
+        action_layout.addWidget(self.plan_btn)
         action_layout.addWidget(self.delete_btn)
         action_layout.addWidget(self.stop_btn)
         layout.addLayout(action_layout)
@@ -660,8 +1078,33 @@ class CyberpunkGmailDeleter(QMainWindow):
         terminal_title.setFont(QFont("Orbitron", 18, QFont.Bold))
         terminal_layout.addWidget(terminal_title)
 
-        self.terminal = QTextEdit()
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 1)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setMinimumHeight(25)
+        self.progress_bar.setStyleSheet("""
+            QProgressBar {
+                background-color: #000000;
+                border: 2px solid #00ffcc;
+                border-radius: 5px;
+                color: #ffffff;
+                text-align: center;
+                font-weight: bold;
+            }
+            QProgressBar::chunk {
+                background-color: #39ff14;
+            }
+        """)
+        terminal_layout.addWidget(self.progress_bar)
+
+        self.progress_label = QLabel("")
+        self.progress_label.setStyleSheet("color: #ffd700; font-size: 14px;")
+        terminal_layout.addWidget(self.progress_label)
+
+        self.terminal = QPlainTextEdit()
         self.terminal.setReadOnly(True)
+        self.terminal.setUndoRedoEnabled(False)
+        self.terminal.setMaximumBlockCount(LOG_MAX_LINES)
         self.terminal.setMinimumHeight(220)
         self.terminal.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         terminal_layout.addWidget(self.terminal)
@@ -709,25 +1152,139 @@ class CyberpunkGmailDeleter(QMainWindow):
         help_dialog.exec_()
 
     def log(self, message):
-        if threading.current_thread() is threading.main_thread():
-            self._append_log(message)
-        else:
-            self.log_signal.emit(message)
+        self.log_queue.append(message)
+        log_file = self.log_file
+        if log_file is not None:
+            log_file.info(message)
 
-    def _append_log(self, message):
-        self.terminal.append(message)
+    def update_progress(self):
+        """
+        Refresh the progress bar from the engine's tracker at a fixed rate,
+        however fast the workers advance it, plus once after a job ends.
+        """
+        if not self.engine:
+            return
+        running = self.engine.is_running
+        if not running and not self.progress_active:
+            return
+        self.progress_active = running
+        state = self.engine.tracker.snapshot()
+        if not state["total"]:
+            self.progress_bar.setRange(0, 0 if running else 1)  # busy indicator while searching
+            self.progress_label.setText("🔎 Searching..." if running else "")
+            return
+        self.progress_bar.setRange(0, state["total"])
+        self.progress_bar.setValue(min(state["done"], state["total"]))
+        text = f"📈 {self.engine.tracker.describe()}"
+        if running and state["idle"] >= STALL_WARNING:
+            text += f" · ⏳ no progress for {format_duration(state['idle'])}"
+        self.progress_label.setText(text)
+        lines = []
+        for folder, entry in state["folders"].items():
+            rate = f"{entry['rate']:,.0f} emails/s" if entry["rate"] else "-- emails/s"
+            lines.append(f"{folder}: {entry['done']:,}/{entry['total']:,} · {rate} · "
+                         f"ETA {format_duration(entry['eta'])}")
+        self.progress_label.setToolTip("\n".join(lines))
+
+    def update_metrics(self):
+        if self.engine:
+            self.metrics_label.setText(self.engine.metrics.summary())
+
+    def _save_metrics(self):
+        """
+        Log where the run spent its time and save the IMAP metrics as JSON and
+        Prometheus text next to the reports.
+        """
+        metrics = self.engine.metrics
+        for line in metrics.report_lines():
+            self.log(line)
+        try:
+            metrics_dir = os.path.join(default_cache_dir(), "metrics")
+            os.makedirs(metrics_dir, exist_ok=True)
+            base = os.path.join(metrics_dir, time.strftime("metrics-%Y%m%d-%H%M%S"))
+            metrics.write(base + ".json")
+            metrics.write(base + ".prom")
+            self.log(f"💾 IMAP metrics saved to {base}.json and {base}.prom")
+        except OSError as e:
+            self.log(f"⚠️ Could not save IMAP metrics: {e}")
+
+    def _flush_log(self):
+        """
+        Append everything logged since the last tick as one block of text.
+        A backlog larger than the terminal keeps only its newest lines.
+        """
+        if not self.log_queue:
+            return
+        lines = []
+        while self.log_queue:
+            lines.append(self.log_queue.popleft())
+        self.terminal.appendPlainText("\n".join(lines[-LOG_MAX_LINES:]))
         scrollbar = self.terminal.verticalScrollBar()
         scrollbar.setValue(scrollbar.maximum())
 
+    def toggle_log_file(self, enabled):
+        """
+        Tee the full log (not just the lines the terminal keeps) to a
+        rotating file in the cache directory.
+        """
+        if not enabled:
+            if self.log_file is not None:
+                for handler in list(self.log_file.handlers):
+                    self.log_file.removeHandler(handler)
+                    handler.close()
+                self.log_file = None
+            return
+        path = os.path.join(default_cache_dir(), "logs", "gmail_cleanup.log")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_FILE_BYTES,
+                                                           backupCount=LOG_FILE_BACKUPS, encoding="utf-8")
+        except OSError as e:
+            self.log(f"❌ Cannot open log file {path}: {e}")
+            self.log_file_check.setChecked(False)
+            return
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        log_file = logging.getLogger("gmail_cleanup.terminal")
+        log_file.propagate = False
+        log_file.setLevel(logging.INFO)
+        log_file.addHandler(handler)
+        self.log_file = log_file
+        self.log(f"💾 Saving the log to {path}")
+
+    def _filtered_folders(self):
+        text = self.folder_filter.text().strip()
+        return self.folder_model.matching_folders(text) if text else self.folder_model.folders()
+
     def select_all_folders(self):
-        for check in self.folder_checks.values():
-            check.setChecked(True)
-        self.log("✅ All folders selected.")
+        folders = self._filtered_folders()
+        self.folder_model.set_checked(folders, True)
+        if self.folder_filter.text().strip():
+            self.log(f"✅ {len(folders):,} matching folders selected.")
+        else:
+            self.log("✅ All folders selected.")
 
     def deselect_all_folders(self):
-        for check in self.folder_checks.values():
-            check.setChecked(False)
-        self.log("✅ All folders deselected.")
+        folders = self._filtered_folders()
+        self.folder_model.set_checked(folders, False)
+        if self.folder_filter.text().strip():
+            self.log(f"✅ {len(folders):,} matching folders deselected.")
+        else:
+            self.log("✅ All folders deselected.")
+
+    def filter_folders(self, text):
+        self.folder_proxy.setFilterFixedString(text.strip())
+        if text.strip():
+            self.folder_view.expandAll()
+
+    def update_folder_stats(self, stats):
+        """
+        Slot for folder_stats_ready: scan workers emit their results and the
+        model updates the count and size columns on the UI thread.
+        """
+        if stats is None:
+            self.folder_model.clear_stats()
+        else:
+            self.folder_model.set_stats(stats)
 
     def connect_imap(self):
         username = self.email_input.text().strip()
@@ -754,10 +1311,11 @@ class CyberpunkGmailDeleter(QMainWindow):
         self.connect_btn.setIcon(self.connecting_icon)
 
         def connect_thread():
+            engine = GmailCleanupEngine(email, password, log=self.log, pool_size=self.pool_size,
+                                        chunk_size=self.chunk_size, split_size=self.split_size)
             try:
-                imap = imaplib.IMAP4_SSL('imap.gmail.com', 993)
-                imap.login(email, password)
-                self.connection_success.emit(imap)
+                engine.connect()
+                self.connection_success.emit(engine)
             except imaplib.IMAP4.error as e:
                 self.auth_error.emit(str(e))
             except Exception as e:
@@ -765,9 +1323,11 @@ class CyberpunkGmailDeleter(QMainWindow):
 
         threading.Thread(target=connect_thread, daemon=True).start()
 
-    def handle_connection_success(self, imap):
-        self.imap = imap
+    def handle_connection_success(self, engine):
+        self.engine = engine
         self.log('\u2705 Connected successfully!')
+        if 'MOVE' in engine.capabilities:
+            self.log('\u26a1 Server supports MOVE - Move to Trash will use UID MOVE')
         self.status_bar.showMessage('\U0001f50c Connected to Gmail')
         self.connect_btn.setText('CONNECTED')
         self.connect_btn.setIcon(self.connected_icon)
@@ -799,30 +1359,20 @@ class CyberpunkGmailDeleter(QMainWindow):
 
     def load_folders(self):
         try:
-            if self.folder_placeholder:
-                self.folder_placeholder.deleteLater()
-                self.folder_placeholder = None
-
-            status, folders = self.imap.list()
-            if status == "OK":
+            folders = self.engine.list_folders()
+            if folders is not None:
                 self.log("📁 Loading folders...")
-                folder_count = 0
-
-                for folder in folders:
-                    folder_name = folder.decode().split('"')[-2]
-                    if folder_name not in ["[Gmail]", "Notes"]:
-                        check = QCheckBox(folder_name)
-                        check.setStyleSheet("color: #00ffcc; font-size: 14px;")
-                        check.setMinimumHeight(25)
-                        self.folder_layout.addWidget(check)
-                        self.folder_checks[folder_name] = check
-                        folder_count += 1
-
+                self.folder_model.set_folders(folders)
+                self.folder_placeholder.hide()
+                self.folder_view.show()
+                self.folder_filter.setEnabled(True)
                 self.scan_btn.setEnabled(True)
+                self.analyze_btn.setEnabled(True)
+                self.plan_btn.setEnabled(True)
                 self.delete_btn.setEnabled(True)
                 self.select_all_btn.setEnabled(True)
                 self.deselect_all_btn.setEnabled(True)
-                self.log(f"📁 Loaded {folder_count} folders successfully!")
+                self.log(f"📁 Loaded {len(folders)} folders successfully!")
                 self.log("💡 Select folders and click SCAN to count emails")
             else:
                 self.log("❌ Failed to load folders.")
@@ -830,7 +1380,7 @@ class CyberpunkGmailDeleter(QMainWindow):
             self.log(f"❌ Error loading folders: {e}")
 
     def scan_emails(self):
-        selected_folders = [folder for folder, check in self.folder_checks.items() if check.isChecked()]
+        selected_folders = self.folder_model.selected_folders()
         if not selected_folders:
             self.log("⚠️ Error: No folders selected!")
             self.log("💡 Select at least one folder to scan")
@@ -839,33 +1389,29 @@ class CyberpunkGmailDeleter(QMainWindow):
         self.log("=" * 60)
         self.log("🔍 Starting scan operation...")
         self.status_bar.showMessage("🔍 Scanning folders...")
+        self.engine.metrics.reset()
+        self.engine.tracker.start({})
+        self.progress_active = True
         self.scan_btn.setEnabled(False)
+        self.analyze_btn.setEnabled(False)
+        self.plan_btn.setEnabled(False)
         self.delete_btn.setEnabled(False)
         self.stop_btn.setEnabled(True)
 
+        criteria = self._search_criteria()
+        use_index = self.index_check.isChecked()
+
         def scan_thread():
             try:
-                total_emails = 0
-                for folder in selected_folders:
-                    if not self.is_running:
-                        self.log("⏹️ Scan stopped by user")
-                        break
-                    self.log(f"📁 Scanning: {folder}")
-                    quoted_folder = f'"{folder}"' if any(c in folder for c in ['/', ' ', '\\']) else folder
-                    status, _ = self.imap.select(quoted_folder, readonly=True)
-                    if status != "OK":
-                        self.log(f"❌ Failed to access folder: {folder}")
-                        continue
-                    status, messages = self.imap.search(None, "ALL")
-                    if status == "OK":
-                        count = len(messages[0].split())
-                        total_emails += count
-                        self.log(f"   └─ Found {count:,} emails")
-                    else:
-                        self.log(f"❌ Failed to search folder: {folder}")
-
+                result = self.engine.scan(selected_folders, criteria, use_index=use_index)
+                if criteria == "ALL":  # filtered scans count matches, not the folder's size
+                    self.folder_stats_ready.emit(result["folders"])
+                total_emails = result["total"]
                 self.log("─" * 60)
-                self.log(f"📊 SCAN COMPLETE: Total {total_emails:,} emails in {len(selected_folders)} folders")
+                summary = f"📊 SCAN COMPLETE: Total {total_emails:,} emails in {len(selected_folders)} folders"
+                if result["size"]:
+                    summary += f" ({format_bytes(result['size'])})"
+                self.log(summary)
                 self.log("=" * 60)
                 self.status_bar.showMessage(f"📊 Scan complete - {total_emails:,} emails found")
             except Exception as e:
@@ -873,80 +1419,187 @@ class CyberpunkGmailDeleter(QMainWindow):
                 self.status_bar.showMessage("❌ Scan Error")
             finally:
                 self.scan_btn.setEnabled(True)
+                self.analyze_btn.setEnabled(True)
+                self.plan_btn.setEnabled(True)
                 self.delete_btn.setEnabled(True)
                 self.stop_btn.setEnabled(False)
-                self.is_running = False
 
-        self.is_running = True
         threading.Thread(target=scan_thread, daemon=True).start()
 
+    def analyze_emails(self):
+        selected_folders = self.folder_model.selected_folders()
+        if not selected_folders:
+            self.log("⚠️ Error: No folders selected!")
+            self.log("💡 Select at least one folder to analyze")
+            return
+
+        self.log("=" * 60)
+        self.log("📊 Starting storage analysis...")
+        self.status_bar.showMessage("📊 Analyzing storage...")
+        self.engine.metrics.reset()
+        self.engine.tracker.start({})
+        self.progress_active = True
+        self.scan_btn.setEnabled(False)
+        self.analyze_btn.setEnabled(False)
+        self.plan_btn.setEnabled(False)
+        self.delete_btn.setEnabled(False)
+        self.stop_btn.setEnabled(True)
+
+        criteria = self._search_criteria()
+
+        def analyze_thread():
+            try:
+                report = self.engine.analyze(selected_folders, criteria)
+                report_dir = os.path.join(default_cache_dir(), "reports")
+                os.makedirs(report_dir, exist_ok=True)
+                base = os.path.join(report_dir, time.strftime("storage-%Y%m%d-%H%M%S"))
+                report.write_csv(base + ".csv")
+                report.write_json(base + ".json")
+                self.log("─" * 60)
+                self.log(f"📊 ANALYSIS COMPLETE: {report.messages:,} emails, {format_bytes(report.size)}")
+                if report.failed:
+                    self.log(f"⚠️ Not fully analyzed: {', '.join(report.failed)}")
+                self.log(f"💾 Report saved to {base}.csv and {base}.json")
+                self.log("=" * 60)
+                self.status_bar.showMessage(f"📊 Analysis complete - {format_bytes(report.size)} in {report.messages:,} emails")
+            except Exception as e:
+                self.log(f"❌ Analysis Error: {e}")
+                self.status_bar.showMessage("❌ Analysis Error")
+            finally:
+                self.scan_btn.setEnabled(True)
+                self.analyze_btn.setEnabled(True)
+                self.plan_btn.setEnabled(True)
+                self.delete_btn.setEnabled(True)
+                self.stop_btn.setEnabled(False)
+
+        threading.Thread(target=analyze_thread, daemon=True).start()
+
+    def plan_emails(self):
+        selected_folders = self.folder_model.selected_folders()
+        if not selected_folders:
+            self.log("⚠️ Error: No folders selected!")
+            self.log("💡 Select at least one folder to plan a deletion for")
+            return
+
+        is_permanent = self.permanent_radio.isChecked()
+        self.log("=" * 60)
+        self.log("📝 Planning deletion (dry run, nothing is deleted)...")
+        self.status_bar.showMessage("📝 Planning deletion...")
+        self.engine.metrics.reset()
+        self.engine.tracker.start({})
+        self.progress_active = True
+        self.scan_btn.setEnabled(False)
+        self.analyze_btn.setEnabled(False)
+        self.plan_btn.setEnabled(False)
+        self.delete_btn.setEnabled(False)
+        self.stop_btn.setEnabled(True)
+
+        criteria = self._search_criteria()
+        use_index = self.index_check.isChecked()
+
+        def plan_thread():
+            try:
+                plan = self.engine.plan(selected_folders, is_permanent, criteria, use_index=use_index)
+                if plan is None:
+                    return
+                plan_dir = os.path.join(default_cache_dir(), "plans")
+                path = os.path.join(plan_dir, time.strftime("plan-%Y%m%d-%H%M%S.json"))
+                plan.write(path)
+                self.plan = plan
+                self.log("─" * 60)
+                self.log(f"📝 PLAN READY: {plan.messages:,} emails, {format_bytes(plan.size)} to {plan.mode}")
+                self.log(f"💾 Plan saved to {path}")
+                self.log("💡 Review it, tick '📝 Delete exactly the saved plan' and press DELETE EMAILS")
+                self.log("=" * 60)
+                self.status_bar.showMessage(f"📝 Plan ready - {plan.messages:,} emails")
+            except Exception as e:
+                self.log(f"❌ Planning Error: {e}")
+                self.status_bar.showMessage("❌ Planning Error")
+            finally:
+                self.scan_btn.setEnabled(True)
+                self.analyze_btn.setEnabled(True)
+                self.plan_btn.setEnabled(True)
+                self.delete_btn.setEnabled(True)
+                self.stop_btn.setEnabled(False)
+
+        threading.Thread(target=plan_thread, daemon=True).start()
+
+    def _load_plan(self):
+        if self.plan is not None:
+            return self.plan
+        path, _ = QFileDialog.getOpenFileName(self, "Open deletion plan", os.path.join(default_cache_dir(), "plans"),
+                                              "Deletion plans (*.json)")
+        if not path:
+            return None
+        try:
+            self.plan = DeletionPlan.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            self.log(f"❌ Cannot read plan {path}: {e}")
+            return None
+        self.log(f"📝 Loaded plan {self.plan.checksum} from {path}")
+        return self.plan
+
     def delete_emails(self):
-        selected_folders = [folder for folder, check in self.folder_checks.items() if check.isChecked()]
+        plan = self._load_plan() if self.plan_check.isChecked() else None
+        if plan is not None:
+            selected_folders = list(plan.folders)
+            is_permanent = plan.mode == "permanent"
+        elif self.plan_check.isChecked():
+            self.log("⚠️ Error: No plan to execute!")
+            self.log("💡 Press PLAN DELETION first, or untick '📝 Delete exactly the saved plan'")
+            return
+        else:
+            selected_folders = self.folder_model.selected_folders()
+            is_permanent = self.permanent_radio.isChecked()
         if not selected_folders:
             self.log("⚠️ Error: No folders selected!")
             self.log("💡 Select at least one folder to delete from")
             return
 
-        is_permanent = self.permanent_radio.isChecked()
+        archive = None
+        if self.archive_check.isChecked():
+            path = QFileDialog.getExistingDirectory(self, "Archive emails to", os.path.expanduser("~"))
+            if not path:
+                self.log("⚠️ Deletion cancelled: no archive folder chosen")
+                return
+            try:
+                archive = open_archive(path, "mbox", "gzip")
+            except (OSError, ValueError) as e:
+                self.log(f"❌ Cannot create archive in {path}: {e}")
+                return
+
         mode_text = "PERMANENT DELETION" if is_permanent else "MOVE TO TRASH"
 
         self.log("=" * 60)
         self.log(f"🗑️ Starting deletion operation - Mode: {mode_text}")
         self.log(f"📁 Folders to process: {len(selected_folders)}")
         self.status_bar.showMessage(f"🗑️ Deleting emails - {mode_text}")
+        self.engine.metrics.reset()
+        self.engine.tracker.start({})
+        self.progress_active = True
         self.scan_btn.setEnabled(False)
+        self.analyze_btn.setEnabled(False)
+        self.plan_btn.setEnabled(False)
         self.delete_btn.setEnabled(False)
         self.stop_btn.setEnabled(True)
 
+        criteria = self._search_criteria()
+        use_index = self.index_check.isChecked()
+        self.engine.pipeline_depth = PIPELINE_DEPTH if self.pipeline_check.isChecked() else 0
+
         def delete_thread():
             try:
-                total_deleted = 0
-                for folder in selected_folders:
-                    if not self.is_running:
-                        self.log("⏹️ Deletion stopped by user")
-                        break
-                    self.log(f"🗑️ Processing folder: {folder}")
-                    quoted_folder = f'"{folder}"' if any(c in folder for c in ['/', ' ', '\\']) else folder
-                    status, _ = self.imap.select(quoted_folder)
-                    if status != "OK":
-                        self.log(f"❌ Failed to access folder: {folder}")
-                        continue
-                    status, messages = self.imap.uid('SEARCH', None, "ALL")
-                    if status == "OK":
-                        email_uids = messages[0].split()
-                        if not email_uids:
-                            self.log(f"   └─ No emails to delete in {folder}")
-                            continue
-                        count = len(email_uids)
-                        self.log(f"   └─ Deleting {count:,} emails...")
-
-                        trash_msgids = []
-                        for i, email_uid in enumerate(email_uids, 1):
-                            if not self.is_running:
-                                break
-
-                            if is_permanent:
-                                msg_id = self._prepare_permanent_delete(email_uid)
-                                if not msg_id:
-                                    self.log("   └─ ⚠️ Failed to prepare email for permanent removal, skipping.")
-                                    continue
-                                trash_msgids.append(msg_id)
-                            else:
-                                if not self._move_to_trash(email_uid):
-                                    self.log("   └─ ⚠️ Failed to move an email to Trash, skipping.")
-                                    continue
-
-                            if i % 100 == 0:
-                                self.log(f"   └─ Progress: {i}/{count} ({(i/count*100):.1f}%)")
-
-                        if is_permanent:
-                            self._delete_permanently(trash_msgids, quoted_folder)
-                        else:
-                            self.imap.expunge()
-                        total_deleted += count
-                        self.log(f"   └─ ✅ Deleted {count:,} emails from {folder}")
-
+                if plan is not None:
+                    result = self.engine.execute_plan(plan, use_index=use_index, archive=archive)
+                    if not result["stopped"] and not result["failed"]:
+                        self.plan = None
+                else:
+                    result = self.engine.delete(selected_folders, is_permanent, criteria, use_index=use_index,
+                                                archive=archive)
+                total_deleted = result["deleted"]
                 self.log("─" * 60)
+                if archive is not None:
+                    self.log(f"📦 Archived {archive.messages:,} emails ({format_bytes(archive.size)}) to {archive.path}")
                 self.log(f"🗑️ DELETION COMPLETE: {total_deleted:,} emails deleted")
                 self.log("=" * 60)
                 self.status_bar.showMessage(f"🗑️ Deletion complete - {total_deleted:,} emails deleted")
@@ -954,107 +1607,39 @@ class CyberpunkGmailDeleter(QMainWindow):
                 self.log(f"❌ Deletion Error: {e}")
                 self.status_bar.showMessage("❌ Deletion Error")
             finally:
+                if archive is not None:
+                    archive.close()
+                self.folder_stats_ready.emit(None)  # a deleted message leaves every label it had
+                self._save_metrics()
                 self.scan_btn.setEnabled(True)
+                self.analyze_btn.setEnabled(True)
+                self.plan_btn.setEnabled(True)
                 self.delete_btn.setEnabled(True)
                 self.stop_btn.setEnabled(False)
-                self.is_running = False
 
-        self.is_running = True
         threading.Thread(target=delete_thread, daemon=True).start()
 
-    def _uid_to_str(self, email_uid):
-        if isinstance(email_uid, bytes):
-            return email_uid.decode()
-        return str(email_uid)
+    def _search_criteria(self):
+        return build_search_criteria(self.gmail_filter_input.text(), self.imap_filter_input.text())
 
-    def _move_to_trash(self, email_uid):
-        """
-        Move the given email (by UID) to Gmail Trash and flag it as deleted.
-        Returns True on success, False otherwise.
-        """
-        uid = self._uid_to_str(email_uid)
-        status, _ = self.imap.uid('COPY', uid, '[Gmail]/Trash')
-        if status != 'OK':
-            return False
-        status, _ = self.imap.uid('STORE', uid, '+FLAGS.SILENT', '(\\Deleted)')
-        return status == 'OK'
-
-    def _prepare_permanent_delete(self, email_uid):
-        """
-        Move the message into Gmail Trash and return its Gmail message ID so we can delete forever.
-        """
-        uid = self._uid_to_str(email_uid)
-        status, data = self.imap.uid('FETCH', uid, '(X-GM-MSGID)')
-        if status != 'OK' or not data:
-            return None
-
-        msg_id = None
-        for resp in data:
-            if isinstance(resp, tuple):
-                resp = resp[0]
-            if not resp:
-                continue
-            decoded = resp.decode('utf-8', errors='ignore') if isinstance(resp, bytes) else str(resp)
-            match = re.search(r'X-GM-MSGID (\d+)', decoded)
-            if match:
-                msg_id = match.group(1)
-                break
-
-        if not msg_id:
-            return None
-
-        status, _ = self.imap.uid('STORE', uid, '+X-GM-LABELS', '(\Trash)')
-        if status != 'OK':
-            return None
-        self.imap.uid('STORE', uid, '-X-GM-LABELS', '(\Inbox)')
-        return msg_id
-
-    def _delete_permanently(self, msg_id_list, return_mailbox):
-        if not msg_id_list:
-            return
-        try:
-            status, _ = self.imap.select('[Gmail]/Trash')
-            if status != 'OK':
-                self.log('?? Unable to access Gmail Trash for permanent deletion.')
-                return
-
-            trash_uids = []
-            for msg_id in msg_id_list:
-                search_status, search_data = self.imap.uid('SEARCH', None, 'X-GM-MSGID', msg_id)
-                if search_status == 'OK' and search_data and search_data[0]:
-                    trash_uids.extend(search_data[0].decode().split())
-
-            if not trash_uids:
-                self.log('?? No matching messages located in Trash for permanent removal.')
-                return
-
-            uid_set = ','.join(trash_uids)
-            self.imap.uid('STORE', uid_set, '+FLAGS.SILENT', '(\Deleted)')
-            self.imap.uid('EXPUNGE', uid_set)
-        except Exception as e:
-            self.log(f'?? Error while permanently deleting from Trash: {e}')
-        finally:
-            try:
-                self.imap.select(return_mailbox)
-            except Exception:
-                pass
     def stop_process(self):
-        self.is_running = False
+        if self.engine:
+            self.engine.stop()
         self.log("⏹️ Stopping operation...")
         self.status_bar.showMessage("⏹️ Stopped")
         self.scan_btn.setEnabled(True)
+        self.analyze_btn.setEnabled(True)
+        self.plan_btn.setEnabled(True)
         self.delete_btn.setEnabled(True)
         self.stop_btn.setEnabled(False)
 
     def closeEvent(self, event):
-        self.is_running = False
-        if self.imap:
-            try:
-                self.imap.close()
-                self.imap.logout()
-                self.log("🔌 Disconnected from Gmail")
-            except:
-                pass
+        if self.engine:
+            self.engine.close()
+            self.log("🔌 Disconnected from Gmail")
+        self.log_timer.stop()
+        self._flush_log()
+        self.toggle_log_file(False)
         event.accept()
 
 if __name__ == "__main__":
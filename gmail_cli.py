@@ -0,0 +1,245 @@
+"""
+Command-line front end for the Gmail cleanup engine, for cron jobs and
+headless servers. Results are printed as JSON on stdout; the log goes to
+stderr.
+
+    export GMAIL_APP_PASSWORD=abcdefghijklmnop
+    python -m gmail_cli --user you@gmail.com scan --all-folders
+    python -m gmail_cli --user you@gmail.com delete --folder Newsletters --gmail-filter "older_than:2y" --yes
+    python -m gmail_cli --user you@gmail.com analyze --folder "[Gmail]/All Mail" --csv report.csv
+    python -m gmail_cli --user you@gmail.com rules cleanup-rules.json --yes
+    python -m gmail_cli --user you@gmail.com plan --folder Newsletters --mode permanent -o newsletters.plan.json
+    python -m gmail_cli --user you@gmail.com delete --plan newsletters.plan.json --yes
+    python -m gmail_cli --user you@gmail.com delete -f INBOX --mode permanent --archive backup/ --compress gzip --yes
+    python -m gmail_cli --user you@gmail.com --metrics run.prom delete --folder Newsletters --yes
+"""
+import sys
+import os
+import json
+import signal
+import getpass
+import argparse
+import imaplib
+from gmail_engine import (
+    CHUNK_SIZE, IMAP_HOST, IMAP_PORT, PIPELINE_DEPTH, POOL_SIZE, REPORT_TOP, DeletionPlan, GmailCleanupEngine,
+    build_search_criteria
+)
+from gmail_archive import COMPRESSIONS, FORMATS, open_archive
+from gmail_rules import RuleError, explain_rules, load_rules, run_rules
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_AUTH = 3
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="gmail_cli",
+        description="Scan and bulk-delete Gmail over IMAP without the GUI.",
+    )
+    parser.add_argument("--user", default=os.environ.get("GMAIL_USER"),
+                        help="Gmail address or username (default: $GMAIL_USER)")
+    parser.add_argument("--password-env", default="GMAIL_APP_PASSWORD", metavar="NAME",
+                        help="environment variable holding the App Password (default: GMAIL_APP_PASSWORD); "
+                             "prompted for when unset and stdin is a terminal")
+    parser.add_argument("--host", default=IMAP_HOST, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=IMAP_PORT, help=argparse.SUPPRESS)
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE,
+                        help=f"parallel IMAP connections (default: {POOL_SIZE})")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help=f"UIDs per IMAP command (default: {CHUNK_SIZE})")
+    parser.add_argument("--index", action="store_true", help="use the local SQLite metadata index")
+    parser.add_argument("--quiet", action="store_true", help="do not write the log to stderr")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="write per-command IMAP metrics at the end of the run (Prometheus text for .prom/.txt, "
+                             "JSON otherwise)")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.required = True
+
+    commands.add_parser("folders", help="list folders")
+
+    def add_selection(command):
+        command.add_argument("--folder", "-f", action="append", default=[], dest="folders",
+                             help="folder to process (repeatable)")
+        command.add_argument("--all-folders", action="store_true", help="process every folder")
+        command.add_argument("--gmail-filter", default="", help="Gmail search query, sent as X-GM-RAW")
+        command.add_argument("--imap-filter", default="", help="IMAP SEARCH criteria, e.g. 'BEFORE 01-Jan-2023'")
+
+    add_selection(commands.add_parser("scan", help="count emails per folder"))
+    plan = commands.add_parser("plan", help="write the exact UIDs a delete would remove to a plan file")
+    add_selection(plan)
+    plan.add_argument("--output", "-o", required=True, metavar="PATH", help="plan file to write")
+    delete = commands.add_parser("delete", help="move emails to Trash or delete them forever")
+    add_selection(delete)
+    delete.add_argument("--plan", metavar="PATH",
+                        help="delete exactly the UIDs of a plan file instead of searching (folders, mode and "
+                             "filters come from the plan)")
+    for command in (plan, delete):
+        command.add_argument("--mode", choices=("trash", "permanent"),
+                             help="trash is recoverable, permanent is not (default: trash; with --plan, must match "
+                                  "the plan's mode)")
+    rules = commands.add_parser("rules", help="apply the cleanup rules in a JSON or YAML file")
+    rules.add_argument("rules_file", metavar="FILE", help="rules file (see gmail_rules.py for the format)")
+    rules.add_argument("--explain", action="store_true",
+                       help="print the search each rule compiles to and exit without deleting")
+    for command in (delete, rules):
+        command.add_argument("--pipeline", type=int, nargs="?", const=PIPELINE_DEPTH, default=0, metavar="DEPTH",
+                             help=f"keep up to DEPTH commands in flight per connection (asyncio; default depth {PIPELINE_DEPTH})")
+        command.add_argument("--yes", action="store_true", help="confirm the deletion (required)")
+        command.add_argument("--archive", metavar="DIR",
+                             help="archive every chunk to DIR (one mbox or Maildir per folder) before deleting it")
+        command.add_argument("--archive-format", choices=FORMATS, default="mbox", help="archive format (default: mbox)")
+        command.add_argument("--compress", choices=COMPRESSIONS, help="compress the archive (zstd needs zstandard)")
+    analyze = commands.add_parser("analyze", help="break down size and count by sender, domain, list, year and label")
+    add_selection(analyze)
+    analyze.add_argument("--top", type=int, default=REPORT_TOP, metavar="N",
+                         help=f"entries per breakdown (default: {REPORT_TOP})")
+    analyze.add_argument("--csv", metavar="PATH", help="also write the report as CSV")
+    return parser
+
+
+def read_password(args):
+    password = os.environ.get(args.password_env)
+    if not password and sys.stdin.isatty():
+        password = getpass.getpass("Gmail App Password: ")
+    return (password or "").strip()
+
+
+def emit(result):
+    json.dump(result, sys.stdout, indent=2, ensure_ascii=False)
+    sys.stdout.write("\n")
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.user:
+        parser.error("--user is required (or set GMAIL_USER)")
+    if args.command == "delete" and not args.yes:
+        parser.error("delete needs --yes to confirm")
+    if args.command == "rules":
+        if not args.yes and not args.explain:
+            parser.error("rules needs --yes to confirm (or --explain to only show the plan)")
+        try:
+            rules = load_rules(args.rules_file)
+        except (OSError, RuleError) as e:
+            parser.error(str(e))
+    elif args.command == "delete" and args.plan:
+        if args.folders or args.all_folders or args.gmail_filter or args.imap_filter:
+            parser.error("--plan cannot be combined with --folder, --all-folders or filters")
+        try:
+            plan = DeletionPlan.load(args.plan)
+        except (OSError, ValueError, KeyError) as e:
+            parser.error(f"cannot read plan {args.plan}: {e}")
+        if args.mode and args.mode != plan.mode:
+            parser.error(f"--mode {args.mode} does not match the plan, which was made for {plan.mode}")
+    elif args.command != "folders" and not args.folders and not args.all_folders:
+        parser.error("choose folders with --folder or --all-folders")
+    archive = None
+    if args.command in ("delete", "rules") and args.archive:
+        try:
+            archive = open_archive(args.archive, args.archive_format, args.compress)
+        except (OSError, ValueError) as e:
+            parser.error(f"cannot create archive {args.archive}: {e}")
+    password = read_password(args)
+    if not password:
+        parser.error(f"no App Password: set {args.password_env}")
+    email = args.user if '@' in args.user else f"{args.user}@gmail.com"
+
+    if hasattr(sys.stderr, "reconfigure"):
+        sys.stderr.reconfigure(errors="replace")
+
+    def log(message):
+        print(message, file=sys.stderr, flush=True)
+
+    engine = GmailCleanupEngine(email, password, log=None if args.quiet else log, host=args.host,
+                                port=args.port, pool_size=args.pool_size, chunk_size=args.chunk_size)
+
+    def stop(signum, frame):
+        engine.log("⏹️ Stopping operation...")
+        engine.stop()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        engine.connect()
+    except imaplib.IMAP4.error as e:
+        emit({"command": args.command, "error": f"Authentication failed: {e}"})
+        return EXIT_AUTH
+    except Exception as e:
+        emit({"command": args.command, "error": f"Connection failed: {e}"})
+        return EXIT_FAILED
+
+    try:
+        folders = engine.list_folders()
+        if folders is None:
+            emit({"command": args.command, "error": "Failed to load folders"})
+            return EXIT_FAILED
+        if args.command == "folders":
+            emit({"command": "folders", "folders": folders})
+            return EXIT_OK
+        if args.command == "rules":
+            if args.explain:
+                emit({"command": "rules", "rules": explain_rules(engine, rules)})
+                return EXIT_OK
+            engine.pipeline_depth = args.pipeline
+            results = run_rules(engine, rules, use_index=args.index, archive=archive)
+            emit({"command": "rules", "rules": results})
+            ok = len(results) == len(rules) and not any(result["stopped"] or result["failed"] for result in results)
+            return EXIT_OK if ok else EXIT_FAILED
+
+        selected = folders if args.all_folders else args.folders
+        criteria = build_search_criteria(args.gmail_filter, args.imap_filter)
+        if args.command == "scan":
+            result = engine.scan(selected, criteria, use_index=args.index)
+            ok = not result["stopped"] and all(stats is not None for stats in result["folders"].values())
+        elif args.command == "plan":
+            plan = engine.plan(selected, args.mode == "permanent", criteria, use_index=args.index)
+            if plan is None:
+                emit({"command": "plan", "stopped": True})
+                return EXIT_FAILED
+            plan.write(args.output)
+            result = {key: value for key, value in plan.to_dict().items() if key != "folders"}
+            result["folders"] = {folder: {"count": len(entry["uids"]), "size": entry["size"]}
+                                 for folder, entry in plan.folders.items()}
+            result["output"] = args.output
+            ok = not plan.failed
+        elif args.command == "analyze":
+            report = engine.analyze(selected, criteria, top=args.top)
+            if args.csv:
+                report.write_csv(args.csv)
+            result = dict(criteria=criteria, folders=selected, **report.to_dict())
+            ok = not report.stopped and not report.failed
+        else:
+            engine.pipeline_depth = args.pipeline
+            if args.plan:
+                result = engine.execute_plan(plan, use_index=args.index, archive=archive)
+            else:
+                result = engine.delete(selected, args.mode == "permanent", criteria, use_index=args.index,
+                                       archive=archive)
+            if archive is not None:
+                result["archived"] = archive.messages
+            ok = not result["stopped"] and not result["failed"]
+        emit(dict(command=args.command, **result))
+        return EXIT_OK if ok else EXIT_FAILED
+    except Exception as e:
+        emit({"command": args.command, "error": str(e)})
+        return EXIT_FAILED
+    finally:
+        engine.close()
+        if archive is not None:
+            archive.close()
+        for line in engine.metrics.report_lines():
+            engine.log(line)
+        if args.metrics:
+            try:
+                engine.metrics.write(args.metrics)
+            except OSError as e:
+                engine.log(f"⚠️ Could not write metrics to {args.metrics}: {e}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2860 @@
+"""
+Headless Gmail cleanup engine. It only needs the standard library, so it can
+be driven from cron or a server without Qt. The PyQt5 window in
+gmail_cleanup.py and the command line in gmail_cli.py both use it.
+"""
+import sys
+import os
+import asyncio
+import csv
+import json
+import hashlib
+import math
+import heapq
+import time
+import random
+import sqlite3
+import threading
+import re
+import queue
+import bisect
+from array import array
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import imaplib
+import email.utils
+from async_imap import AsyncImapConnection
+from gmail_metrics import ImapMetrics, MeteredIMAP4_SSL
+
+IMAP_HOST = 'imap.gmail.com'
+IMAP_PORT = 993
+CHUNK_SIZE = 500
+POOL_SIZE = 4
+SPLIT_SIZE = 20000
+PIPELINE_DEPTH = 8
+MIN_CHUNK_SIZE = 25
+CHUNK_STEP = 50
+SLOW_FACTOR = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+THROTTLE_RETRIES = 6
+RECONNECT_RETRIES = 5
+RECONNECT_DELAY = 1.0
+INDEX_FETCH_SIZE = 5000
+UID_WINDOW = 50000
+MAX_UID_SET_LENGTH = 4000
+ANALYZE_FETCH_SIZE = 2000
+ARCHIVE_BATCH_BYTES = 16 * 1024 * 1024
+RATE_TIME_CONSTANT = 10.0
+REPORT_TOP = 20
+REPORT_DEDUPE_BATCH = 65536  # message IDs collected in a set before they are merged into the sorted array
+FETCH_START_RE = re.compile(rb'^\d+ \(')
+FETCH_UID_RE = re.compile(rb'\bUID (\d+)')
+FETCH_MSGID_RE = re.compile(rb'X-GM-MSGID (\d+)')
+FETCH_THRID_RE = re.compile(rb'X-GM-THRID (\d+)')
+FETCH_SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+FETCH_DATE_RE = re.compile(rb'INTERNALDATE "[^"]*"')
+FETCH_FLAGS_RE = re.compile(rb'\bFLAGS \(([^)]*)\)')
+INLINE_LITERAL_RE = re.compile(rb'\{(\d+)\}\r\n')
+FETCH_LABELS_RE = re.compile(rb'X-GM-LABELS \(((?:[^()"]|"(?:[^"\\]|\\.)*")*)\)')
+INDEX_FETCH_ITEMS = '(UID X-GM-MSGID X-GM-THRID RFC822.SIZE INTERNALDATE X-GM-LABELS)'
+ANALYZE_FETCH_ITEMS = '(UID X-GM-MSGID RFC822.SIZE INTERNALDATE X-GM-LABELS BODY.PEEK[HEADER.FIELDS (FROM LIST-ID)])'
+ARCHIVE_META_ITEMS = '(UID RFC822.SIZE INTERNALDATE FLAGS)'
+FILTER_FETCH_ITEMS = '(UID RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (FROM TO SUBJECT LIST-ID)])'
+HEADER_FROM_RE = re.compile(rb'^From:[ \t]*(.*(?:\r?\n[ \t].*)*)', re.IGNORECASE | re.MULTILINE)
+HEADER_LIST_ID_RE = re.compile(rb'^List-Id:[ \t]*(.*(?:\r?\n[ \t].*)*)', re.IGNORECASE | re.MULTILINE)
+LABEL_RE = re.compile(rb'"((?:[^"\\]|\\.)*)"|([^\s"]+)')
+STATUS_NAME_RE = re.compile(rb'^\s*(?:"((?:[^"\\]|\\.)*)"|(\S+))\s+\(')
+ESEARCH_COUNT_RE = re.compile(rb'\bCOUNT (\d+)')
+ESEARCH_ALL_RE = re.compile(rb'\bALL ([\d:,]+)')
+STATUS_ITEM_RE = re.compile(rb'(MESSAGES|UNSEEN|SIZE|UIDNEXT|UIDVALIDITY|HIGHESTMODSEQ) (\d+)')
+UIDVALIDITY_RE = re.compile(rb'\[UIDVALIDITY (\d+)\]')
+THROTTLED_RE = re.compile(rb'\[(?:THROTTLED|OVERQUOTA|UNAVAILABLE|LIMIT)\]', re.IGNORECASE)
+
+
+def build_search_criteria(gmail_query="", imap_criteria=""):
+    """
+    Combine standard IMAP SEARCH keys (``BEFORE 01-Jan-2023 FROM x LARGER n``)
+    and a Gmail search query (sent as ``X-GM-RAW``) into one UID SEARCH
+    criteria string. Returns ``ALL`` when both are empty.
+    """
+    parts = []
+    if imap_criteria.strip():
+        parts.append(imap_criteria.strip())
+    if gmail_query.strip():
+        escaped = gmail_query.strip().replace('\\', '\\\\').replace('"', '\\"')
+        parts.append(f'X-GM-RAW "{escaped}"')
+    return " ".join(parts) or "ALL"
+
+
+def uid_set_size(uid_set):
+    """
+    Number of UIDs in a sequence set without expanding it; ``*`` counts as one.
+    """
+    if isinstance(uid_set, bytes):
+        uid_set = uid_set.decode()
+    size = 0
+    for part in uid_set.split(','):
+        low, _, high = part.partition(':')
+        if low.isdigit() and high.isdigit():
+            size += abs(int(high) - int(low)) + 1
+        elif part:
+            size += 1
+    return size
+
+
+def parse_uid_set(uid_set):
+    """
+    Expand IMAP sequence-set syntax (``1:3,7``) into a compact ``array('I')``
+    of UIDs (4 bytes each).
+    """
+    if isinstance(uid_set, bytes):
+        uid_set = uid_set.decode()
+    uids = array('I')
+    for part in uid_set.split(','):
+        if not part:
+            continue
+        low, _, high = part.partition(':')
+        low, high = int(low), int(high or low)
+        uids.extend(range(min(low, high), max(low, high) + 1))
+    return uids
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:,.1f} {unit}" if unit != "B" else f"{size:,} B"
+        size /= 1024
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--"
+    seconds = math.ceil(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+
+
+def iter_fetch_records(data):
+    """
+    Group imaplib FETCH data into one ``(meta, literals)`` pair per message.
+    imaplib splits a response at every literal into a ``(prefix, literal)``
+    tuple followed by the bytes that come after it.
+    """
+    meta, literals = None, []
+    for item in data:
+        if item is None:
+            continue
+        head = item[0] if isinstance(item, tuple) else item
+        if FETCH_START_RE.match(head):
+            if meta is not None:
+                yield meta, literals
+            meta, literals = b'', []
+        if meta is None:
+            continue
+        meta += head
+        if isinstance(item, tuple):
+            literals.append(item[1])
+    if meta is not None:
+        yield meta, literals
+
+
+def iter_inline_fetch_records(untagged):
+    """
+    iter_fetch_records() for async_imap responses, where each FETCH is one
+    ``n FETCH (...)`` bytes object with its literals inlined.
+    """
+    for response in untagged:
+        if b' FETCH (' not in response[:24]:
+            continue
+        meta, literals, position = b'', [], 0
+        while True:
+            match = INLINE_LITERAL_RE.search(response, position)
+            if not match:
+                break
+            end = match.end() + int(match.group(1))
+            meta += response[position:match.start()]
+            literals.append(response[match.end():end])
+            position = end
+        yield meta + response[position:], literals
+
+
+def parse_message_metadata(meta):
+    """
+    Extract UID, Gmail IDs, size, INTERNALDATE (epoch seconds), flags and
+    labels from one FETCH response. Missing items are returned as None.
+    """
+    def number(regex):
+        match = regex.search(meta)
+        return int(match.group(1)) if match else None
+
+    date = None
+    date_match = FETCH_DATE_RE.search(meta)
+    if date_match:
+        parsed = imaplib.Internaldate2tuple(date_match.group(0))
+        date = int(time.mktime(parsed)) if parsed else None
+    flags_match = FETCH_FLAGS_RE.search(meta)
+    labels = None
+    labels_match = FETCH_LABELS_RE.search(meta)
+    if labels_match:
+        labels = [(quoted if quoted else bare).decode(errors='ignore').replace('\\"', '"')
+                  for quoted, bare in LABEL_RE.findall(labels_match.group(1))]
+    return {
+        "uid": number(FETCH_UID_RE),
+        "msgid": number(FETCH_MSGID_RE),
+        "thrid": number(FETCH_THRID_RE),
+        "size": number(FETCH_SIZE_RE),
+        "date": date,
+        "flags": flags_match.group(1).decode(errors='ignore').split() if flags_match else None,
+        "labels": labels,
+    }
+
+
+def parse_report_headers(header):
+    """
+    Return the lower-cased sender address and the List-Id (without angle
+    brackets) from a ``HEADER.FIELDS (FROM LIST-ID)`` block, or None for each
+    one that is missing.
+    """
+    sender = list_id = None
+    match = HEADER_FROM_RE.search(header or b'')
+    if match:
+        address = email.utils.parseaddr(match.group(1).decode(errors='ignore').replace('\r\n', ''))[1]
+        sender = address.lower() if '@' in address else None
+    match = HEADER_LIST_ID_RE.search(header or b'')
+    if match:
+        value = match.group(1).decode(errors='ignore').replace('\r\n', '').strip()
+        bracketed = re.search(r'<([^>]+)>', value)
+        list_id = (bracketed.group(1) if bracketed else value).lower() or None
+    return sender, list_id
+
+
+def default_cache_dir():
+    base = os.environ.get("LOCALAPPDATA") if sys.platform == "win32" else None
+    base = base or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "gmail_cleanup")
+
+
+class UidSet:
+    """
+    Sorted set of UIDs stored as inclusive ranges in two ``array('I')``
+    columns (``lows`` and ``highs``), so a million contiguous UIDs take one
+    range and a million scattered ones 8 MB. ``str()`` gives the minimal IMAP
+    sequence set (``1:4000,4002:9000``) and ``split()`` cuts it into pieces
+    that fit on one command line.
+    """
+
+    def __init__(self, uids=()):
+        self.lows = array('I')
+        self.highs = array('I')
+        self._size = 0
+        self._extend((uid, uid) for uid in map(int, uids))
+
+    def _extend(self, ranges):
+        """
+        Merge ``(low, high)`` ranges in. Ranges arriving in order (the UID
+        arrays the engine passes around are sorted) are merged in one pass;
+        from the first out-of-order range on, the rest is sorted and merged
+        with what was built so far.
+        """
+        ranges = iter(ranges)
+        for low, high in ranges:
+            if low > high:
+                low, high = high, low
+            if self.lows and low < self.lows[-1]:
+                rest = sorted((min(pair), max(pair)) for pair in ranges)
+                rest.insert(bisect.bisect_left(rest, (low, high)), (low, high))
+                lows, highs = self.lows, self.highs
+                self.lows, self.highs = array('I'), array('I')
+                for merged_low, merged_high in heapq.merge(zip(lows, highs), rest):
+                    self._append(merged_low, merged_high)
+                break
+            self._append(low, high)
+        self._size = sum(high - low + 1 for low, high in zip(self.lows, self.highs))
+
+    def _append(self, low, high):
+        lows, highs = self.lows, self.highs
+        if highs and low <= highs[-1] + 1:
+            if high > highs[-1]:
+                highs[-1] = high
+        else:
+            lows.append(low)
+            highs.append(high)
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        uid_set = cls()
+        uid_set._extend(ranges)
+        return uid_set
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Build a set from IMAP sequence-set syntax (``1:3,7``).
+        """
+        if isinstance(text, bytes):
+            text = text.decode()
+
+        def ranges():
+            for part in text.split(','):
+                if part:
+                    low, _, high = part.partition(':')
+                    yield int(low), int(high or low)
+        return cls.from_ranges(ranges())
+
+    @property
+    def ranges(self):
+        return list(zip(self.lows, self.highs))
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for low, high in zip(self.lows, self.highs):
+            yield from range(low, high + 1)
+
+    def __contains__(self, uid):
+        index = bisect.bisect_right(self.lows, int(uid)) - 1
+        return index >= 0 and self.highs[index] >= int(uid)
+
+    def __eq__(self, other):
+        return isinstance(other, UidSet) and self.lows == other.lows and self.highs == other.highs
+
+    def __or__(self, other):
+        return UidSet.from_ranges(heapq.merge(zip(self.lows, self.highs), zip(other.lows, other.highs)))
+
+    def __ior__(self, other):
+        """
+        In-place union. Journal commits mostly arrive above everything
+        committed so far, and are then appended without copying the set.
+        """
+        if other.lows and (not self.lows or other.lows[0] > self.highs[-1]):
+            self._append(other.lows[0], other.highs[0])
+            self.lows.extend(other.lows[1:])
+            self.highs.extend(other.highs[1:])
+            self._size += other._size
+            return self
+        merged = self | other
+        self.lows, self.highs, self._size = merged.lows, merged.highs, merged._size
+        return self
+
+    def __sub__(self, other):
+        result = UidSet()
+        other_lows, other_highs = other.lows, other.highs
+        first = 0
+        for low, high in zip(self.lows, self.highs):
+            while first < len(other_lows) and other_highs[first] < low:
+                first += 1
+            index = first
+            while low <= high and index < len(other_lows) and other_lows[index] <= high:
+                if other_lows[index] > low:
+                    result._append(low, other_lows[index] - 1)
+                low = max(low, other_highs[index] + 1)
+                index += 1
+            if low <= high:
+                result._append(low, high)
+        result._size = sum(high - low + 1 for low, high in zip(result.lows, result.highs))
+        return result
+
+    union = __or__
+    difference = __sub__
+
+    def __str__(self):
+        return ','.join(str(low) if low == high else f"{low}:{high}" for low, high in zip(self.lows, self.highs))
+
+    def __repr__(self):
+        return f"UidSet({str(self)!r})"
+
+    def split(self, max_length=MAX_UID_SET_LENGTH, max_size=None):
+        """
+        Cut the set into consecutive UidSets whose sequence set is at most
+        ``max_length`` characters and, when given, holds at most ``max_size``
+        UIDs.
+        """
+        pieces = []
+        current, length, size = [], 0, 0
+        for low, high in zip(self.lows, self.highs):
+            while low <= high:
+                end = high if max_size is None else min(high, low + max_size - size - 1)
+                text_length = len(str(low)) if low == end else len(str(low)) + 1 + len(str(end))
+                if current and length + 1 + text_length > max_length:
+                    pieces.append(UidSet.from_ranges(current))
+                    current, length, size = [], 0, 0
+                    continue
+                length += text_length + (1 if current else 0)
+                current.append((low, end))
+                size += end - low + 1
+                low = end + 1
+                if max_size is not None and size >= max_size:
+                    pieces.append(UidSet.from_ranges(current))
+                    current, length, size = [], 0, 0
+        if current:
+            pieces.append(UidSet.from_ranges(current))
+        return pieces
+
+
+class MetadataIndex:
+    """
+    Optional on-disk SQLite index of folder state (UIDVALIDITY, UIDNEXT,
+    HIGHESTMODSEQ) and per-message metadata. Message bodies and credentials
+    are never stored. The connection is shared by worker threads, so every
+    access goes through one lock.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS folders (
+            name TEXT PRIMARY KEY,
+            uidvalidity INTEGER NOT NULL,
+            uidnext INTEGER NOT NULL,
+            highestmodseq INTEGER,
+            synced_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            folder TEXT NOT NULL,
+            uid INTEGER NOT NULL,
+            msgid INTEGER,
+            thrid INTEGER,
+            size INTEGER,
+            date INTEGER,
+            labels TEXT,
+            PRIMARY KEY (folder, uid)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS messages_msgid ON messages (msgid);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+
+    @classmethod
+    def for_account(cls, email):
+        safe_name = re.sub(r'[^A-Za-z0-9@._-]', '_', email.lower())
+        return cls(os.path.join(default_cache_dir(), f"{safe_name}.sqlite3"))
+
+    def folder_state(self, folder):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT uidvalidity, uidnext, highestmodseq, "
+                "(SELECT COUNT(*) FROM messages WHERE folder = ?) FROM folders WHERE name = ?",
+                (folder, folder),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"uidvalidity": row[0], "uidnext": row[1], "highestmodseq": row[2], "messages": row[3]}
+
+    def reset_folder(self, folder):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM messages WHERE folder = ?", (folder,))
+            self._db.execute("DELETE FROM folders WHERE name = ?", (folder,))
+
+    def set_folder_state(self, folder, uidvalidity, uidnext, highestmodseq=None):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO folders (name, uidvalidity, uidnext, highestmodseq, synced_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (folder, uidvalidity, uidnext, highestmodseq, time.time()),
+            )
+
+    def add_messages(self, folder, records):
+        rows = [
+            (folder, record["uid"], record["msgid"], record["thrid"], record["size"], record["date"],
+             json.dumps(record["labels"]) if record["labels"] is not None else None)
+            for record in records
+        ]
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def remove_messages(self, folder, uids):
+        """
+        Forget the given UIDs and, because Gmail labels are views of the same
+        message, the same messages in every other folder except Trash.
+        """
+        uids = [int(uid) for uid in uids]
+        with self._lock, self._db:
+            for start in range(0, len(uids), 500):
+                chunk = uids[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                self._db.execute(
+                    f"DELETE FROM messages WHERE folder != '[Gmail]/Trash' AND msgid IN "
+                    f"(SELECT msgid FROM messages WHERE folder = ? AND uid IN ({marks}) AND msgid IS NOT NULL)",
+                    [folder] + chunk,
+                )
+                self._db.execute(f"DELETE FROM messages WHERE folder = ? AND uid IN ({marks})", [folder] + chunk)
+
+    def discard_uids(self, folder, uids):
+        """
+        Forget UIDs that left this folder only (e.g. a label was removed).
+        """
+        uids = [int(uid) for uid in uids]
+        with self._lock, self._db:
+            for start in range(0, len(uids), 500):
+                chunk = uids[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                self._db.execute(f"DELETE FROM messages WHERE folder = ? AND uid IN ({marks})", [folder] + chunk)
+
+    def msgids(self, folder, uids):
+        """
+        ``{uid: X-GM-MSGID}`` for the given UIDs of a folder.
+        """
+        uids = [int(uid) for uid in uids]
+        found = {}
+        with self._lock:
+            for start in range(0, len(uids), 500):
+                chunk = uids[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                found.update(self._db.execute(
+                    f"SELECT uid, msgid FROM messages WHERE folder = ? AND uid IN ({marks}) AND msgid IS NOT NULL",
+                    [folder] + chunk))
+        return found
+
+    def size(self, folder, uids):
+        """
+        Total RFC822.SIZE of the given UIDs of a folder.
+        """
+        uids = [int(uid) for uid in uids]
+        total = 0
+        with self._lock:
+            for start in range(0, len(uids), 500):
+                chunk = uids[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                total += self._db.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM messages WHERE folder = ? AND uid IN ({marks})",
+                    [folder] + chunk).fetchone()[0]
+        return total
+
+    def uids(self, folder):
+        with self._lock:
+            return array('I', (row[0] for row in self._db.execute(
+                "SELECT uid FROM messages WHERE folder = ? ORDER BY uid", (folder,))))
+
+    def folder_summary(self, folder):
+        with self._lock:
+            count, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM messages WHERE folder = ?", (folder,)
+            ).fetchone()
+        return {"MESSAGES": count, "SIZE": size}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class DeletionJournal:
+    """
+    Append-only, fsync'd log of a deletion job: the planned UID set per
+    folder and every chunk that has been committed. A job that was stopped or
+    crashed resumes from its last committed chunk instead of searching again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._reset()
+        if os.path.exists(path):
+            with open(path, "rb") as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn final write from a crash
+                    self._apply(record)
+
+    @classmethod
+    def for_account(cls, email, job=None):
+        """
+        The journal of ``email``'s deletion job, or of its named ``job`` (one
+        per cleanup rule) so that independent jobs resume independently.
+        """
+        safe_name = re.sub(r'[^A-Za-z0-9@._-]', '_', email.lower())
+        if job:
+            safe_name += "-" + re.sub(r'[^A-Za-z0-9@._-]', '_', job)
+        return cls(os.path.join(default_cache_dir(), "jobs", f"{safe_name}.jsonl"))
+
+    def _reset(self):
+        self.mode = None
+        self.criteria = None
+        self.started = None
+        self.plans = {}
+        self.committed = {}
+        self.pending_msgids = {}
+
+    def _apply(self, record):
+        kind = record["type"]
+        folder = record.get("folder")
+        if kind == "job":
+            self._reset()
+            self.mode = record["mode"]
+            self.criteria = record.get("criteria", "ALL")
+            self.started = record["started"]
+        elif kind == "plan":
+            self.plans[folder] = (record["uidvalidity"], UidSet.parse(record["uids"]))
+            self.committed[folder] = UidSet()
+        elif kind == "commit":
+            committed = self.committed.setdefault(folder, UidSet())
+            committed |= UidSet.parse(record["uids"])
+            if record.get("msgids"):
+                self.pending_msgids.setdefault(folder, set()).update(record["msgids"])
+        elif kind == "purged":
+            self.pending_msgids.get(folder, set()).difference_update(record["msgids"])
+        elif kind == "done":
+            self._reset()
+
+    def _append(self, record):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._apply(record)
+
+    @property
+    def unfinished(self):
+        return self.mode is not None
+
+    def start(self, mode, criteria="ALL"):
+        self.close()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            self._file = open(self.path, "w", encoding="utf-8")
+        self._append({"type": "job", "mode": mode, "criteria": criteria, "started": time.time()})
+
+    def plan(self, folder, uidvalidity, uids):
+        self._append({"type": "plan", "folder": folder, "uidvalidity": uidvalidity,
+                      "uids": str(UidSet(uids))})
+
+    def commit(self, folder, uids, msgids=None):
+        record = {"type": "commit", "folder": folder, "uids": str(UidSet(uids))}
+        if msgids:
+            record["msgids"] = list(msgids)
+        self._append(record)
+
+    def purged(self, folder, msgids):
+        if msgids:
+            self._append({"type": "purged", "folder": folder, "msgids": list(msgids)})
+
+    def remaining(self, folder, uidvalidity):
+        """
+        UIDs of a planned folder that are not committed yet, or None when the
+        folder has no plan or its UIDVALIDITY changed since planning.
+        """
+        with self._lock:
+            if folder not in self.plans or self.plans[folder][0] != uidvalidity:
+                return None
+            return array('I', self.plans[folder][1] - self.committed.get(folder, UidSet()))
+
+    def finish(self):
+        self._append({"type": "done"})
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class DeletionPlan:
+    """
+    The exact deletion a dry run resolved: per folder, its UIDVALIDITY, the
+    UID set to delete and the bytes those messages take. Plan files are
+    JSON with UID sets in range form, so they stay small and reviewable.
+    ``GmailCleanupEngine.delete(plan=...)`` executes a plan without searching
+    again and refuses to when a folder's UIDVALIDITY changed. ``duplicates``
+    counts the messages left out of a folder because another planned folder
+    (label) already covers them, and ``failed`` the folders that could not
+    be planned.
+    """
+
+    VERSION = 1
+
+    def __init__(self, email, mode="trash", criteria="ALL", created=None):
+        self.email = email
+        self.mode = mode
+        self.criteria = criteria
+        self.created = created if created is not None else time.time()
+        self.folders = {}
+        self.duplicates = 0
+        self.failed = []
+
+    def add(self, folder, uidvalidity, uids, size=0):
+        uids = uids if isinstance(uids, UidSet) else UidSet(uids)
+        self.folders[folder] = {"uidvalidity": uidvalidity, "uids": uids, "size": size}
+
+    @property
+    def messages(self):
+        return sum(len(entry["uids"]) for entry in self.folders.values())
+
+    @property
+    def size(self):
+        return sum(entry["size"] for entry in self.folders.values())
+
+    @property
+    def checksum(self):
+        """
+        Short digest of the planned deletion, used as the job's identity so
+        that a stopped plan only resumes for the same plan.
+        """
+        planned = [(folder, entry["uidvalidity"], str(entry["uids"])) for folder, entry in sorted(self.folders.items())]
+        digest = hashlib.sha256(json.dumps([self.email, self.mode, self.criteria, planned]).encode())
+        return digest.hexdigest()[:16]
+
+    def to_dict(self):
+        return {
+            "version": self.VERSION,
+            "account": self.email,
+            "mode": self.mode,
+            "criteria": self.criteria,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.created)),
+            "checksum": self.checksum,
+            "messages": self.messages,
+            "size": self.size,
+            "duplicates": self.duplicates,
+            "failed": self.failed,
+            "folders": {folder: {"uidvalidity": entry["uidvalidity"], "count": len(entry["uids"]),
+                                 "size": entry["size"], "uids": str(entry["uids"])}
+                        for folder, entry in self.folders.items()},
+        }
+
+    def write(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as plan_file:
+            json.dump(self.to_dict(), plan_file, indent=2, ensure_ascii=False)
+            plan_file.write("\n")
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a plan file. Folders may have been removed from it during
+        review. Raises ValueError when it is not a plan this version
+        understands.
+        """
+        with open(path, encoding="utf-8") as plan_file:
+            data = json.load(plan_file)
+        if not isinstance(data, dict) or data.get("version") != cls.VERSION:
+            raise ValueError(f"{path} is not a version {cls.VERSION} deletion plan")
+        created = time.mktime(time.strptime(data["created"], "%Y-%m-%dT%H:%M:%S"))
+        plan = cls(data["account"], data["mode"], data.get("criteria", "ALL"), created)
+        for folder, entry in data["folders"].items():
+            plan.add(folder, entry["uidvalidity"], UidSet.parse(entry["uids"]), entry.get("size", 0))
+        plan.duplicates = data.get("duplicates", 0)
+        plan.failed = data.get("failed", [])
+        return plan
+
+
+class MailboxReport:
+    """
+    Streaming storage breakdown of a mailbox: message count and bytes per
+    sender, sender domain, mailing list (List-Id), year and label, plus the
+    largest messages. Memory grows with the number of distinct keys, not
+    with the number of messages: the largest messages live in a top-k heap.
+    With ``dedupe`` a message seen in several folders is counted once; the
+    message IDs already counted are kept in a sorted ``array('Q')`` (8 bytes
+    each, as in _dedupe_plans), with the latest REPORT_DEDUPE_BATCH in a
+    set until they are merged in. ``failed`` lists the folders that could
+    not be searched or fetched completely.
+    """
+
+    GROUPS = ("senders", "domains", "lists", "years", "labels")
+
+    def __init__(self, top=REPORT_TOP, dedupe=False):
+        self.top = top
+        self.messages = 0
+        self.size = 0
+        self.groups = {group: {} for group in self.GROUPS}
+        self.stopped = False
+        self.failed = []
+        self._largest = []
+        self._seen = array('Q') if dedupe else None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def add(self, folder, record, header):
+        """
+        Count one message from its ``parse_message_metadata`` record and
+        its From / List-Id header block.
+        """
+        size = record["size"] or 0
+        sender, list_id = parse_report_headers(header)
+        year = time.gmtime(record["date"]).tm_year if record["date"] else None
+        keys = [("senders", sender), ("domains", sender.rpartition('@')[2] if sender else None),
+                ("lists", list_id), ("years", year)]
+        keys.extend(("labels", label) for label in record["labels"] or ["(no label)"])
+        with self._lock:
+            if self._seen is not None and record["msgid"]:
+                if self._is_duplicate(record["msgid"]):
+                    return
+            self.messages += 1
+            self.size += size
+            for group, key in keys:
+                if key is not None:
+                    stats = self.groups[group].setdefault(key, [0, 0])
+                    stats[0] += 1
+                    stats[1] += size
+            entry = (size, record["msgid"] or 0, folder, record["uid"], sender or "", record["date"] or 0)
+            if len(self._largest) < self.top:
+                heapq.heappush(self._largest, entry)
+            else:
+                heapq.heappushpop(self._largest, entry)
+
+    def _is_duplicate(self, msgid):
+        """
+        Return whether ``msgid`` was already counted, and remember it if not.
+        """
+        seen = self._seen
+        found = bisect.bisect_left(seen, msgid)
+        if (found < len(seen) and seen[found] == msgid) or msgid in self._pending:
+            return True
+        self._pending.add(msgid)
+        if len(self._pending) >= REPORT_DEDUPE_BATCH:
+            self._seen = array('Q', heapq.merge(seen, sorted(self._pending)))
+            self._pending = set()
+        return False
+
+    def ranking(self, group, limit=None):
+        """
+        ``[(key, count, size)]`` of a group, largest size first (years in
+        chronological order).
+        """
+        items = self.groups[group].items()
+        if group == "years":
+            rows = sorted(items)
+        else:
+            rows = heapq.nlargest(limit or self.top, items, key=lambda item: item[1][1])
+        return [(key, count, size) for key, (count, size) in rows]
+
+    def largest(self):
+        return [{"size": size, "folder": folder, "uid": uid, "from": sender,
+                 "date": time.strftime("%Y-%m-%d", time.gmtime(date)) if date else None}
+                for size, _, folder, uid, sender, date in sorted(self._largest, reverse=True)]
+
+    def to_dict(self):
+        report = {"messages": self.messages, "size": self.size, "stopped": self.stopped, "failed": self.failed}
+        for group in self.GROUPS:
+            report[group] = [{"key": key, "count": count, "size": size}
+                             for key, count, size in self.ranking(group)]
+        report["largest"] = self.largest()
+        return report
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as report_file:
+            json.dump(self.to_dict(), report_file, indent=2, ensure_ascii=False)
+
+    def write_csv(self, path):
+        """
+        Write one ``group,key,count,size`` row per ranked key; the largest
+        messages use the group ``largest`` and a ``sender date folder UID``
+        key.
+        """
+        with open(path, "w", encoding="utf-8", newline="") as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(["group", "key", "count", "size"])
+            for group in self.GROUPS:
+                for key, count, size in self.ranking(group):
+                    writer.writerow([group, key, count, size])
+            for message in self.largest():
+                key = f"{message['from']} {message['date']} {message['folder']} UID {message['uid']}"
+                writer.writerow(["largest", key, 1, message["size"]])
+
+
+class ImapConnectionPool:
+    """
+    Bounded pool of authenticated IMAP connections. Connections are opened
+    lazily through ``factory`` up to ``size`` and each one is handed to a
+    single worker at a time.
+    """
+
+    def __init__(self, factory, size=POOL_SIZE):
+        self.factory = factory
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = len(self._connections) < self.size
+            if can_open:
+                self._connections.append(None)
+        if not can_open:
+            return self._idle.get()
+        try:
+            imap = self.factory()
+        except Exception:
+            with self._lock:
+                self._connections.remove(None)
+            raise
+        with self._lock:
+            self._connections[self._connections.index(None)] = imap
+        return imap
+
+    def release(self, imap, broken=False):
+        if not broken:
+            self._idle.put(imap)
+            return
+        with self._lock:
+            if imap in self._connections:
+                self._connections.remove(imap)
+        try:
+            imap.logout()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for a ``with`` block. Connections that hit an
+        ``IMAP4.abort`` or socket error are dropped instead of being returned
+        to the pool.
+        """
+        imap = self.acquire()
+        broken = False
+        try:
+            yield imap
+        except (imaplib.IMAP4.abort, OSError):
+            broken = True
+            raise
+        finally:
+            self.release(imap, broken=broken)
+
+    def close(self):
+        with self._lock:
+            connections = [imap for imap in self._connections if imap is not None]
+            self._connections = []
+        for imap in connections:
+            try:
+                imap.logout()
+            except Exception:
+                pass
+
+
+class UidValidityChanged(imaplib.IMAP4.error):
+    """
+    A mailbox was re-selected after a reconnect and its UIDVALIDITY had
+    changed, so the UIDs of the interrupted command no longer apply.
+    """
+
+
+class ReconnectingImap:
+    """
+    imaplib connection that survives dropped sessions. When a command fails
+    with ``IMAP4.abort`` or a socket error, a new connection is opened
+    through ``factory`` (with backoff), the selected mailbox is selected
+    again, its UIDVALIDITY is verified and the command is retried. Commands
+    with a duplicate effect when replayed (COPY, APPEND) are not retried.
+    Everything else is passed through to the current imaplib connection.
+    """
+
+    RETRIED = {'uid', 'select', 'status', 'list', 'capability', 'expunge', 'noop', '_simple_command'}
+    NOT_REPLAYABLE = {'COPY', 'APPEND'}
+
+    def __init__(self, factory, log=None, on_drop=None, retries=RECONNECT_RETRIES):
+        self.factory = factory
+        self.log = log or (lambda message: None)
+        self.on_drop = on_drop or (lambda error: None)
+        self.retries = retries
+        self.mailbox = None
+        self.imap = factory()
+
+    def __getattr__(self, name):
+        attr = getattr(self.imap, name)
+        if name not in self.RETRIED:
+            return attr
+        return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+
+    def _call(self, name, *args, **kwargs):
+        if name == 'select':
+            self.mailbox = None
+        for attempt in range(self.retries + 1):
+            try:
+                result = getattr(self.imap, name)(*args, **kwargs)
+                break
+            except (imaplib.IMAP4.abort, OSError) as e:
+                if attempt == self.retries or (name == 'uid' and str(args[0]).upper() in self.NOT_REPLAYABLE):
+                    raise
+                self._reconnect(e)
+        if name == 'select' and result[0] == 'OK':
+            self.mailbox = (args[0] if args else 'INBOX', kwargs.get('readonly', args[1] if len(args) > 1 else False),
+                            self._uidvalidity())
+        return result
+
+    def _uidvalidity(self):
+        values = self.imap.untagged_responses.get('UIDVALIDITY')
+        return int(values[-1]) if values and values[-1] else None
+
+    def _reconnect(self, error):
+        """
+        Replace the dropped connection and restore the selected mailbox.
+        Raises the original error when every attempt fails, and
+        UidValidityChanged when the mailbox no longer has the same UIDs.
+        """
+        self.on_drop(error)
+        try:
+            self.imap.shutdown()
+        except Exception:
+            pass
+        for attempt in range(1, self.retries + 1):
+            self.log(f"🔌 Connection lost ({error}); reconnecting ({attempt}/{self.retries})...")
+            time.sleep(min(BACKOFF_MAX, RECONNECT_DELAY * 2 ** (attempt - 1)))
+            try:
+                self.imap = self.factory()
+                if self.mailbox is not None:
+                    mailbox, readonly, uidvalidity = self.mailbox
+                    status, _ = self.imap.select(mailbox, readonly=readonly)
+                    if status != 'OK':
+                        raise imaplib.IMAP4.abort(f"cannot re-select {mailbox}")
+                    if self._uidvalidity() != uidvalidity:
+                        self.mailbox = None
+                        raise UidValidityChanged(f"UIDVALIDITY of {mailbox} changed while reconnecting")
+            except (imaplib.IMAP4.abort, OSError):
+                continue
+            self.log("🔌 Reconnected")
+            return
+        raise error
+
+
+class ReconnectingAsyncImap:
+    """
+    Asyncio version of ReconnectingImap for AsyncImapConnection. Pipelined
+    commands that were in flight when the connection dropped all fail
+    together; the first one reconnects and the others retry on the new
+    connection.
+    """
+
+    def __init__(self, conn, factory, log=None, on_drop=None, retries=RECONNECT_RETRIES):
+        self.conn = conn
+        self.factory = factory
+        self.log = log or (lambda message: None)
+        self.on_drop = on_drop or (lambda error: None)
+        self.retries = retries
+        self.mailbox = None
+        self._failure = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, factory, **kwargs):
+        return cls(await factory(), factory, **kwargs)
+
+    @property
+    def capabilities(self):
+        return self.conn.capabilities
+
+    async def command(self, *args):
+        selecting = args[0].upper() in ('SELECT', 'EXAMINE')
+        if selecting:
+            self.mailbox = None
+        for attempt in range(self.retries + 1):
+            conn = self.conn
+            try:
+                status, data = await conn.command(*args)
+                break
+            except (imaplib.IMAP4.abort, OSError) as e:
+                if attempt == self.retries or (args[0].upper() == 'UID'
+                                               and args[1].upper() in ReconnectingImap.NOT_REPLAYABLE):
+                    raise
+                await self._reconnect(conn, e)
+        if selecting and status == 'OK':
+            self.mailbox = (args, self._uidvalidity(data))
+        return status, data
+
+    async def uid(self, command, *args):
+        return await self.command('UID', command, *args)
+
+    def _uidvalidity(self, untagged):
+        for response in untagged:
+            match = UIDVALIDITY_RE.search(response)
+            if match:
+                return int(match.group(1))
+        return None
+
+    async def _reconnect(self, dropped, error):
+        async with self._lock:
+            if self._failure is not None:
+                raise self._failure
+            if self.conn is not dropped:
+                return  # another in-flight command already reconnected
+            self.on_drop(error)
+            await dropped.logout()
+            for attempt in range(1, self.retries + 1):
+                self.log(f"🔌 Connection lost ({error}); reconnecting ({attempt}/{self.retries})...")
+                await asyncio.sleep(min(BACKOFF_MAX, RECONNECT_DELAY * 2 ** (attempt - 1)))
+                try:
+                    conn = await self.factory()
+                    if self.mailbox is not None:
+                        select, uidvalidity = self.mailbox
+                        status, data = await conn.command(*select)
+                        if status != 'OK':
+                            await conn.logout()
+                            continue
+                        if self._uidvalidity(data) != uidvalidity:
+                            self.mailbox = None
+                            self.conn = conn
+                            self._failure = UidValidityChanged(f"UIDVALIDITY of {select[1]} changed while reconnecting")
+                            raise self._failure
+                except (imaplib.IMAP4.abort, OSError):
+                    continue
+                self.conn = conn
+                self._failure = None
+                self.log("🔌 Reconnected")
+                return
+            self._failure = error
+            raise error
+
+    async def logout(self):
+        await self.conn.logout()
+
+
+class ProgressTracker:
+    """
+    Progress of one job, fed by every worker and read by the UI at its own
+    pace. Throughput is an exponentially smoothed messages/second per folder
+    and overall: each ``advance()`` weighs its rate sample by
+    ``1 - exp(-dt / RATE_TIME_CONSTANT)``, so bursts of chunks finishing
+    together do not make the estimate jump. ``snapshot()`` also reports how
+    long nothing has advanced, which tells a stalled job from a slow one.
+    """
+
+    def __init__(self, time_constant=RATE_TIME_CONSTANT):
+        self.time_constant = time_constant
+        self._lock = threading.Lock()
+        self.start({})
+
+    def start(self, totals):
+        """
+        Begin a job with ``{folder: messages}`` to process.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.started = self.last = now
+            self.folders = {folder: {"done": 0, "total": total, "rate": None, "last": now, "pending": 0}
+                            for folder, total in totals.items()}
+            self.done = 0
+            self.total = sum(totals.values())
+            self.rate = None
+            self.pending = 0
+
+    def _smooth(self, rate, pending, last, now):
+        """
+        Fold ``pending`` messages processed since ``last`` into ``rate`` and
+        return ``(rate, pending, last)``. When no time has passed (several
+        chunks finishing within one clock tick) the messages are carried into
+        the next sample instead of being dropped.
+        """
+        elapsed = now - last
+        if elapsed <= 0:
+            return rate, pending, last
+        sample = pending / elapsed
+        if rate is None:
+            return sample, 0, now
+        weight = 1 - math.exp(-elapsed / self.time_constant)
+        return rate + weight * (sample - rate), 0, now
+
+    def advance(self, folder, count):
+        """
+        Count ``count`` more messages of ``folder`` as processed and return
+        ``(done, total)`` for the whole job.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self.folders.setdefault(folder, {"done": 0, "total": 0, "rate": None, "last": self.started,
+                                                     "pending": 0})
+            entry["done"] += count
+            entry["rate"], entry["pending"], entry["last"] = self._smooth(
+                entry["rate"], entry["pending"] + count, entry["last"], now)
+            self.done += count
+            self.rate, self.pending, self.last = self._smooth(self.rate, self.pending + count, self.last, now)
+            return self.done, self.total
+
+    @staticmethod
+    def _eta(done, total, rate):
+        if not rate or done >= total:
+            return None if done < total else 0
+        return (total - done) / rate
+
+    def snapshot(self):
+        """
+        ``{"done", "total", "rate", "eta", "idle", "folders": {folder:
+        {"done", "total", "rate", "eta"}}}``; rates are messages/second and
+        ``eta``/``idle`` seconds (``eta`` is None until a rate is known).
+        """
+        with self._lock:
+            return {
+                "done": self.done,
+                "total": self.total,
+                "rate": self.rate,
+                "eta": self._eta(self.done, self.total, self.rate),
+                "idle": time.monotonic() - self.last,
+                "folders": {
+                    folder: {"done": entry["done"], "total": entry["total"], "rate": entry["rate"],
+                             "eta": self._eta(entry["done"], entry["total"], entry["rate"])}
+                    for folder, entry in self.folders.items()
+                },
+            }
+
+    def describe(self):
+        """
+        ``12,000/50,000 (24.0%) · 850 emails/s · ETA 44s`` for log lines.
+        """
+        state = self.snapshot()
+        percent = state["done"] / state["total"] * 100 if state["total"] else 100.0
+        rate = f"{state['rate']:,.0f} emails/s" if state["rate"] else "-- emails/s"
+        return f"{state['done']:,}/{state['total']:,} ({percent:.1f}%) · {rate} · ETA {format_duration(state['eta'])}"
+
+
+class ImapThrottled(imaplib.IMAP4.abort):
+    """
+    Gmail kept throttling a command after every backoff retry. Raised as an
+    abort so the connection is dropped and the job can resume later.
+    """
+
+
+class ThrottleController:
+    """
+    AIMD controller for chunk size and concurrency, shared by all workers of
+    one job. Each round of successful commands adds CHUNK_STEP UIDs and one
+    worker slot. A ``[THROTTLED]`` / ``[OVERQUOTA]`` reply, a dropped
+    connection, or a per-UID latency above SLOW_FACTOR times the best seen at
+    the current chunk size halves both. Throttled commands are retried after
+    an exponential backoff with jitter.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, concurrency=POOL_SIZE):
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min(MIN_CHUNK_SIZE, chunk_size)
+        self.max_chunk_size = chunk_size * 4
+        self.concurrency = concurrency
+        self.max_concurrency = concurrency
+        self.active = 0
+        self.latency = None
+        self.best_latency = None
+        self.successes = 0
+        self.throttles = 0
+        self.events = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, blocking=True):
+        """
+        Take a worker slot, waiting while ``concurrency`` are busy unless
+        ``blocking`` is false. Returns True when a slot was taken.
+        """
+        with self._cond:
+            while self.active >= self.concurrency:
+                if not blocking:
+                    return False
+                self._cond.wait(0.5)
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def record(self, seconds, size=1):
+        """
+        Feed the duration of a successful command covering ``size`` UIDs.
+        """
+        cost = seconds / max(size, 1)
+        with self._cond:
+            self.throttles = 0
+            self.successes += 1
+            self.latency = cost if self.latency is None else 0.8 * self.latency + 0.2 * cost
+            self.best_latency = cost if self.best_latency is None else min(self.best_latency, cost)
+            if self.successes < self.concurrency:
+                return
+            self.successes = 0
+            if self.latency > SLOW_FACTOR * self.best_latency:
+                self._decrease()
+            elif self.chunk_size < self.max_chunk_size or self.concurrency < self.max_concurrency:
+                self.chunk_size = min(self.max_chunk_size, self.chunk_size + CHUNK_STEP)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                self.latency = self.best_latency = None
+                self._cond.notify_all()
+
+    def throttled(self):
+        """
+        Register a throttling reply and return the backoff delay in seconds:
+        exponential in the number of consecutive throttles, with jitter so
+        parallel workers do not retry in lockstep.
+        """
+        with self._cond:
+            self.events += 1
+            self.throttles += 1
+            self.successes = 0
+            self._decrease()
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.throttles - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _decrease(self):
+        self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+        self.concurrency = max(1, self.concurrency // 2)
+        self.latency = self.best_latency = None
+
+
+class GmailCleanupEngine:
+    """
+    UI-free Gmail operations: connect, list folders, scan, Move to Trash and
+    permanent delete. Output is reported through the ``log(message)`` and
+    ``progress(done, total)`` callbacks, which are called from worker
+    threads. ``stop()`` may be called from any thread. Every IMAP command is
+    recorded in ``metrics`` (an ImapMetrics), and analyze and delete report
+    throughput and ETA through ``tracker`` (a ProgressTracker).
+    """
+
+    def __init__(self, email, password, log=None, progress=None, host=IMAP_HOST, port=IMAP_PORT,
+                 pool_size=POOL_SIZE, chunk_size=CHUNK_SIZE, split_size=SPLIT_SIZE, pipeline_depth=0):
+        self.credentials = (email, password)
+        self.log = log or (lambda message: None)
+        self.progress = progress or (lambda done, total: None)
+        self.host = host
+        self.port = port
+        self.imap = None
+        self.pool = None
+        self.index = None
+        self.capabilities = set()
+        self.is_running = False
+        self.chunk_size = chunk_size
+        self.pool_size = pool_size
+        self.split_size = split_size
+        self.pipeline_depth = pipeline_depth
+        self.ssl_context = None
+        self.throttle = None
+        self.metrics = ImapMetrics()
+        self.tracker = ProgressTracker()
+
+    @property
+    def email(self):
+        return self.credentials[0]
+
+    def connect(self):
+        """
+        Log in, detect capabilities and set up the connection pool. Raises
+        ``imaplib.IMAP4.error`` when authentication fails.
+        """
+        imap = self._open_reconnecting_connection()
+        self.capabilities = self._detect_capabilities(imap)
+        self.imap = imap
+        self.pool = ImapConnectionPool(self._open_reconnecting_connection, self.pool_size)
+        return imap
+
+    def _open_reconnecting_connection(self):
+        return ReconnectingImap(self._open_connection, log=self.log, on_drop=self._connection_dropped)
+
+    def _connection_dropped(self, error):
+        """
+        A dropped session (often a ``BYE`` while Gmail is overloaded) counts as
+        throttling for a running deletion.
+        """
+        self.metrics.dropped()
+        if self.throttle is not None:
+            self.throttle.throttled()
+
+    def _open_connection(self):
+        email, password = self.credentials
+        imap = MeteredIMAP4_SSL(self.host, self.port, ssl_context=self.ssl_context, metrics=self.metrics)
+        imap.login(email, password)
+        if 'QRESYNC' in self.capabilities:
+            status, _ = imap._simple_command('ENABLE', 'QRESYNC')
+            if status != 'OK':
+                self.capabilities.discard('QRESYNC')
+        return imap
+
+    def list_folders(self):
+        """
+        Return the selectable folder names, or None if LIST failed.
+        """
+        status, folders = self.imap.list()
+        if status != "OK":
+            return None
+        names = [folder.decode().split('"')[-2] for folder in folders]
+        return [name for name in names if name not in ["[Gmail]", "Notes"]]
+
+    def stop(self):
+        self.is_running = False
+
+    def scan(self, folders, criteria="ALL", use_index=False):
+        """
+        Count the emails in ``folders`` (only those matching ``criteria``
+        when it is not ``ALL``). Returns ``{"folders": {name: stats or None},
+        "total": n, "size": bytes, "stopped": bool}``.
+        """
+        index = self._get_index(use_index) if criteria == "ALL" else None
+        index_items = ("UIDNEXT", "UIDVALIDITY")
+        if 'CONDSTORE' in self.capabilities:
+            index_items += ("HIGHESTMODSEQ",)
+        status_items = self._status_items(index_items if index else ())
+
+        def scan_folder(folder):
+            with self.pool.connection() as imap:
+                return self._folder_status(imap, folder, status_items)
+
+        def search_folder(folder):
+            with self.pool.connection() as imap:
+                if self._select_state(imap, folder) is None:
+                    return None
+                return {"MESSAGES": self._search_count(imap, criteria)}
+
+        def index_folder(folder):
+            with self.pool.connection() as imap:
+                self._sync_folder_index(imap, index, folder)
+
+        self.throttle = ThrottleController(self.chunk_size, self.pool_size)
+        self.is_running = True
+        try:
+            stats = {}
+            if criteria != "ALL":
+                self.log(f"🔎 Filter: {criteria}")
+                with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+                    futures = {executor.submit(self._run_if_active, search_folder, folder): folder
+                               for folder in folders}
+                    for future in as_completed(futures):
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            self.log(f"❌ Failed to search {futures[future]}: {e}")
+                            continue
+                        if result is not None:
+                            stats[futures[future]] = result
+            elif 'LIST-STATUS' in self.capabilities:
+                with self.pool.connection() as imap:
+                    stats = self._list_status(imap, status_items)
+                self.log(f"⚡ LIST-STATUS returned counts for {len(stats)} folders in one round trip")
+            # A folder whose filtered SEARCH failed stays out of stats: an
+            # unfiltered STATUS would report all of its emails as matching.
+            missing = [folder for folder in folders if folder not in stats] if criteria == "ALL" else []
+            if missing:
+                with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+                    futures = {executor.submit(self._run_if_active, scan_folder, folder): folder
+                               for folder in missing}
+                    for future in as_completed(futures):
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            self.log(f"❌ Failed to scan {futures[future]}: {e}")
+                            continue
+                        if result is not None:
+                            stats[futures[future]] = result
+            if index is not None:
+                stale = [folder for folder in folders
+                         if folder in stats and not self._index_is_fresh(index, folder, stats[folder])]
+                if stale:
+                    self.log(f"💾 Updating local index for {len(stale)} folders...")
+                    with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+                        futures = {executor.submit(self._run_if_active, index_folder, folder): folder
+                                   for folder in stale}
+                        for future in as_completed(futures):
+                            try:
+                                future.result()
+                            except Exception as e:
+                                self.log(f"❌ Failed to index {futures[future]}: {e}")
+                for folder in folders:
+                    if folder in stats and self._index_is_fresh(index, folder, stats[folder]):
+                        stats[folder].update(index.folder_summary(folder))
+            stopped = not self.is_running
+            if stopped:
+                self.log("⏹️ Scan stopped by user")
+
+            total_emails = 0
+            total_size = 0
+            for folder in folders:
+                folder_stats = stats.get(folder)
+                if folder_stats is None:
+                    self.log(f"❌ Failed to access folder: {folder}")
+                    continue
+                count = folder_stats.get("MESSAGES", 0)
+                total_emails += count
+                self.metrics.processed(count)
+                if criteria != "ALL":
+                    self.log(f"📁 {folder}: {count:,} matching emails")
+                    continue
+                details = f"{folder_stats.get('UNSEEN', 0):,} unread"
+                if "SIZE" in folder_stats:
+                    total_size += folder_stats["SIZE"]
+                    details += f", {format_bytes(folder_stats['SIZE'])}"
+                self.log(f"📁 {folder}: {count:,} emails ({details})")
+            return {
+                "criteria": criteria,
+                "folders": {folder: stats.get(folder) for folder in folders},
+                "total": total_emails,
+                "size": total_size,
+                "stopped": stopped,
+            }
+        finally:
+            self.is_running = False
+
+    def analyze(self, folders, criteria="ALL", top=REPORT_TOP):
+        """
+        Build a MailboxReport of where the bytes are in ``folders`` (only the
+        messages matching ``criteria`` when it is not ``ALL``). Size, date,
+        labels and the From / List-Id headers are streamed with bulk UID
+        FETCHes of ANALYZE_FETCH_SIZE messages, and large folders are split
+        into SPLIT_SIZE ranges across the connection pool. Messages found in
+        several folders are counted once, and folders that ``[Gmail]/All
+        Mail`` already contains are skipped when it is selected.
+        """
+        if '[Gmail]/All Mail' in folders:
+            covered = [folder for folder in folders
+                       if folder not in ('[Gmail]/All Mail', '[Gmail]/Trash', '[Gmail]/Spam')]
+            if covered:
+                self.log(f"📁 {', '.join(covered)}: already counted through [Gmail]/All Mail")
+                folders = [folder for folder in folders if folder not in covered]
+        report = MailboxReport(top, dedupe=len(folders) > 1)
+        self.tracker.start({})
+        self.throttle = ThrottleController(ANALYZE_FETCH_SIZE, self.pool_size)
+        if criteria != "ALL":
+            self.log(f"🔎 Filter: {criteria}")
+
+        def plan_folder(folder):
+            email_uids = array('I')
+            try:
+                with self.pool.connection() as imap:
+                    state = self._select_state(imap, folder)
+                    if state is None:
+                        self.log(f"❌ Failed to access folder: {folder}")
+                        report.failed.append(folder)
+                        return array('I')
+                    for window in self._iter_uid_windows(imap, criteria, state["uidnext"]):
+                        email_uids.extend(window)
+            except Exception as e:
+                self.log(f"❌ Failed to search folder {folder}: {e}")
+                report.failed.append(folder)
+                return array('I')
+            self.log(f"📁 {folder}: {len(email_uids):,} emails to analyze")
+            return email_uids
+
+        def analyze_range(folder, email_uids):
+            with self.pool.connection() as imap:
+                if self._select_state(imap, folder) is None:
+                    raise imaplib.IMAP4.error(f"cannot select {folder}")
+                for part in UidSet(email_uids).split(max_size=ANALYZE_FETCH_SIZE):
+                    if not self.is_running:
+                        return
+                    status, data = self._uid(imap, 'FETCH', str(part), ANALYZE_FETCH_ITEMS)
+                    if status != 'OK':
+                        raise imaplib.IMAP4.error(f"FETCH {part} failed")
+                    for meta, literals in iter_fetch_records(data):
+                        record = parse_message_metadata(meta)
+                        if record["uid"] is not None:
+                            report.add(folder, record, literals[0] if literals else b'')
+                    done, total = self.tracker.advance(folder, len(part))
+                    self.metrics.processed(len(part))
+                    self.progress(done, total)
+
+        self.is_running = True
+        try:
+            with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+                plans = list(executor.map(lambda folder: self._run_if_active(plan_folder, folder) or [], folders))
+                self.tracker.start({folder: len(email_uids) for folder, email_uids in zip(folders, plans)})
+                futures = {}
+                for folder, email_uids in zip(folders, plans):
+                    for start in range(0, len(email_uids), self.split_size):
+                        future = executor.submit(self._run_if_active, analyze_range, folder,
+                                                 email_uids[start:start + self.split_size])
+                        futures[future] = folder
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.log(f"❌ Failed to analyze {futures[future]}: {e}")
+                        if futures[future] not in report.failed:
+                            report.failed.append(futures[future])
+            report.stopped = not self.is_running
+            if report.stopped:
+                self.log("⏹️ Analysis stopped by user")
+            self.log(f"📊 {report.messages:,} emails, {format_bytes(report.size)}")
+            for group, title in (("senders", "Top senders"), ("domains", "Top domains"),
+                                 ("lists", "Top mailing lists"), ("years", "By year"), ("labels", "Top labels")):
+                rows = report.ranking(group, 5)
+                if rows:
+                    self.log(f"   {title}:")
+                    for key, count, size in rows:
+                        self.log(f"   └─ {key}: {count:,} emails, {format_bytes(size)}")
+            return report
+        finally:
+            self.is_running = False
+
+    def plan(self, folders, permanent=False, criteria="ALL", use_index=False):
+        """
+        Dry run of delete(): resolve the exact UIDs it would remove from
+        ``folders`` and how many bytes they take, without changing anything.
+        Sizes come from the metadata index when it is used, otherwise from
+        bulk ``UID FETCH (RFC822.SIZE)`` across the pool. As in delete(), a
+        message selected through several folders is planned once (see
+        _dedupe_plans). A folder that cannot be searched or sized is left out
+        of the plan and listed in its ``failed``. Returns a DeletionPlan for
+        execute_plan(), or None when stopped.
+        """
+        index = self._get_index(use_index) if criteria == "ALL" else None
+        plan = DeletionPlan(self.email, "permanent" if permanent else "trash", criteria)
+        sizes = {}
+        sizes_lock = threading.Lock()
+        if criteria != "ALL":
+            self.log(f"🔎 Filter: {criteria}")
+        self.throttle = ThrottleController(ANALYZE_FETCH_SIZE, self.pool_size)
+
+        def plan_folder(folder):
+            try:
+                with self.pool.connection() as imap:
+                    state = self._select_state(imap, folder)
+                    if state is None or (index is not None and self._sync_folder_index(imap, index, folder) is None):
+                        self.log(f"❌ Failed to access folder: {folder}")
+                        plan.failed.append(folder)
+                        return None
+                    if index is not None:
+                        sizes[folder] = index.folder_summary(folder)["SIZE"]
+                        return state["uidvalidity"], index.uids(folder)
+                    email_uids = array('I')
+                    for window in self._iter_uid_windows(imap, criteria, state["uidnext"]):
+                        email_uids.extend(window)
+                    return state["uidvalidity"], email_uids
+            except Exception as e:
+                self.log(f"❌ Failed to search folder {folder}: {e}")
+                plan.failed.append(folder)
+                return None
+
+        def size_range(folder, email_uids):
+            total = 0
+            with self.pool.connection() as imap:
+                if self._select_state(imap, folder) is None:
+                    raise imaplib.IMAP4.error(f"cannot select {folder}")
+                for part in UidSet(email_uids).split(max_size=ANALYZE_FETCH_SIZE):
+                    if not self.is_running:
+                        return
+                    status, data = self._uid(imap, 'FETCH', str(part), '(UID RFC822.SIZE)')
+                    if status != 'OK':
+                        raise imaplib.IMAP4.error(f"FETCH {part} failed")
+                    total += sum(parse_message_metadata(meta)["size"] or 0 for meta, _ in iter_fetch_records(data))
+            with sizes_lock:
+                sizes[folder] = sizes.get(folder, 0) + total
+
+        self.is_running = True
+        try:
+            with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+                planned = list(executor.map(lambda folder: self._run_if_active(plan_folder, folder), folders))
+                if len(folders) > 1 and 'X-GM-EXT-1' in self.capabilities and self.is_running:
+                    kept, dropped = self._dedupe_plans(executor, folders,
+                                                       [result[1] if result else [] for result in planned], index)
+                    planned = [result and (result[0], email_uids) for result, email_uids in zip(planned, kept)]
+                    for folder, email_uids in zip(folders, dropped):
+                        if email_uids:
+                            if index is not None:
+                                sizes[folder] -= index.size(folder, email_uids)
+                            self.log(f"🔗 {folder}: {len(email_uids):,} emails are also selected through "
+                                     f"another label, not planning them here")
+                    plan.duplicates = sum(len(email_uids) for email_uids in dropped)
+                    if plan.duplicates:
+                        self.log(f"🔗 Deduplicated by X-GM-MSGID: {plan.duplicates:,} emails planned once")
+                futures = {}
+                for folder, result in zip(folders, planned):
+                    if result is None or folder in sizes:
+                        continue
+                    for start in range(0, len(result[1]), self.split_size):
+                        future = executor.submit(self._run_if_active, size_range, folder,
+                                                 result[1][start:start + self.split_size])
+                        futures[future] = folder
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.log(f"❌ Failed to size {futures[future]}: {e}")
+                        if futures[future] not in plan.failed:
+                            plan.failed.append(futures[future])
+            if not self.is_running:
+                self.log("⏹️ Planning stopped by user")
+                return None
+            for folder, result in zip(folders, planned):
+                if result is not None and folder not in plan.failed:
+                    plan.add(folder, result[0], result[1], sizes.get(folder, 0))
+                    self.metrics.processed(len(result[1]))
+                    self.log(f"📝 {folder}: {len(result[1]):,} emails, {format_bytes(sizes.get(folder, 0))}")
+            if plan.failed:
+                self.log(f"⚠️ Not planned: {', '.join(plan.failed)}")
+            self.log(f"📝 Plan {plan.checksum}: {plan.messages:,} emails, {format_bytes(plan.size)} to {plan.mode}")
+            return plan
+        finally:
+            self.is_running = False
+
+    def execute_plan(self, plan, use_index=False, archive=None):
+        """
+        Delete exactly the UIDs of a DeletionPlan: no new search is made, and
+        nothing is deleted if any planned folder's UIDVALIDITY changed since
+        (UidValidityChanged is raised). Returns what delete() returns.
+        """
+        if plan.email.lower() != self.email.lower():
+            raise ValueError(f"the plan was made for {plan.email}, not {self.email}")
+        return self.delete(list(plan.folders), plan.mode == "permanent", plan.criteria, use_index, plan=plan,
+                           archive=archive)
+
+    def delete(self, folders, permanent=False, criteria="ALL", use_index=False, local_filter=None, job=None,
+               plan=None, archive=None):
+        """
+        Move the emails in ``folders`` to Trash, or delete them forever when
+        ``permanent`` is set, resuming an unfinished job with the same mode and
+        criteria. ``local_filter(record, header)`` further narrows the server
+        search for conditions IMAP cannot express (see _filter_uids), and
+        ``job`` names a journal of its own (see DeletionJournal.for_account).
+        ``plan`` replaces the search with a DeletionPlan (see execute_plan).
+        With an ``archive`` (see gmail_archive.open_archive), every chunk is
+        first fetched into it and synced; only the archived messages of the
+        chunk are then deleted, in the same pass.
+        Returns ``{"deleted": n, "folders": {name: n}, "stopped":
+        bool, "failed": bool, "resumed": bool, "throttled": n, "duplicates": n}``.
+        When several folders are selected, a message with more than one of
+        their labels is only deleted once (see _dedupe_plans).
+        """
+        self.tracker.start({})
+        index = self._get_index(use_index) if criteria == "ALL" and local_filter is None and plan is None else None
+        criteria_key = criteria
+        if plan is not None:
+            self.log(f"📝 Executing plan {plan.checksum}: {plan.messages:,} emails, {format_bytes(plan.size)}")
+            criteria_key = f"PLAN {plan.checksum}"
+        elif criteria != "ALL":
+            self.log(f"🔎 Filter: {criteria}")
+        if local_filter is not None:
+            self.log(f"🔬 Local filter: {local_filter}")
+            criteria_key = f"{criteria} WHERE {local_filter}"
+        if archive is not None:
+            self.log(f"📦 Archiving every chunk to {archive.path} before deleting it")
+        self.throttle = throttle = ThrottleController(self.chunk_size, self.pool_size * (self.pipeline_depth or 1))
+        mode = "permanent" if permanent else "trash"
+        journal = DeletionJournal.for_account(self.email, job)
+        resumed = journal.unfinished and journal.mode == mode and journal.criteria == criteria_key
+        if resumed:
+            started = time.strftime("%Y-%m-%d %H:%M", time.localtime(journal.started))
+            self.log(f"♻️ Resuming unfinished deletion job from {started}")
+        else:
+            if journal.unfinished:
+                self.log(f"⚠️ Discarding unfinished {journal.mode} job (different delete mode or filter)")
+            journal.start(mode, criteria_key)
+
+        unpurged = []
+        unplanned = []
+        stale = []
+
+        def plan_folder(folder):
+            with self.pool.connection() as imap:
+                state = self._select_state(imap, folder)
+                if state is None:
+                    self.log(f"❌ Failed to access folder: {folder}")
+                    unplanned.append(folder)
+                    return []
+                if plan is not None and plan.folders[folder]["uidvalidity"] != state["uidvalidity"]:
+                    self.log(f"❌ {folder}: UIDVALIDITY changed since the plan was made")
+                    stale.append(folder)
+                    return []
+                email_uids = journal.remaining(folder, state["uidvalidity"])
+                if email_uids is not None:
+                    planned = len(journal.plans[folder][1])
+                    self.log(f"♻️ {folder}: {planned - len(email_uids):,}/{planned:,} emails already committed")
+                    return email_uids
+                if plan is not None:
+                    email_uids = array('I', plan.folders[folder]["uids"])
+                elif index is not None:
+                    if self._sync_folder_index(imap, index, folder) is None:
+                        self.log(f"❌ Failed to access folder: {folder}")
+                        unplanned.append(folder)
+                        return []
+                    email_uids = index.uids(folder)
+                else:
+                    email_uids = array('I')
+                    try:
+                        for window in self._iter_uid_windows(imap, criteria, state["uidnext"]):
+                            email_uids.extend(window)
+                    except imaplib.IMAP4.abort:
+                        raise
+                    except imaplib.IMAP4.error:
+                        self.log(f"❌ Failed to search folder: {folder}")
+                        unplanned.append(folder)
+                        return []
+                if local_filter is not None and email_uids:
+                    matched = len(email_uids)
+                    try:
+                        email_uids = self._filter_uids(imap, email_uids, local_filter)
+                    except imaplib.IMAP4.abort:
+                        raise
+                    except imaplib.IMAP4.error:
+                        self.log(f"❌ Failed to filter folder: {folder}")
+                        unplanned.append(folder)
+                        return []
+                    if not self.is_running:
+                        return []
+                    self.log(f"🔬 {folder}: {len(email_uids):,} of {matched:,} emails pass the local filter")
+                journal.plan(folder, state["uidvalidity"], email_uids)
+                if not email_uids:
+                    self.log(f"   └─ No emails to delete in {folder}")
+                else:
+                    self.log(f"🗑️ {folder}: {len(email_uids):,} emails to delete")
+                return email_uids
+
+        def commit_chunk(folder, chunk, msg_ids, kept):
+            """
+            ``kept`` holds the UIDs of the chunk that are still on the server
+            (not archived, or their COPY/MOVE/STORE failed); they stay in the
+            index so later index-backed jobs still see them.
+            """
+            journal.commit(folder, chunk, msg_ids)
+            if index is not None:
+                kept = set(kept)
+                index.remove_messages(folder, [uid for uid in chunk if uid not in kept] if kept else chunk)
+            done_total, total = self.tracker.advance(folder, len(chunk))
+            self.metrics.processed(len(chunk))
+            self.log(f"   └─ Progress: {self.tracker.describe()}")
+            self.progress(done_total, total)
+
+        # Gmail message IDs labelled Trash per folder; purged once after the
+        # folder's last work unit, since each purge reads the IDs of all of Trash.
+        trash_msgids = {}
+
+        def delete_range(folder, email_uids):
+            with self.pool.connection() as imap:
+                quoted_folder = self._quote_folder(folder)
+                status, _ = self._throttled(lambda: imap.select(quoted_folder), "SELECT")
+                if status != "OK":
+                    self.log(f"❌ Failed to access folder: {folder}")
+                    return 0
+                processed = 0
+                start = 0
+                while start < len(email_uids):
+                    with throttle.slot():
+                        if not self.is_running:
+                            break
+                        chunk = email_uids[start:start + throttle.chunk_size]
+                        start += len(chunk)
+                        targets = chunk
+                        kept = []
+                        if archive is not None:
+                            targets = self._archive_batch(imap, archive, folder, journal.plans[folder][0], chunk)
+                            if len(targets) < len(chunk):
+                                self.log(f"   └─ ⚠️ {folder}: {len(chunk) - len(targets):,} emails were not archived, keeping them.")
+                                archived = set(targets)
+                                kept = [uid for uid in chunk if uid not in archived]
+                        if permanent:
+                            msg_ids = self._prepare_permanent_delete_batch(imap, targets, kept)
+                            trash_msgids[folder].extend(msg_ids)
+                            done = len(msg_ids)
+                            if done < len(targets):
+                                self.log(f"   └─ ⚠️ {folder}: {len(targets) - done:,} emails failed or were already removed, skipping.")
+                        else:
+                            done = self._move_to_trash_batch(imap, targets, kept)
+                            if done < len(targets):
+                                self.log(f"   └─ ⚠️ {folder}: failed to move {len(targets) - done:,} emails to Trash, skipping.")
+                        processed += done
+                        commit_chunk(folder, chunk, msg_ids if permanent else None, kept)
+
+                if not permanent and 'MOVE' not in self.capabilities:
+                    imap.expunge()
+                return processed
+
+        def purge_folder(folder):
+            msg_ids = trash_msgids.pop(folder, None)
+            if not msg_ids:
+                return
+            try:
+                with self.pool.connection() as imap:
+                    purged = self._delete_permanently(imap, msg_ids, self._quote_folder(folder))
+            except Exception as e:
+                self.log(f"❌ Error while purging {folder} from Trash: {e}")
+                purged = False
+            if purged:
+                journal.purged(folder, msg_ids)
+            else:
+                unpurged.append(folder)
+
+        async def delete_range_pipelined(conn, folder, email_uids):
+            """
+            Same work as delete_range on an asyncio connection. Up to
+            pipeline_depth chunks are in flight at once, so their commands
+            share round trips instead of waiting for each other.
+            """
+            quoted_folder = self._quote_folder(folder)
+            status, _ = await self._throttled_async(lambda: conn.command('SELECT', quoted_folder), "SELECT")
+            if status != "OK":
+                self.log(f"❌ Failed to access folder: {folder}")
+                return 0
+            window = asyncio.Semaphore(self.pipeline_depth)
+            errors = []
+
+            async def delete_chunk(chunk):
+                try:
+                    targets = chunk
+                    kept = []
+                    if archive is not None:
+                        targets = await self._archive_batch_async(conn, archive, folder, journal.plans[folder][0], chunk)
+                        if len(targets) < len(chunk):
+                            self.log(f"   └─ ⚠️ {folder}: {len(chunk) - len(targets):,} emails were not archived, keeping them.")
+                            archived = set(targets)
+                            kept = [uid for uid in chunk if uid not in archived]
+                    if permanent:
+                        msg_ids = await self._prepare_permanent_delete_batch_async(conn, targets, kept)
+                        trash_msgids[folder].extend(msg_ids)
+                        done = len(msg_ids)
+                        if done < len(targets):
+                            self.log(f"   └─ ⚠️ {folder}: {len(targets) - done:,} emails failed or were already removed, skipping.")
+                    else:
+                        done = await self._move_to_trash_batch_async(conn, targets, kept)
+                        if done < len(targets):
+                            self.log(f"   └─ ⚠️ {folder}: failed to move {len(targets) - done:,} emails to Trash, skipping.")
+                    commit_chunk(folder, chunk, msg_ids if permanent else None, kept)
+                    return done
+                except Exception as e:
+                    errors.append(e)
+                    raise
+                finally:
+                    throttle.release()
+                    window.release()
+
+            tasks = []
+            start = 0
+            while start < len(email_uids):
+                await window.acquire()
+                while not throttle.acquire(blocking=False):
+                    await asyncio.sleep(0.05)
+                if not self.is_running or errors:
+                    throttle.release()
+                    window.release()
+                    break
+                chunk = email_uids[start:start + throttle.chunk_size]
+                start += len(chunk)
+                tasks.append(asyncio.ensure_future(delete_chunk(chunk)))
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            if not permanent and 'MOVE' not in self.capabilities:
+                await conn.command('EXPUNGE')
+            return sum(results)
+
+        async def purge_folder_pipelined(conn, folder):
+            msg_ids = trash_msgids.pop(folder, None)
+            if not msg_ids:
+                return
+            if await self._delete_permanently_async(conn, msg_ids):
+                journal.purged(folder, msg_ids)
+            else:
+                unpurged.append(folder)
+
+        total_deleted = 0
+        duplicates = 0
+        deleted_per_folder = {}
+        remaining = {}
+        failed = False
+
+        def unit_done(folder, count, error=None):
+            """
+            Account for one finished work unit; returns True when it was the
+            folder's last, so the caller can purge the folder's Trash.
+            """
+            nonlocal total_deleted, failed
+            deleted_per_folder[folder] = deleted_per_folder.get(folder, 0) + (count or 0)
+            if error is not None:
+                failed = True
+                self.log(f"❌ Error while deleting from {folder}: {error}")
+            remaining[folder] -= 1
+            if not remaining[folder]:
+                count = deleted_per_folder[folder]
+                total_deleted += count
+                self.log(f"   └─ ✅ Deleted {count:,} emails from {folder}")
+                return True
+            return False
+
+        self.is_running = True
+        try:
+            with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+                plans = list(executor.map(lambda folder: self._run_if_active(plan_folder, folder) or [], folders))
+                if stale:
+                    journal.finish()
+                    raise UidValidityChanged(f"{', '.join(stale)} changed since the plan was made "
+                                             f"(UIDVALIDITY), nothing was deleted: create a new plan")
+                if len(folders) > 1 and 'X-GM-EXT-1' in self.capabilities and self.is_running:
+                    plans, dropped = self._dedupe_plans(executor, folders, plans, index)
+                    for folder, email_uids in zip(folders, dropped):
+                        if email_uids:
+                            journal.commit(folder, email_uids)
+                            self.log(f"🔗 {folder}: {len(email_uids):,} emails are also selected through "
+                                     f"another label, skipping them here")
+                    duplicates = sum(len(email_uids) for email_uids in dropped)
+                    if duplicates:
+                        self.log(f"🔗 Deduplicated by X-GM-MSGID: {duplicates:,} duplicate operations avoided")
+                self.tracker.start({folder: len(email_uids) for folder, email_uids in zip(folders, plans)})
+                units = []
+                for folder, email_uids in zip(folders, plans):
+                    carried_msgids = journal.pending_msgids.get(folder, ()) if permanent else ()
+                    trash_msgids[folder] = list(carried_msgids)
+                    for start in range(0, max(len(email_uids), 1 if carried_msgids else 0), self.split_size):
+                        units.append((folder, email_uids[start:start + self.split_size]))
+                        remaining[folder] = remaining.get(folder, 0) + 1
+                if units:
+                    self.log(f"⚡ {len(units)} work units across {len(remaining)} folders on up to {self.pool_size} connections")
+
+                if self.pipeline_depth:
+                    self.log(f"⚡ Pipelining up to {self.pipeline_depth} chunks per connection")
+                    self._run_pipelined(delete_range_pipelined, units, unit_done,
+                                        purge_folder_pipelined if permanent else None)
+                else:
+                    futures = {executor.submit(self._run_if_active, delete_range, *unit): unit[0] for unit in units}
+                    purges = []
+                    for future in as_completed(futures):
+                        folder = futures[future]
+                        try:
+                            finished = unit_done(folder, future.result())
+                        except Exception as e:
+                            finished = unit_done(folder, 0, e)
+                        if finished and permanent:
+                            purges.append(executor.submit(purge_folder, folder))
+                    for purge in purges:
+                        purge.result()
+                if self.is_running:  # after a stop the remaining IDs stay pending in the journal
+                    unpurged.extend(folder for folder, msg_ids in trash_msgids.items() if msg_ids)
+            failed = failed or bool(unpurged) or bool(unplanned)
+            stopped = not self.is_running
+            if stopped:
+                self.log("⏹️ Deletion stopped by user")
+                self.log("💡 Run the deletion again later to resume from the last committed chunk")
+            elif failed:
+                self.log("💡 Run the deletion again to resume the failed folders from the last committed chunk")
+            else:
+                journal.finish()
+            return {
+                "mode": mode,
+                "criteria": criteria,
+                "deleted": total_deleted,
+                "folders": deleted_per_folder,
+                "stopped": stopped,
+                "failed": failed,
+                "resumed": resumed,
+                "throttled": throttle.events,
+                "duplicates": duplicates,
+            }
+        finally:
+            journal.close()
+            self.is_running = False
+
+    def close(self):
+        self.is_running = False
+        if self.pool:
+            self.pool.close()
+        if self.index:
+            self.index.close()
+        if self.imap:
+            try:
+                self.imap.logout()
+            except Exception:
+                pass
+
+    def _get_index(self, enabled):
+        """
+        Return the account's metadata index when ``enabled``.
+        """
+        if not enabled:
+            return None
+        if self.index is None:
+            self.index = MetadataIndex.for_account(self.email)
+            self.log(f"💾 Using local index: {self.index.path}")
+        return self.index
+
+    def _dedupe_plans(self, executor, folders, plans, index=None):
+        """
+        Keep every Gmail message in the plan of one folder only. Labels are
+        views of the same message and moving it to Trash from any of them
+        removes it from all, so the X-GM-MSGIDs of the planned UIDs are
+        collected (from the index when enabled, otherwise with bulk FETCHes)
+        and each folder drops the messages an earlier folder already covers.
+        ``[Gmail]/All Mail`` goes first, so when it is selected every message
+        is handled from its single SELECT. Returns the new plans and the
+        dropped UIDs, both in folder order.
+        """
+        def message_ids(folder, email_uids):
+            uids, msgids = array('I'), array('Q')
+            if index is not None:
+                for part in UidSet(email_uids).split(max_size=INDEX_FETCH_SIZE):
+                    known = index.msgids(folder, part)
+                    uids.extend(part)
+                    msgids.extend(known.get(uid) or 0 for uid in part)
+                return uids, msgids
+            with self.pool.connection() as imap:
+                if self._select_state(imap, folder) is None:
+                    raise imaplib.IMAP4.error(f"cannot select {folder}")
+                for part in UidSet(email_uids).split(max_size=INDEX_FETCH_SIZE):
+                    found = self._fetch_msgids(imap, str(part))
+                    if found is None:
+                        raise imaplib.IMAP4.error("FETCH X-GM-MSGID failed")
+                    uids.extend(part)
+                    msgids.extend(int(found.get(uid, 0)) for uid in part)
+            return uids, msgids
+
+        futures = [executor.submit(self._run_if_active, message_ids, folder, email_uids) if email_uids else None
+                   for folder, email_uids in zip(folders, plans)]
+        plans = list(plans)
+        dropped = [array('I') for _ in folders]
+        seen = array('Q')
+        for position in sorted(range(len(folders)), key=lambda position: folders[position] != '[Gmail]/All Mail'):
+            if futures[position] is None:
+                continue
+            try:
+                result = futures[position].result()
+            except Exception as e:
+                self.log(f"⚠️ Could not read message IDs in {folders[position]}, not deduplicating it: {e}")
+                continue
+            if result is None:
+                continue
+            uids, msgids = result
+            kept = array('I')
+            for uid, msgid in zip(uids, msgids):
+                found = bisect.bisect_left(seen, msgid)
+                if msgid and found < len(seen) and seen[found] == msgid:
+                    dropped[position].append(uid)
+                else:
+                    kept.append(uid)
+            plans[position] = kept
+            seen = array('Q', sorted(seen + array('Q', (msgid for msgid in msgids if msgid))))
+        return plans, dropped
+
+    def _detect_capabilities(self, imap):
+        """
+        Return the server's post-login CAPABILITY list as an upper-case set.
+        Servers often advertise extensions such as MOVE only after LOGIN, so the
+        greeting capabilities cached by imaplib are only used as a fallback.
+        """
+        try:
+            status, data = imap.capability()
+            if status == 'OK' and data and data[0]:
+                return set(data[0].decode(errors='ignore').upper().split())
+        except imaplib.IMAP4.error:
+            pass
+        return {cap.upper() for cap in imap.capabilities}
+
+    def _quote_folder(self, folder):
+        return f'"{folder}"' if any(c in folder for c in ['/', ' ', '\\']) else folder
+
+    def _run_if_active(self, func, *args):
+        """
+        Run a queued worker task unless STOP was pressed while it was waiting.
+        """
+        if not self.is_running:
+            return None
+        return func(*args)
+
+    def _uid(self, imap, command, *args):
+        """
+        ``imap.uid()`` under the job's throttle controller (see _throttled).
+        Latency is only recorded for explicit UID sets, not SEARCH or ``1:*``.
+        """
+        size = (uid_set_size(args[0]) if command != 'SEARCH' and args and isinstance(args[0], str)
+                and '*' not in args[0] else 0)
+        return self._throttled(lambda: imap.uid(command, *args), f"UID {command}", size)
+
+    async def _uid_async(self, conn, command, *args):
+        """
+        Asyncio version of _uid.
+        """
+        size = (uid_set_size(args[0]) if command != 'SEARCH' and args and isinstance(args[0], str)
+                and '*' not in args[0] else 0)
+        return await self._throttled_async(lambda: conn.uid(command, *args), f"UID {command}", size)
+
+    def _throttled(self, call, name, size=0):
+        """
+        Run ``call()`` under the job's throttle controller: the latency of
+        successful commands is recorded for ``size`` UIDs, and
+        ``[THROTTLED]``-style replies are retried after a backoff. Raises
+        ImapThrottled when retries run out.
+        """
+        throttle = self.throttle
+        if throttle is None:
+            return call()
+        for _ in range(THROTTLE_RETRIES):
+            started = time.monotonic()
+            status, data = call()
+            if status == 'OK':
+                if size:
+                    throttle.record(time.monotonic() - started, size)
+                return status, data
+            if not any(THROTTLED_RE.search(item) for item in data if isinstance(item, bytes)):
+                return status, data
+            deadline = time.monotonic() + self._back_off(throttle, name)
+            while self.is_running and time.monotonic() < deadline:
+                time.sleep(min(0.1, max(0.0, deadline - time.monotonic())))
+            if not self.is_running:
+                break
+        raise ImapThrottled(f"{name} still throttled after {THROTTLE_RETRIES} attempts")
+
+    async def _throttled_async(self, call, name, size=0):
+        """
+        Asyncio version of _throttled; ``call()`` returns an awaitable.
+        """
+        throttle = self.throttle
+        if throttle is None:
+            return await call()
+        for _ in range(THROTTLE_RETRIES):
+            started = time.monotonic()
+            status, data = await call()
+            if status == 'OK':
+                if size:
+                    throttle.record(time.monotonic() - started, size)
+                return status, data
+            if not any(THROTTLED_RE.search(item) for item in data if isinstance(item, bytes)):
+                return status, data
+            deadline = time.monotonic() + self._back_off(throttle, name)
+            while self.is_running and time.monotonic() < deadline:
+                await asyncio.sleep(min(0.1, max(0.0, deadline - time.monotonic())))
+            if not self.is_running:
+                break
+        raise ImapThrottled(f"{name} still throttled after {THROTTLE_RETRIES} attempts")
+
+    def _back_off(self, throttle, name):
+        delay = throttle.throttled()
+        self.metrics.throttled(name)
+        self.log(f"🐢 Gmail throttled {name}: backing off {delay:.1f}s "
+                 f"(chunk size {throttle.chunk_size}, {throttle.concurrency} workers)")
+        return delay
+
+    def _status_items(self, extra=()):
+        items = ["MESSAGES", "UNSEEN"]
+        if 'STATUS=SIZE' in self.capabilities:
+            items.append("SIZE")
+        items.extend(extra)
+        return "(" + " ".join(items) + ")"
+
+    def _parse_status(self, resp):
+        """
+        Split an untagged STATUS response into ``(folder, {item: value})``.
+        """
+        if isinstance(resp, tuple):
+            resp = resp[0]
+        match = STATUS_NAME_RE.match(resp or b'')
+        if not match:
+            return None, {}
+        if match.group(1) is not None:
+            name = re.sub(rb'\\(.)', rb'\1', match.group(1)).decode(errors='ignore')
+        else:
+            name = match.group(2).decode(errors='ignore')
+        return name, {key.decode(): int(value) for key, value in STATUS_ITEM_RE.findall(resp[match.end():])}
+
+    def _folder_status(self, imap, folder, items):
+        """
+        Count a folder with STATUS, which needs no SELECT and never transfers UIDs.
+        """
+        status, data = imap.status(self._quote_folder(folder), items)
+        if status != 'OK' or not data or not data[-1]:
+            return None
+        return self._parse_status(data[-1])[1] or None
+
+    def _list_status(self, imap, items):
+        """
+        Fetch counts for every folder in a single ``LIST ... RETURN (STATUS ...)``
+        round trip (LIST-STATUS, RFC 5819). Returns ``{}`` if the server refuses.
+        """
+        try:
+            typ, dat = imap._simple_command('LIST', '""', '"*"', 'RETURN', f'(STATUS {items})')
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:
+            return {}
+        imap._untagged_response(typ, dat, 'LIST')
+        typ, dat = imap._untagged_response(typ, dat, 'STATUS')
+        if typ != 'OK':
+            return {}
+        stats = {}
+        for resp in dat:
+            name, values = self._parse_status(resp)
+            if name is not None and values:
+                stats[name] = values
+        return stats
+
+    def _search_count(self, imap, criteria):
+        """
+        Count matches of a UID SEARCH in the selected folder. With ESEARCH
+        (RFC 4731) only the count is transferred, not the UID list.
+        """
+        if 'ESEARCH' in self.capabilities:
+            status, _ = self._uid(imap, 'SEARCH', 'RETURN (COUNT)', criteria)
+            _, responses = imap.response('ESEARCH')
+            if status == 'OK':
+                for resp in responses or []:
+                    match = ESEARCH_COUNT_RE.search(resp or b'')
+                    if match:
+                        return int(match.group(1))
+                return 0
+        status, messages = self._uid(imap, 'SEARCH', None, criteria)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"SEARCH {criteria} failed")
+        return len(messages[0].split())
+
+    def _iter_uid_windows(self, imap, criteria, uidnext):
+        """
+        Yield the UIDs matching ``criteria`` in the selected folder as
+        ``array('I')`` windows, one ``UID SEARCH UID a:b <criteria>`` per UID
+        range below ``uidnext``. The range adapts so each window returns
+        about UID_WINDOW UIDs, however sparse the folder is. With ESEARCH the
+        matches arrive as a compressed set (``RETURN (ALL)``). Without a
+        UIDNEXT the folder is searched in one go.
+        """
+        if not uidnext:
+            yield self._search_uids(imap, criteria)
+            return
+        start, span = 1, UID_WINDOW
+        while start < uidnext:
+            end = min(uidnext - 1, start + span - 1)
+            window = self._search_uids(imap, criteria, f"{start}:{end}")
+            yield window
+            if len(window) < UID_WINDOW // 2:
+                span *= 2
+            elif len(window) > UID_WINDOW * 2:
+                span = max(UID_WINDOW, span // 2)
+            start = end + 1
+
+    def _search_uids(self, imap, criteria, uid_range=None):
+        criteria = f"UID {uid_range} {criteria}" if uid_range else criteria
+        if 'ESEARCH' in self.capabilities:
+            status, _ = self._uid(imap, 'SEARCH', 'RETURN (ALL)', criteria)
+            _, responses = imap.response('ESEARCH')
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"SEARCH {criteria} failed")
+            for resp in responses or []:
+                match = ESEARCH_ALL_RE.search(resp or b'')
+                if match:
+                    return parse_uid_set(match.group(1))
+            return array('I')
+        status, messages = self._uid(imap, 'SEARCH', None, criteria)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"SEARCH {criteria} failed")
+        return array('I', map(int, messages[0].split()))
+
+    def _filter_uids(self, imap, email_uids, predicate):
+        """
+        Return the ``email_uids`` of the selected folder for which
+        ``predicate(record, header)`` is true, where ``record`` is
+        parse_message_metadata() of the FETCH response and ``header`` holds
+        the From, To, Subject and List-Id header lines. Metadata is fetched in
+        bulk, ANALYZE_FETCH_SIZE messages per UID FETCH.
+        """
+        kept = array('I')
+        for part in UidSet(email_uids).split(max_size=ANALYZE_FETCH_SIZE):
+            if not self.is_running:
+                break
+            status, data = self._uid(imap, 'FETCH', str(part), FILTER_FETCH_ITEMS)
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"FETCH {part} failed")
+            for meta, literals in iter_fetch_records(data):
+                record = parse_message_metadata(meta)
+                if record["uid"] is not None and predicate(record, literals[0] if literals else b''):
+                    kept.append(record["uid"])
+        return array('I', sorted(kept))
+
+    def _select_state(self, imap, folder, readonly=True):
+        """
+        SELECT a folder and return its EXISTS count plus UIDVALIDITY, UIDNEXT
+        and HIGHESTMODSEQ (None when the server does not report them).
+        """
+        quoted_folder = self._quote_folder(folder)
+        status, data = self._throttled(lambda: imap.select(quoted_folder, readonly=readonly), "SELECT")
+        if status != 'OK':
+            return None
+        state = {"exists": int(data[0] or 0)}
+        for key in ("UIDVALIDITY", "UIDNEXT", "HIGHESTMODSEQ"):
+            _, values = imap.response(key)
+            state[key.lower()] = int(values[-1]) if values and values[-1] else None
+        return state
+
+    def _index_is_fresh(self, index, folder, status):
+        cached = index.folder_state(folder)
+        return (cached is not None
+                and cached["uidvalidity"] == status.get("UIDVALIDITY")
+                and cached["uidnext"] == status.get("UIDNEXT")
+                and cached["messages"] == status.get("MESSAGES")
+                and status.get("HIGHESTMODSEQ", cached["highestmodseq"]) == cached["highestmodseq"])
+
+    def _sync_folder_index(self, imap, index, folder):
+        """
+        Bring the index for ``folder`` up to date and return its SELECT state.
+        A changed UIDVALIDITY drops the cached rows. With CONDSTORE only the
+        messages changed since the cached HIGHESTMODSEQ are fetched (plus
+        VANISHED UIDs under QRESYNC); without it only UIDs at or above the
+        cached UIDNEXT are fetched, and the folder is rebuilt if messages
+        vanished since the last sync.
+        """
+        state = self._select_state(imap, folder)
+        if state is None:
+            return None
+        cached = index.folder_state(folder)
+        if cached is not None and cached["uidvalidity"] != state["uidvalidity"]:
+            self.log(f"💾 UIDVALIDITY changed for {folder}, rebuilding its index")
+            index.reset_folder(folder)
+            cached = None
+        if (cached is not None and cached["uidnext"] == state["uidnext"]
+                and cached["messages"] == state["exists"]
+                and state["highestmodseq"] in (None, cached["highestmodseq"])):
+            return state
+
+        if state["exists"] == 0:
+            index.reset_folder(folder)
+        elif cached is not None and cached["highestmodseq"] and state["highestmodseq"]:
+            self._index_changes(imap, index, folder, cached, state)
+        else:
+            self._index_fetch(imap, index, folder, cached["uidnext"] if cached else 1, state["uidnext"])
+            if index.folder_summary(folder)["MESSAGES"] != state["exists"]:
+                index.reset_folder(folder)
+                self._index_fetch(imap, index, folder, 1, state["uidnext"])
+        index.set_folder_state(folder, state["uidvalidity"], state["uidnext"] or 0, state["highestmodseq"])
+        self.log(f"💾 Indexed {folder}: {index.folder_summary(folder)['MESSAGES']:,} emails")
+        return state
+
+    def _index_changes(self, imap, index, folder, cached, state):
+        """
+        Apply only what changed since the cached HIGHESTMODSEQ: one
+        ``UID FETCH 1:* (...) (CHANGEDSINCE n [VANISHED])`` returns new and
+        modified messages, and under QRESYNC the expunged UIDs as well.
+        """
+        qresync = 'QRESYNC' in self.capabilities
+        modifiers = f"(CHANGEDSINCE {cached['highestmodseq']}{' VANISHED' if qresync else ''})"
+        status, data = imap.uid('FETCH', '1:*', INDEX_FETCH_ITEMS, modifiers)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"FETCH CHANGEDSINCE failed in {folder}")
+        records = [record for record in (parse_message_metadata(meta) for meta, _ in iter_fetch_records(data))
+                   if record["uid"] is not None]
+        index.add_messages(folder, records)
+
+        vanished = []
+        _, responses = imap.response('VANISHED')
+        for resp in responses or []:
+            if resp:
+                vanished.extend(parse_uid_set(resp.split()[-1]))
+        if vanished:
+            index.discard_uids(folder, vanished)
+        if not qresync and index.folder_summary(folder)["MESSAGES"] != state["exists"]:
+            status, messages = imap.uid('SEARCH', None, "ALL")
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"SEARCH failed in {folder}")
+            server_uids = {int(uid) for uid in messages[0].split()}
+            vanished = [uid for uid in index.uids(folder) if uid not in server_uids]
+            index.discard_uids(folder, vanished)
+        self.log(f"💾 {folder}: {len(records):,} changed, {len(vanished):,} vanished since last sync")
+
+    def _index_fetch(self, imap, index, folder, start, uidnext):
+        """
+        Stream metadata for UIDs ``start .. uidnext - 1`` into the index in
+        windows of INDEX_FETCH_SIZE, one bulk UID FETCH per window.
+        """
+        end = uidnext - 1 if uidnext else None
+        while end is None or start <= end:
+            if end is None:
+                uid_range = f"{start}:*"
+            else:
+                uid_range = f"{start}:{min(start + INDEX_FETCH_SIZE - 1, end)}"
+            status, data = imap.uid('FETCH', uid_range, INDEX_FETCH_ITEMS)
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"FETCH {uid_range} failed in {folder}")
+            records = [record for record in (parse_message_metadata(meta) for meta, _ in iter_fetch_records(data))
+                       if record["uid"] is not None and record["uid"] >= start]
+            index.add_messages(folder, records)
+            if end is None:
+                break
+            start += INDEX_FETCH_SIZE
+
+    def _archive_batch(self, imap, archive, folder, uidvalidity, email_uids):
+        """
+        Append a chunk of UIDs to ``archive`` and sync it, returning the UIDs
+        that are now safely archived (messages that vanished or failed to
+        fetch are missing). Bodies are fetched with ``BODY.PEEK[]`` in groups
+        of about ARCHIVE_BATCH_BYTES, using the sizes of a first metadata
+        FETCH, so only one group is held in memory at a time. Body FETCHes
+        are not fed to the throttle's latency model, which is per UID.
+        """
+        archived = array('I')
+        for uid_set in UidSet(email_uids).split():
+            status, data = self._uid(imap, 'FETCH', str(uid_set), ARCHIVE_META_ITEMS)
+            if status != 'OK':
+                continue
+            records = [parse_message_metadata(meta) for meta, _ in iter_fetch_records(data)]
+            for group in self._archive_groups(records):
+                group_set = str(UidSet(group))
+                status, data = self._throttled(lambda: imap.uid('FETCH', group_set, '(UID BODY.PEEK[])'), "UID FETCH")
+                if status == 'OK':
+                    archived.extend(self._write_archive(archive, folder, uidvalidity, group,
+                                                        iter_fetch_records(data)))
+        archive.sync()
+        return array('I', sorted(archived))
+
+    def _archive_groups(self, records):
+        """
+        Split FETCH metadata records into ``{uid: record}`` groups of about
+        ARCHIVE_BATCH_BYTES; a larger message gets a group of its own.
+        """
+        group, size = {}, 0
+        for record in records:
+            if record["uid"] is None:
+                continue
+            if group and size + (record["size"] or 0) > ARCHIVE_BATCH_BYTES:
+                yield group
+                group, size = {}, 0
+            group[record["uid"]] = record
+            size += record["size"] or 0
+        if group:
+            yield group
+
+    def _write_archive(self, archive, folder, uidvalidity, group, fetched):
+        written = []
+        for meta, literals in fetched:
+            uid_match = FETCH_UID_RE.search(meta)
+            record = group.get(int(uid_match.group(1))) if uid_match else None
+            if record is None or not literals:
+                continue
+            archive.add(folder, uidvalidity, record["uid"], literals[0], record["flags"] or (), record["date"])
+            written.append(record["uid"])
+        return written
+
+    def _move_to_trash_batch(self, imap, email_uids, failed=None):
+        """
+        Move a chunk of UIDs to Gmail Trash on a compressed UID set. Uses a
+        single UID MOVE (RFC 6851) when the server advertises it, otherwise one
+        COPY plus one STORE \\Deleted that the caller expunges afterwards.
+        A failing chunk is halved and retried until the offending messages are
+        isolated; their UIDs are appended to ``failed`` when given. Returns the
+        number of moved emails.
+        """
+        if not email_uids:
+            return 0
+        uid_sets = UidSet(email_uids).split()
+        if len(uid_sets) > 1:
+            return sum(self._move_to_trash_batch(imap, list(part), failed) for part in uid_sets)
+        uid_set = str(uid_sets[0])
+        try:
+            if 'MOVE' in self.capabilities:
+                status, _ = self._uid(imap, 'MOVE', uid_set, '[Gmail]/Trash')
+                if status == 'OK':
+                    return len(email_uids)
+            else:
+                status, _ = self._uid(imap, 'COPY', uid_set, '[Gmail]/Trash')
+                if status == 'OK':
+                    status, _ = self._uid(imap, 'STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+                    if status == 'OK':
+                        return len(email_uids)
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:
+            pass
+        if len(email_uids) == 1:
+            if failed is not None:
+                failed.extend(email_uids)
+            return 0
+        middle = len(email_uids) // 2
+        return (self._move_to_trash_batch(imap, email_uids[:middle], failed)
+                + self._move_to_trash_batch(imap, email_uids[middle:], failed))
+
+    def _fetch_msgids(self, imap, uid_set):
+        """
+        Return ``{uid: X-GM-MSGID}`` for a UID set using a single UID FETCH,
+        or None if the FETCH itself failed. UIDs that no longer exist are
+        simply absent from the result.
+        """
+        status, data = self._uid(imap, 'FETCH', uid_set, '(X-GM-MSGID)')
+        if status != 'OK':
+            return None
+        return self._parse_msgids(data)
+
+    def _parse_msgids(self, data):
+        msg_ids = {}
+        for resp in data:
+            if isinstance(resp, tuple):
+                resp = resp[0]
+            if not resp:
+                continue
+            uid_match = FETCH_UID_RE.search(resp)
+            msgid_match = FETCH_MSGID_RE.search(resp)
+            if uid_match and msgid_match:
+                msg_ids[int(uid_match.group(1))] = msgid_match.group(1).decode()
+        return msg_ids
+
+    def _prepare_permanent_delete_batch(self, imap, email_uids, failed=None):
+        """
+        Label a chunk of UIDs as Trash and return their Gmail message IDs so we
+        can delete them forever. The whole chunk costs one FETCH and two STORE
+        commands; a failing chunk is halved like in Move to Trash, and the
+        UIDs that could not be labelled are appended to ``failed``.
+        """
+        if not email_uids:
+            return []
+        uid_sets = UidSet(email_uids).split()
+        if len(uid_sets) > 1:
+            return [msg_id for part in uid_sets
+                    for msg_id in self._prepare_permanent_delete_batch(imap, list(part), failed)]
+        try:
+            msg_ids = self._fetch_msgids(imap, str(uid_sets[0]))
+            if msg_ids == {}:
+                return []
+            if msg_ids:
+                parts = [str(part) for part in UidSet(msg_ids).split()]
+                if all(self._uid(imap, 'STORE', part, '+X-GM-LABELS', '(\\Trash)')[0] == 'OK' for part in parts):
+                    for part in parts:
+                        self._uid(imap, 'STORE', part, '-X-GM-LABELS', '(\\Inbox)')
+                    return list(msg_ids.values())
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:
+            pass
+        if len(email_uids) == 1:
+            if failed is not None:
+                failed.extend(email_uids)
+            return []
+        middle = len(email_uids) // 2
+        return (self._prepare_permanent_delete_batch(imap, email_uids[:middle], failed)
+                + self._prepare_permanent_delete_batch(imap, email_uids[middle:], failed))
+
+    def _delete_permanently(self, imap, msg_id_list, return_mailbox):
+        """
+        Expunge the given Gmail message IDs from Trash. Trash UIDs are resolved
+        with one bulk X-GM-MSGID FETCH instead of a SEARCH per message.
+        Returns True once every STORE \\Deleted and UID EXPUNGE succeeded, or
+        when Trash held none of them; False leaves the folder to be purged
+        again on resume.
+        """
+        if not msg_id_list:
+            return True
+        try:
+            status, data = self._throttled(lambda: imap.select('[Gmail]/Trash'), "SELECT")
+            if status != 'OK':
+                self.log('?? Unable to access Gmail Trash for permanent deletion.')
+                return False
+            if not data or data[0] in (b'0', None):
+                self.log('?? No matching messages located in Trash for permanent removal.')
+                return True
+
+            trash_msgids = self._fetch_msgids(imap, '1:*')
+            if trash_msgids is None:
+                self.log('?? Unable to read message IDs in Gmail Trash for permanent deletion.')
+                return False
+            wanted = set(msg_id_list)
+            trash_uids = [uid for uid, msg_id in trash_msgids.items() if msg_id in wanted]
+            if not trash_uids:
+                self.log('?? No matching messages located in Trash for permanent removal.')
+                return True
+
+            purged = True
+            for uid_set in UidSet(trash_uids).split(max_size=self.chunk_size):
+                uid_set = str(uid_set)
+                if (self._uid(imap, 'STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')[0] != 'OK'
+                        or self._uid(imap, 'EXPUNGE', uid_set)[0] != 'OK'):
+                    self.log(f'?? Failed to purge {uid_set_size(uid_set):,} emails from Gmail Trash.')
+                    purged = False
+            return purged
+        except Exception as e:
+            self.log(f'?? Error while permanently deleting from Trash: {e}')
+            return False
+        finally:
+            try:
+                self._throttled(lambda: imap.select(return_mailbox), "SELECT")
+            except Exception:
+                pass
+
+    async def _open_async_connection(self):
+        conn = await AsyncImapConnection.open(self.host, self.port, self.ssl_context, metrics=self.metrics)
+        await conn.login(*self.credentials)
+        return conn
+
+    def _run_pipelined(self, delete_range, units, unit_done, finish_folder=None):
+        """
+        Run every ``(folder, uids)`` work unit in one event loop over up to
+        ``pool_size`` asyncio connections. Connections reconnect on their
+        own; one that still ends in an ``IMAP4.abort`` is dropped and reopened
+        for the next unit. ``finish_folder(conn, folder)`` is awaited once a
+        folder's last unit is done (see unit_done).
+        """
+        async def run():
+            connections = asyncio.Queue()
+            for _ in range(min(self.pool_size, len(units))):
+                connections.put_nowait(None)
+
+            async def open_connection():
+                return await ReconnectingAsyncImap.open(self._open_async_connection, log=self.log,
+                                                        on_drop=self._connection_dropped)
+
+            async def run_unit(folder, email_uids):
+                if not self.is_running:
+                    unit_done(folder, 0)
+                    return
+                conn = await connections.get()
+                try:
+                    try:
+                        if conn is None:
+                            conn = await open_connection()
+                        finished = unit_done(folder, await delete_range(conn, folder, email_uids))
+                    except Exception as e:
+                        if isinstance(e, imaplib.IMAP4.abort) and conn is not None:
+                            await conn.logout()
+                            conn = None
+                        finished = unit_done(folder, 0, e)
+                    if finished and finish_folder is not None:
+                        try:
+                            if conn is None:
+                                conn = await open_connection()
+                            await finish_folder(conn, folder)
+                        except Exception as e:
+                            self.log(f"❌ Error while finishing {folder}: {e}")
+                finally:
+                    connections.put_nowait(conn)
+
+            await asyncio.gather(*(run_unit(*unit) for unit in units))
+            while not connections.empty():
+                conn = connections.get_nowait()
+                if conn is not None:
+                    await conn.logout()
+
+        asyncio.run(run())
+
+    async def _archive_batch_async(self, conn, archive, folder, uidvalidity, email_uids):
+        """
+        Asyncio version of _archive_batch. Writing and syncing the archive
+        run in a worker thread so other pipelined chunks keep going.
+        """
+        loop = asyncio.get_running_loop()
+        archived = array('I')
+        for uid_set in UidSet(email_uids).split():
+            status, data = await self._uid_async(conn, 'FETCH', str(uid_set), ARCHIVE_META_ITEMS)
+            if status != 'OK':
+                continue
+            records = [parse_message_metadata(meta) for meta, _ in iter_inline_fetch_records(data)]
+            for group in self._archive_groups(records):
+                group_set = str(UidSet(group))
+                status, data = await self._throttled_async(lambda: conn.uid('FETCH', group_set, '(UID BODY.PEEK[])'),
+                                                           "UID FETCH")
+                if status == 'OK':
+                    archived.extend(await loop.run_in_executor(
+                        None, self._write_archive, archive, folder, uidvalidity, group,
+                        list(iter_inline_fetch_records(data))))
+        await loop.run_in_executor(None, archive.sync)
+        return array('I', sorted(archived))
+
+    async def _move_to_trash_batch_async(self, conn, email_uids, failed=None):
+        """
+        Asyncio version of _move_to_trash_batch. The STORE \\Deleted of the
+        COPY fallback is only sent once its COPY succeeded.
+        """
+        if not email_uids:
+            return 0
+        uid_sets = UidSet(email_uids).split()
+        if len(uid_sets) > 1:
+            return sum([await self._move_to_trash_batch_async(conn, list(part), failed) for part in uid_sets])
+        uid_set = str(uid_sets[0])
+        try:
+            if 'MOVE' in self.capabilities:
+                status, _ = await self._uid_async(conn, 'MOVE', uid_set, '[Gmail]/Trash')
+                if status == 'OK':
+                    return len(email_uids)
+            else:
+                status, _ = await self._uid_async(conn, 'COPY', uid_set, '[Gmail]/Trash')
+                if status == 'OK':
+                    status, _ = await self._uid_async(conn, 'STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+                    if status == 'OK':
+                        return len(email_uids)
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:
+            pass
+        if len(email_uids) == 1:
+            if failed is not None:
+                failed.extend(email_uids)
+            return 0
+        middle = len(email_uids) // 2
+        return (await self._move_to_trash_batch_async(conn, email_uids[:middle], failed)
+                + await self._move_to_trash_batch_async(conn, email_uids[middle:], failed))
+
+    async def _prepare_permanent_delete_batch_async(self, conn, email_uids, failed=None):
+        """
+        Asyncio version of _prepare_permanent_delete_batch.
+        """
+        if not email_uids:
+            return []
+        uid_sets = UidSet(email_uids).split()
+        if len(uid_sets) > 1:
+            return [msg_id for part in uid_sets
+                    for msg_id in await self._prepare_permanent_delete_batch_async(conn, list(part), failed)]
+        try:
+            status, data = await self._uid_async(conn, 'FETCH', str(uid_sets[0]), '(X-GM-MSGID)')
+            msg_ids = self._parse_msgids(data) if status == 'OK' else None
+            if msg_ids == {}:
+                return []
+            if msg_ids:
+                parts = [str(part) for part in UidSet(msg_ids).split()]
+                statuses = [(await self._uid_async(conn, 'STORE', part, '+X-GM-LABELS', '(\\Trash)'))[0]
+                            for part in parts]
+                if all(status == 'OK' for status in statuses):
+                    for part in parts:
+                        await self._uid_async(conn, 'STORE', part, '-X-GM-LABELS', '(\\Inbox)')
+                    return list(msg_ids.values())
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:
+            pass
+        if len(email_uids) == 1:
+            if failed is not None:
+                failed.extend(email_uids)
+            return []
+        middle = len(email_uids) // 2
+        return (await self._prepare_permanent_delete_batch_async(conn, email_uids[:middle], failed)
+                + await self._prepare_permanent_delete_batch_async(conn, email_uids[middle:], failed))
+
+    async def _delete_permanently_async(self, conn, msg_id_list):
+        """
+        Asyncio version of _delete_permanently. The STORE / UID EXPUNGE pairs
+        of all Trash chunks are pipelined.
+        """
+        if not msg_id_list:
+            return True
+        try:
+            status, data = await self._throttled_async(lambda: conn.command('SELECT', '[Gmail]/Trash'), "SELECT")
+            if status != 'OK':
+                self.log('?? Unable to access Gmail Trash for permanent deletion.')
+                return False
+            status, data = await self._uid_async(conn, 'FETCH', '1:*', '(X-GM-MSGID)')
+            if status != 'OK':
+                self.log('?? Unable to read message IDs in Gmail Trash for permanent deletion.')
+                return False
+            wanted = set(msg_id_list)
+            trash_uids = [uid for uid, msg_id in self._parse_msgids(data).items() if msg_id in wanted]
+            if not trash_uids:
+                self.log('?? No matching messages located in Trash for permanent removal.')
+                return True
+
+            async def purge_chunk(uid_set):
+                status, _ = await self._uid_async(conn, 'STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+                if status == 'OK':
+                    status, _ = await self._uid_async(conn, 'EXPUNGE', uid_set)
+                if status != 'OK':
+                    self.log(f'?? Failed to purge {uid_set_size(uid_set):,} emails from Gmail Trash.')
+                return status == 'OK'
+
+            results = await asyncio.gather(*(purge_chunk(str(uid_set))
+                                             for uid_set in UidSet(trash_uids).split(max_size=self.chunk_size)))
+            return all(results)
+        except Exception as e:
+            self.log(f'?? Error while permanently deleting from Trash: {e}')
+            return False
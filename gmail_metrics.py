@@ -0,0 +1,294 @@
+"""
+Per-command IMAP instrumentation for the Gmail cleanup engine. Every command
+sent through a metered connection records its type (``SELECT``,
+``UID MOVE``...), latency and bytes on the wire into an ImapMetrics, together
+with throttling replies, dropped connections and the number of messages the
+job processed. The totals can be shown live, logged, or written as JSON or
+Prometheus text at the end of a run.
+"""
+import json
+import time
+import bisect
+import imaplib
+import threading
+
+LATENCY_BUCKETS = tuple(round(0.001 * 1.5 ** exponent, 6) for exponent in range(30))  # 1 ms to ~2 min
+PROMETHEUS_PREFIX = "gmail_cleanup"
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    if seconds < 1:
+        return f"{seconds * 1000:.0f} ms"
+    return f"{seconds:.2f} s"
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket latency histogram (upper bounds in LATENCY_BUCKETS plus an
+    overflow bucket), so memory stays constant however many commands a job
+    sends. Percentiles are interpolated inside their bucket.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = LATENCY_BUCKETS[bucket - 1] if bucket else 0.0
+                upper = LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+
+class CommandStats:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def to_dict(self):
+        latency = self.latency
+        return {
+            "count": latency.count,
+            "errors": self.errors,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "seconds": round(latency.total, 6),
+            "p50": latency.percentile(0.50),
+            "p95": latency.percentile(0.95),
+            "p99": latency.percentile(0.99),
+            "max": latency.max if latency.count else None,
+        }
+
+
+class ImapMetrics:
+    """
+    Thread-safe totals for one engine. Workers call ``record()`` for every
+    finished command; ``summary()`` and ``to_dict()`` may be called at any
+    time from any thread. ``reset()`` starts a new run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.monotonic()
+            self.commands = {}
+            self.throttles = {}
+            self.drops = 0
+            self.messages = 0
+
+    def record(self, command, seconds, sent=0, received=0, ok=True):
+        with self._lock:
+            stats = self.commands.get(command)
+            if stats is None:
+                stats = self.commands[command] = CommandStats()
+            stats.latency.add(seconds)
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            if not ok:
+                stats.errors += 1
+
+    def throttled(self, command):
+        with self._lock:
+            self.throttles[command] = self.throttles.get(command, 0) + 1
+
+    def dropped(self):
+        with self._lock:
+            self.drops += 1
+
+    def processed(self, count):
+        """
+        Count ``count`` messages as handled by the job (scanned, analyzed,
+        planned or deleted), for the round trips per message.
+        """
+        with self._lock:
+            self.messages += count
+
+    def _totals(self):
+        count = sum(stats.latency.count for stats in self.commands.values())
+        latency = LatencyHistogram()
+        for stats in self.commands.values():
+            latency.counts = [a + b for a, b in zip(latency.counts, stats.latency.counts)]
+            latency.total += stats.latency.total
+            latency.max = max(latency.max, stats.latency.max)
+        latency.count = count
+        return latency
+
+    def summary(self):
+        """
+        One status-bar line: commands, latency percentiles, round trips per
+        message, throttling and traffic.
+        """
+        with self._lock:
+            latency = self._totals()
+            if not latency.count:
+                return "📡 No IMAP commands yet"
+            sent = sum(stats.bytes_sent for stats in self.commands.values())
+            received = sum(stats.bytes_received for stats in self.commands.values())
+            text = (f"📡 {latency.count:,} cmds · p50 {format_seconds(latency.percentile(0.5))} · "
+                    f"p95 {format_seconds(latency.percentile(0.95))} · "
+                    f"p99 {format_seconds(latency.percentile(0.99))}")
+            if self.messages:
+                text += f" · {latency.count / self.messages:.4f} rt/msg"
+            throttles = sum(self.throttles.values())
+            if throttles or self.drops:
+                text += f" · 🐢 {throttles} throttled, {self.drops} drops"
+            return text + f" · ↑{sent / 1024:,.0f} KB ↓{received / 1024:,.0f} KB"
+
+    def report_lines(self, limit=8):
+        """
+        Log lines for the commands that took the most time in total.
+        """
+        with self._lock:
+            ranked = sorted(self.commands.items(), key=lambda item: item[1].latency.total, reverse=True)
+            lines = []
+            for command, stats in ranked[:limit]:
+                latency = stats.latency
+                line = (f"⏱️ {command}: {latency.count:,} × p50 {format_seconds(latency.percentile(0.5))}, "
+                        f"p95 {format_seconds(latency.percentile(0.95))}, "
+                        f"p99 {format_seconds(latency.percentile(0.99))}, {latency.total:.1f} s total")
+                if stats.errors:
+                    line += f", {stats.errors} failed"
+                lines.append(line)
+            return lines
+
+    def to_dict(self):
+        with self._lock:
+            latency = self._totals()
+            return {
+                "elapsed": round(time.monotonic() - self.started, 3),
+                "commands": latency.count,
+                "messages": self.messages,
+                "round_trips_per_message": latency.count / self.messages if self.messages else None,
+                "p50": latency.percentile(0.50),
+                "p95": latency.percentile(0.95),
+                "p99": latency.percentile(0.99),
+                "bytes_sent": sum(stats.bytes_sent for stats in self.commands.values()),
+                "bytes_received": sum(stats.bytes_received for stats in self.commands.values()),
+                "throttled": dict(self.throttles),
+                "drops": self.drops,
+                "by_command": {command: stats.to_dict() for command, stats in sorted(self.commands.items())},
+            }
+
+    def to_prometheus(self):
+        """
+        Prometheus text exposition format (a latency histogram and counters
+        labelled by command).
+        """
+        name = PROMETHEUS_PREFIX
+        with self._lock:
+            lines = [f"# HELP {name}_imap_command_seconds Latency of IMAP commands.",
+                     f"# TYPE {name}_imap_command_seconds histogram"]
+            for command, stats in sorted(self.commands.items()):
+                label = f'command="{command}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.latency.counts):
+                    cumulative += count
+                    lines.append(f'{name}_imap_command_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_imap_command_seconds_bucket{{{label},le="+Inf"}} {stats.latency.count}')
+                lines.append(f"{name}_imap_command_seconds_sum{{{label}}} {stats.latency.total:.6f}")
+                lines.append(f"{name}_imap_command_seconds_count{{{label}}} {stats.latency.count}")
+            counters = (
+                ("imap_command_errors_total", "IMAP commands that failed.", "errors"),
+                ("imap_bytes_sent_total", "Bytes sent to the IMAP server.", "bytes_sent"),
+                ("imap_bytes_received_total", "Bytes received from the IMAP server.", "bytes_received"),
+            )
+            for metric, help_text, attribute in counters:
+                lines += [f"# HELP {name}_{metric} {help_text}", f"# TYPE {name}_{metric} counter"]
+                for command, stats in sorted(self.commands.items()):
+                    lines.append(f'{name}_{metric}{{command="{command}"}} {getattr(stats, attribute)}')
+            lines += [f"# HELP {name}_imap_throttled_total Throttling replies, by command.",
+                      f"# TYPE {name}_imap_throttled_total counter"]
+            for command, count in sorted(self.throttles.items()):
+                lines.append(f'{name}_imap_throttled_total{{command="{command}"}} {count}')
+            lines += [f"# HELP {name}_imap_connection_drops_total Dropped IMAP connections.",
+                      f"# TYPE {name}_imap_connection_drops_total counter",
+                      f"{name}_imap_connection_drops_total {self.drops}",
+                      f"# HELP {name}_messages_processed_total Messages handled by the job.",
+                      f"# TYPE {name}_messages_processed_total counter",
+                      f"{name}_messages_processed_total {self.messages}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write the metrics to ``path``: Prometheus text for ``.prom`` and
+        ``.txt`` files, JSON otherwise.
+        """
+        if path.endswith((".prom", ".txt")):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_dict(), indent=2) + "\n"
+        with open(path, "w", encoding="utf-8") as metrics_file:
+            metrics_file.write(text)
+
+
+def command_name(name, args):
+    """
+    Metric label of a command: ``UID FETCH`` rather than just ``UID``.
+    """
+    if name.upper() == 'UID' and args:
+        return f"UID {str(args[0]).upper()}"
+    return name.upper()
+
+
+class MeteredIMAP4_SSL(imaplib.IMAP4_SSL):
+    """
+    imaplib connection that counts the bytes it sends and reads and records
+    every command into ``metrics`` (when given). All imaplib commands go
+    through ``_simple_command``, so nothing is missed.
+    """
+
+    def __init__(self, host, port, ssl_context=None, metrics=None):
+        self.metrics = metrics
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        super().__init__(host, port, ssl_context=ssl_context)
+
+    def send(self, data):
+        self.bytes_sent += len(data)
+        super().send(data)
+
+    def read(self, size):
+        data = super().read(size)
+        self.bytes_received += len(data)
+        return data
+
+    def readline(self):
+        line = super().readline()
+        self.bytes_received += len(line)
+        return line
+
+    def _simple_command(self, name, *args):
+        if self.metrics is None:
+            return super()._simple_command(name, *args)
+        sent, received = self.bytes_sent, self.bytes_received
+        started = time.monotonic()
+        ok = False
+        try:
+            typ, data = super()._simple_command(name, *args)
+            ok = typ == 'OK' or (typ == 'BYE' and name == 'LOGOUT')
+            return typ, data
+        finally:
+            self.metrics.record(command_name(name, args), time.monotonic() - started,
+                                self.bytes_sent - sent, self.bytes_received - received, ok)
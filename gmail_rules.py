@@ -0,0 +1,349 @@
+"""
+Declarative cleanup rules for the Gmail cleanup engine. A rules file is JSON
+(or YAML when PyYAML is installed) with an optional ``keep`` section that
+protects messages from every rule, and a list of ``rules``:
+
+    {
+      "keep": {"starred": true},
+      "rules": [
+        {"name": "Old promotions", "action": "trash",
+         "match": {"category": "promotions", "older_than": "90d"}},
+        {"name": "noreply", "action": "permanent", "folders": ["[Gmail]/All Mail"],
+         "match": {"from": "noreply@example.com", "older_than": "1y"}}
+      ]
+    }
+
+Each rule is compiled into the cheapest server-side search the account
+supports: a single X-GM-RAW query on Gmail, standard IMAP SEARCH keys
+elsewhere. Only conditions no server can evaluate (the ``*_regex`` keys) are
+checked locally, over headers fetched for the messages the server already
+matched. Rules then run one after another through GmailCleanupEngine.delete(),
+each with a journal of its own, so an interrupted rule resumes by itself.
+"""
+import os
+import re
+import json
+import time
+import email.policy
+from email.parser import BytesHeaderParser
+from gmail_engine import build_search_criteria
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+ACTIONS = ("trash", "permanent")
+AGE_RE = re.compile(r'^(\d+)([dmy])$')
+DATE_RE = re.compile(r'^(\d{4})[-/](\d{1,2})[-/](\d{1,2})$')
+SIZE_RE = re.compile(r'^(\d+)\s*([KMG]?)B?$', re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+AGE_DAYS = {'d': 1, 'm': 30, 'y': 365}
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+REGEX_HEADERS = {"from_regex": "From", "to_regex": "To", "subject_regex": "Subject", "list_regex": "List-Id"}
+HEADER_PARSER = BytesHeaderParser(policy=email.policy.default)
+
+
+class RuleError(ValueError):
+    """
+    A rules file that cannot be loaded or a rule that cannot be compiled.
+    """
+
+
+def _gmail_value(value):
+    return f'"{value}"' if re.search(r'[\s(){}"]', value) else value
+
+
+def _imap_string(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _imap_date(year, month, day):
+    return f"{day:02d}-{MONTHS[month - 1]}-{year}"
+
+
+def _age(value):
+    match = AGE_RE.match(str(value).strip().lower())
+    if not match:
+        raise RuleError(f"age {value!r} must look like 90d, 6m or 1y")
+    return match.group(0), int(match.group(1)) * AGE_DAYS[match.group(2)]
+
+
+def _date(value):
+    match = DATE_RE.match(str(value).strip())
+    if not match:
+        raise RuleError(f"date {value!r} must look like 2023-01-31")
+    year, month, day = (int(part) for part in match.groups())
+    if not 1 <= month <= 12 or not 1 <= day <= 31:
+        raise RuleError(f"date {value!r} is not a valid date")
+    return year, month, day
+
+
+def _size(value):
+    match = SIZE_RE.match(str(value).strip())
+    if not match:
+        raise RuleError(f"size {value!r} must be bytes or look like 500K or 10M")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+
+
+def _days_ago(days):
+    cutoff = time.localtime(time.time() - days * 86400)
+    return _imap_date(cutoff.tm_year, cutoff.tm_mon, cutoff.tm_mday)
+
+
+def _text_condition(gmail_key, imap_key):
+    return (lambda value: f"{gmail_key}:{_gmail_value(value)}",
+            lambda value: f"{imap_key} {_imap_string(value)}")
+
+
+def _flag_condition(gmail_set, gmail_unset, imap_set, imap_unset):
+    return (lambda value: gmail_set if value else gmail_unset,
+            lambda value: imap_set if value else imap_unset)
+
+
+def _gmail_only(gmail_key):
+    return (lambda value: f"{gmail_key}:{_gmail_value(value)}", None)
+
+
+# Condition name -> (Gmail search term, IMAP SEARCH key); None where the
+# server cannot evaluate it. Values are validated by the builders.
+CONDITIONS = {
+    "from": _text_condition("from", "FROM"),
+    "to": _text_condition("to", "TO"),
+    "subject": _text_condition("subject", "SUBJECT"),
+    "list": (lambda value: f"list:{_gmail_value(value)}",
+             lambda value: f"HEADER List-Id {_imap_string(value)}"),
+    "older_than": (lambda value: f"older_than:{_age(value)[0]}",
+                   lambda value: f"BEFORE {_days_ago(_age(value)[1])}"),
+    "newer_than": (lambda value: f"newer_than:{_age(value)[0]}",
+                   lambda value: f"SINCE {_days_ago(_age(value)[1])}"),
+    "before": (lambda value: "before:{}/{:02d}/{:02d}".format(*_date(value)),
+               lambda value: f"BEFORE {_imap_date(*_date(value))}"),
+    "after": (lambda value: "after:{}/{:02d}/{:02d}".format(*_date(value)),
+              lambda value: f"SINCE {_imap_date(*_date(value))}"),
+    "larger": (lambda value: f"larger:{_size(value)}", lambda value: f"LARGER {_size(value)}"),
+    "smaller": (lambda value: f"smaller:{_size(value)}", lambda value: f"SMALLER {_size(value)}"),
+    "unread": _flag_condition("is:unread", "is:read", "UNSEEN", "SEEN"),
+    "starred": _flag_condition("is:starred", "-is:starred", "FLAGGED", "UNFLAGGED"),
+    "category": _gmail_only("category"),
+    "label": _gmail_only("label"),
+    "has_attachment": (lambda value: "has:attachment" if value else "-has:attachment", None),
+    "gmail": (lambda value: f"({value})", None),
+    "imap": (None, lambda value: f"({value})"),
+}
+
+
+class LocalFilter:
+    """
+    The part of a rule the server cannot evaluate: regular expressions over
+    the From, To, Subject and List-Id headers. Called by the engine as
+    ``local_filter(record, header)`` for every message the server search
+    matched; true means the message is deleted.
+    """
+
+    def __init__(self, match=(), keep=()):
+        self.match = list(match)
+        self.keep = list(keep)
+
+    def __bool__(self):
+        return bool(self.match or self.keep)
+
+    def __str__(self):
+        terms = [f"{header} ~ /{regex.pattern}/" for header, regex in self.match]
+        terms += [f"not {header} ~ /{regex.pattern}/" for header, regex in self.keep]
+        return " and ".join(terms)
+
+    def __call__(self, record, header):
+        try:
+            message = HEADER_PARSER.parsebytes(header)
+        except Exception:
+            message = None
+
+        def matches(name, regex):
+            try:
+                return any(regex.search(str(value)) for value in message.get_all(name, ()))
+            except Exception:
+                return False  # unparsable header: no regular expression matches
+
+        return (all(matches(name, regex) for name, regex in self.match)
+                and not any(matches(name, regex) for name, regex in self.keep))
+
+
+class CleanupRule:
+    """
+    One named rule: delete what ``match`` selects in ``folders`` (moving it
+    to Trash, or forever when ``action`` is ``permanent``), except what any
+    ``keep`` condition selects. Conditions within ``match`` must all hold; a
+    list value matches any of its items.
+    """
+
+    def __init__(self, name, match, action="trash", folders=None, keep=None):
+        if action not in ACTIONS:
+            raise RuleError(f"rule {name!r}: action must be one of {', '.join(ACTIONS)}")
+        if not match:
+            raise RuleError(f"rule {name!r}: 'match' is required (use {{\"imap\": \"ALL\"}} to match everything)")
+        for key in list(match) + list(keep or {}):
+            if key not in CONDITIONS and key not in REGEX_HEADERS:
+                supported = ", ".join(sorted(list(CONDITIONS) + list(REGEX_HEADERS)))
+                raise RuleError(f"rule {name!r}: unknown condition {key!r} (supported: {supported})")
+        self.name = name
+        self.match = dict(match)
+        self.action = action
+        self.folders = list(folders) if folders else None
+        self.keep = dict(keep or {})
+
+    @property
+    def permanent(self):
+        return self.action == "permanent"
+
+    @property
+    def job(self):
+        return "rule-" + re.sub(r'[^a-z0-9]+', '-', self.name.lower()).strip('-')
+
+    def target_folders(self, gmail=True):
+        """
+        The folders to clean: the rule's own, or every message on Gmail.
+        """
+        return self.folders or (["[Gmail]/All Mail"] if gmail else ["INBOX"])
+
+    def compile(self, gmail=True):
+        """
+        Return ``(criteria, local_filter)``: the UID SEARCH criteria to send,
+        as one X-GM-RAW query when ``gmail`` is set and as IMAP SEARCH keys
+        otherwise, and a LocalFilter for the regular-expression conditions
+        (None when there are none).
+        """
+        gmail_terms, imap_terms = [], []
+        local = LocalFilter()
+        for key, value in self.match.items():
+            self._compile_condition(key, value, gmail, gmail_terms, imap_terms, local.match, negate=False)
+        for key, value in self.keep.items():
+            self._compile_condition(key, value, gmail, gmail_terms, imap_terms, local.keep, negate=True)
+        criteria = build_search_criteria(" ".join(gmail_terms), " ".join(imap_terms))
+        return criteria, (local or None)
+
+    def _compile_condition(self, key, value, gmail, gmail_terms, imap_terms, regexes, negate):
+        values = value if isinstance(value, list) else [value]
+        if not values:
+            raise RuleError(f"rule {self.name!r}: condition {key!r} has no value")
+        if key in REGEX_HEADERS:
+            try:
+                compiled = [re.compile(str(item), re.IGNORECASE) for item in values]
+            except re.error as e:
+                raise RuleError(f"rule {self.name!r}: {key}: {e}")
+            if not negate and len(compiled) > 1:
+                compiled = [re.compile("|".join(f"(?:{regex.pattern})" for regex in compiled), re.IGNORECASE)]
+            regexes.extend((REGEX_HEADERS[key], regex) for regex in compiled)
+            return
+        gmail_term, imap_term = CONDITIONS[key]
+        if gmail and gmail_term is not None:
+            terms = [gmail_term(item) for item in values]
+            if negate:
+                gmail_terms.extend(term[1:] if term.startswith("-") else f"-{term}" for term in terms)
+            else:
+                gmail_terms.append(terms[0] if len(terms) == 1 else "{" + " ".join(terms) + "}")
+        elif imap_term is not None:
+            terms = [imap_term(item) for item in values]
+            if negate:
+                imap_terms.extend(f"NOT {term}" if " " not in term else f"NOT ({term})" for term in terms)
+            else:
+                combined = terms[-1]
+                for term in reversed(terms[:-1]):
+                    combined = f"OR {term} {combined}"
+                imap_terms.append(combined)
+        else:
+            raise RuleError(f"rule {self.name!r}: {key!r} needs a Gmail account (X-GM-EXT-1)")
+
+    @classmethod
+    def from_dict(cls, data, keep=None):
+        if not isinstance(data, dict) or not data.get("name"):
+            raise RuleError(f"every rule needs a 'name': {data!r}")
+        unknown = set(data) - {"name", "match", "action", "folders", "keep", "enabled"}
+        if unknown:
+            raise RuleError(f"rule {data['name']!r}: unknown field(s) {', '.join(sorted(unknown))}")
+        folders = data.get("folders")
+        if isinstance(folders, str):
+            folders = [folders]
+        merged = dict(keep or {})
+        merged.update(data.get("keep") or {})
+        return cls(str(data["name"]), data.get("match") or {}, data.get("action", "trash"), folders, merged)
+
+
+def parse_rules(data):
+    """
+    Build the enabled CleanupRules from a decoded rules file: a list of rules
+    or ``{"keep": {...}, "rules": [...]}``. Raises RuleError when invalid.
+    """
+    if isinstance(data, list):
+        data = {"rules": data}
+    if not isinstance(data, dict) or not isinstance(data.get("rules"), list):
+        raise RuleError("a rules file needs a list of 'rules'")
+    keep = data.get("keep") or {}
+    rules = [CleanupRule.from_dict(rule, keep) for rule in data["rules"]
+             if not isinstance(rule, dict) or rule.get("enabled", True)]
+    names = [rule.job for rule in rules]
+    duplicates = sorted({rule.name for rule in rules if names.count(rule.job) > 1})
+    if duplicates:
+        raise RuleError(f"rule names must be unique: {', '.join(duplicates)}")
+    return rules
+
+
+def load_rules(path):
+    """
+    Load the rules in the JSON or YAML file at ``path``.
+    """
+    with open(path, encoding="utf-8") as rules_file:
+        text = rules_file.read()
+    if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+        if yaml is None:
+            raise RuleError("YAML rules files need PyYAML: pip install pyyaml (or use JSON)")
+        try:
+            data = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise RuleError(f"{path}: {e}")
+    else:
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            raise RuleError(f"{path}: {e}")
+    return parse_rules(data)
+
+
+def explain_rules(engine, rules):
+    """
+    Return what each rule would run on ``engine``'s account, without
+    touching any mail.
+    """
+    gmail = 'X-GM-EXT-1' in engine.capabilities
+    plans = []
+    for rule in rules:
+        criteria, local_filter = rule.compile(gmail)
+        plans.append({
+            "rule": rule.name,
+            "action": rule.action,
+            "folders": rule.target_folders(gmail),
+            "criteria": criteria,
+            "local_filter": str(local_filter) if local_filter else None,
+        })
+    return plans
+
+
+def run_rules(engine, rules, use_index=False, archive=None):
+    """
+    Run ``rules`` in order through ``engine.delete()`` and return one result
+    per rule that ran. Stops after a rule that was stopped by the user. With
+    an ``archive``, messages are archived before they are deleted.
+    """
+    gmail = 'X-GM-EXT-1' in engine.capabilities
+    compiled = [(rule, *rule.compile(gmail)) for rule in rules]
+    results = []
+    for number, (rule, criteria, local_filter) in enumerate(compiled, 1):
+        engine.log(f"📜 Rule {number}/{len(compiled)}: {rule.name} ({rule.action})")
+        result = engine.delete(rule.target_folders(gmail), rule.permanent, criteria, use_index=use_index,
+                               local_filter=local_filter, job=rule.job, archive=archive)
+        results.append(dict(rule=rule.name, **result))
+        if result["stopped"]:
+            break
+    total = sum(result["deleted"] for result in results)
+    engine.log(f"📜 {len(results)}/{len(compiled)} rules applied, {total:,} emails deleted")
+    return results